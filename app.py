@@ -1,11 +1,13 @@
 # app.py
-from ast import literal_eval
 import asyncio
-import re
 import time
 import uuid
 import json
+import logging
 import traceback
+import hashlib
+import threading
+import click
 from flask import (
     Flask, render_template, Response, jsonify, redirect, request, url_for, flash
 )
@@ -14,10 +16,24 @@ from flask_socketio import SocketIO, emit, join_room, leave_room
 from database import database
 import os
 import signal
+import sys
 
-from flow.utils.helpers import create_agent_config, load_yaml, save_yaml
-from flow.scriptGenerationFlow import generate_script_and_roles
+from flow.utils.helpers import format_conversation_line, load_yaml, parse_conversation
+from flow.scriptGenerationFlow import generate_script_and_roles, script_cache
 from flow.dialogueFlow import DialogueFlow
+from flow.crews.dialogueCrew import agent_configs, crew_factory
+from flow.utils.checkpointer import checkpointer
+from flow.utils.coordination import coordinator
+from flow.utils.llm_cache import llm_cache
+from flow.utils.log_sink import log_sink
+from flow.utils.metrics import install_flow_step_spans, metrics, trace_logger, trace_tags
+from flow.utils import socket_utils
+from flow.utils.session_codec import decode_session_state, encode_field, encode_session_state
+from flow.utils.session_registry import SessionRegistry
+from flow.utils.parser_benchmark import load_recorded_outputs, run_parser_benchmark
+from flow.utils.turn_benchmark import LatencyRecorder, run_turn_benchmark, timed_attribute, timed_flow_steps
+from flow.utils.turn_executor import TurnExecutor
+from flow.utils.usage import usage_accountant
 
 from dotenv import load_dotenv
 load_dotenv()
@@ -25,7 +41,7 @@ load_dotenv()
 app = Flask(__name__)
 app.secret_key = "your-very-secret-key"
 CORS(app)
-socketio = SocketIO(app, cors_allowed_origins="*")
+socketio = SocketIO(app, cors_allowed_origins="*", **coordinator.socketio_options())
 
 # --- Initialize Database ---
 database.init_app(app)
@@ -37,24 +53,86 @@ with app.app_context():
         init_db()
     else:
         print("--- APP: Database already exists.")
+    database.migrate_db()
         
 # --- Initialize Config Files ---
 folder_path = "flow/crews/config"
 original_agents_config_path = f"{folder_path}/agents.yaml"
 base_participants_path = f"{folder_path}/base_participants.yaml"
 meta_agents_path = f"{folder_path}/meta_agents.yaml"
-dynamic_participants_path = f"{folder_path}/dynamic_participants.yaml"
 output_path = f"{folder_path}/agents.yaml"
 base_script_path = f"{folder_path}/base_script.yaml"
-dynamic_script_path = f"{folder_path}/dynamic_script.yaml"
 problem_path = f"{folder_path}/problems.yaml"
 
 # --- Load Config Files ---
 problem_list_data = load_yaml(problem_path)
 
-dialogue_flow = None
 sid_to_session = {}  # Dictionary to map socket ID to session ID
 
+# Background workers that run dialogue turns outside the Socket.IO handlers
+turn_executor = TurnExecutor(
+    socketio, app,
+    num_workers=int(os.getenv("TURN_WORKERS", "4")),
+    max_queue_size=int(os.getenv("TURN_QUEUE_SIZE", "100"))
+)
+
+def snapshot_dialogue_flow(session_id, flow, hand_off=False):
+    """
+    Persist a live flow before the registry drops it and release the session's lease. On a hand-off
+    the flow is also passed to the requesting worker as a snapshot; otherwise the next owner loads
+    it from the database, so no snapshot is left behind to go stale.
+    """
+    # A turn scheduled on the dropped flow would run on state that is no longer the session's
+    flow.turn_scheduler.cancel()
+    agent_configs.remove(session_id)
+    session_data = flow.export_session_data()
+    try:
+        checkpointer.flush()
+        with app.app_context():
+            save_session_data(session_data)
+        if hand_off:
+            coordinator.put_snapshot(session_id, session_data)
+        else:
+            # The database now holds newer state than any hand-off snapshot that was never taken
+            coordinator.take_snapshot(session_id)
+    finally:
+        coordinator.release(session_id)
+
+# Live DialogueFlow instances, one per open classroom
+session_registry = SessionRegistry(
+    max_sessions=int(os.getenv("MAX_LIVE_SESSIONS", "50")),
+    idle_ttl=float(os.getenv("SESSION_IDLE_TTL", "1800")),
+    on_evict=snapshot_dialogue_flow,
+    is_busy=DialogueFlow.is_busy
+)
+
+def hand_off_session(session_id):
+    """Another worker asked for this session: drop the flow and pass it a snapshot once no turn is running."""
+    flow = session_registry.get(session_id)
+    if flow is None:
+        coordinator.release(session_id)
+    elif not flow.is_busy():
+        print(f"--- APP: Handing session {session_id} off to another worker.")
+        session_registry.remove(session_id, snapshot=False)
+        snapshot_dialogue_flow(session_id, flow, hand_off=True)
+
+def drop_lost_session(session_id):
+    """The lease was taken over by another worker, whose state is newer: drop the flow without saving it."""
+    print(f"!!! WARNING: Lost the lease of session {session_id}, dropping its flow.")
+    session_registry.remove(session_id, snapshot=False)
+    agent_configs.remove(session_id)
+
+coordinator.start(session_registry.session_ids, on_handoff=hand_off_session, on_lost=drop_lost_session)
+
+# --- Metrics / tracing ---
+metrics.gauge("classroom_active_sessions", "Live dialogue flows in memory.", fn=lambda: len(session_registry))
+metrics.gauge("classroom_queued_turns", "Turns waiting for a turn worker.", fn=turn_executor.queue_depth)
+install_flow_step_spans()
+if os.getenv("TRACE_SPANS", "0") == "1":
+    # One JSON line per span (flow step, crew kickoff, DB query, socket emit)
+    trace_logger.setLevel(logging.DEBUG)
+    trace_logger.addHandler(logging.StreamHandler())
+
 # --- Agent/System Cleanup on Exit ---
 # def cleanup_system():
 #     print("--- APP: Cleaning up system before exit ---")
@@ -63,13 +141,15 @@ sid_to_session = {}  # Dictionary to map socket ID to session ID
 #     print("--- APP: Cleanup complete ---")
 # atexit.register(cleanup_system)
 
-def initialize_dialogue_flow(session_id):
+def initialize_dialogue_flow(session_id, snapshot=None):
+    """
+    Build the live flow of a session from its DB row and event log, or from `snapshot`
+    (an `export_session_data()` handed off by another worker) when given.
+    """
     db = database.get_db()
     session_data = db.execute(
-        '''SELECT session_id, user_name, problem, 
-                    script, roles, current_stage_id, 
-                    conversation, log_file, stage_state, inner_thought,
-                    turn_number
+        '''SELECT session_id, user_name, problem, current_stage_id,
+                    conversation, log_file, turn_number, status, state
                     FROM sessions 
                     WHERE session_id = ?''', (session_id,)
     ).fetchone()
@@ -78,23 +158,25 @@ def initialize_dialogue_flow(session_id):
         print(f"!!! ERROR: Session ID '{session_id}' not found.")
         return None
 
+    if session_data['status'] != 'ready':
+        print(f"--- APP: Session {session_id} is still {session_data['status']}, not starting its dialogue flow.")
+        return None
+
+    # Reuse the live flow if this session is already open; its state is newer than the DB row
+    if session_id in session_registry:
+        return session_data
+
     # --- Initialize Core Components with latest config for THIS session ---
 
     problem_for_session = session_data['problem']
-    roles = session_data['roles']
+    state = decode_session_state(session_data['state'])
+    roles = state.roles
     
     if roles is None:
-        roles = load_yaml(base_participants_path)
-    else:
-        roles = json.loads(roles)
+        roles = crew_factory.load_config(base_participants_path)
 
-    save_yaml(dynamic_participants_path, roles)
-
-    create_agent_config(
-        dynamic_participants_path,
-        meta_agents_path,
-        output_path
-    )
+    # Per-session agent config kept in memory; agents.yaml is only written by `flask export-agent-config`
+    agents_config = agent_configs.register(session_id, roles)
 
     participant_list = []
     
@@ -107,30 +189,220 @@ def initialize_dialogue_flow(session_id):
             'avatar_initial': agent_name[0].upper() if agent_name else 'A'
         })
         
-    stage_state = json.loads(session_data['stage_state'])
-    inner_thought = literal_eval(session_data['inner_thought'])
-    script = json.loads(session_data['script'])
+    stage_state = state.stage_state
+    if snapshot is not None:
+        # Handed off by another worker: skip replaying the event log
+        conversation = snapshot['conversation']
+        inner_thought = snapshot['inner_thought'][-5:]
+    else:
+        conversation = load_conversation(session_id, session_data['conversation'])
+        inner_thought = load_inner_thought(session_id, state)
+    summary_events = database.get_events(session_id, 'summary', limit=1)
+    summary = summary_events[0]['content'] if summary_events else {"summary": "", "summarized_upto": 0}
+    script = state.script
 
     kwargs = {
         "problem": problem_for_session,
         "current_stage_id": session_data['current_stage_id'],
         "script": script,
         "participants": agent_list,
-        "conversation": session_data['conversation'],
+        "conversation": conversation,
         "filename": session_data['log_file'],
         "inner_thought": inner_thought,
         "stage_state": stage_state,
         "session_id": session_id,
         "user_name": session_data['user_name'],
         "turn_number": session_data['turn_number'],
-        "roles": roles
+        "roles": roles,
+        "agents_config": agents_config,
+        "quiet_period": float(os.getenv("TURN_QUIET_PERIOD", "3")),
+        "max_wait": float(os.getenv("TURN_MAX_WAIT", "10")),
+        "pipeline_mode": os.getenv("PIPELINE_MODE", "overlapped"),
+        "stream_speech": os.getenv("STREAM_SPEECH", "1") == "1",
+        "context_window": int(os.getenv("CONTEXT_WINDOW_MESSAGES", "20")),
+        "summary_chunk": int(os.getenv("CONTEXT_SUMMARY_CHUNK", "10")),
+        "conversation_summary": summary["summary"],
+        "summarized_upto": summary["summarized_upto"]
     }   
     
-    global dialogue_flow
-    dialogue_flow = DialogueFlow(socketio=socketio, **kwargs)
+    session_registry.get_or_create(session_id, lambda: DialogueFlow(socketio=socketio, turn_executor=turn_executor,
+                                                                    event_log=record_session_event,
+                                                                    checkpoint=checkpointer.checkpoint, **kwargs))
     print(f"--- APP: Dialogue flow initialized for session {session_id}")
     return session_data
 
+def record_session_event(session_id, event_type, source, content, metadata=None, turn_number=None, timestamp=None):
+    """Event sink of the dialogue flows: queue one row of the session's event log for the checkpointer."""
+    checkpointer.record_event(session_id, event_type, source, content,
+                              metadata=metadata, turn_number=turn_number, timestamp=timestamp)
+
+def write_checkpoint(events, fields, llm_calls):
+    """
+    Checkpointer writer: append the queued events and LLM usage rows and update the changed
+    session columns in one commit.
+    """
+    with app.app_context():
+        for event in events:
+            database.append_event(commit=False, **event)
+        for record in llm_calls:
+            database.append_llm_call(commit=False, **record)
+        for session_id, values in fields.items():
+            database.update_session(session_id, values, commit=False)
+        database.get_db().commit()
+
+checkpointer.write = write_checkpoint
+# Usage rows are written with the next checkpoint batch instead of one commit per LLM call
+usage_accountant.sink = checkpointer.record_llm_call
+
+def load_messages(session_id, legacy_conversation=None):
+    """
+    Return the messages of a session from the event log, oldest first.
+    Sessions saved before the event log existed have their conversation blob moved into it once.
+    """
+    rows = database.get_events(session_id, 'new_message')
+    if not rows and backfill_legacy_conversation(session_id, legacy_conversation):
+        rows = database.get_events(session_id, 'new_message')
+    return rows
+
+def backfill_legacy_conversation(session_id, legacy_conversation):
+    """Move a conversation blob saved before the event log existed into message events."""
+    if not legacy_conversation:
+        return False
+    if database.get_message_page(session_id, limit=1)[0]:
+        return False
+    for message in parse_conversation(legacy_conversation):
+        database.append_event(session_id, 'new_message', message['sender_name'], {
+            'text': message['text'],
+            'sender_name': message['sender_name']
+        }, turn_number=message['turn_number'], timestamp=int(message['timestamp'] * 1000), commit=False)
+    db = database.get_db()
+    db.execute('UPDATE sessions SET conversation = NULL WHERE session_id = ?', (session_id,))
+    db.commit()
+    print(f"--- APP: Moved conversation of session {session_id} into the event log")
+    return True
+
+def load_conversation(session_id, legacy_conversation=None):
+    """Rebuild the conversation string of a session from its message events."""
+    return "".join(
+        format_conversation_line(row['timestamp'] / 1000, row['turn_number'],
+                                 row['content']['sender_name'], row['content']['text'])
+        for row in load_messages(session_id, legacy_conversation)
+    )
+
+def load_inner_thought(session_id, state=None):
+    """
+    Return the inner thoughts of the latest turns (at most 5) from the event log,
+    or from the session state of sessions saved before the event log existed.
+    """
+    rows = database.get_events(session_id, 'inner_thought', limit=5)
+    if rows:
+        return [row['content']['thoughts'] for row in rows]
+    return state.inner_thought[-5:] if state is not None else []
+
+def get_dialogue_flow(session_id):
+    """
+    Return the live dialogue flow for a session, reloading it from the DB if it was evicted.
+    """
+    dialogue_flow = session_registry.get(session_id)
+    if dialogue_flow is None:
+        # Only the worker holding the session's lease runs its turns
+        if not coordinator.claim(session_id, timeout=float(os.getenv("COORDINATION_HANDOFF_TIMEOUT", "10"))):
+            print(f"!!! WARNING: Session {session_id} was not handed off by its worker in time.")
+            return None
+        snapshot = coordinator.take_snapshot(session_id)
+        with app.app_context():
+            if initialize_dialogue_flow(session_id, snapshot) is not None:
+                dialogue_flow = session_registry.get(session_id)
+        if dialogue_flow is None:
+            coordinator.release(session_id)
+    return dialogue_flow
+
+# Messages for sessions whose flow is being loaded in the background, in arrival order
+pending_messages = {}
+pending_messages_lock = threading.Lock()
+
+def live_dialogue_flow_or_queue(session_id, sender_name, text):
+    """
+    Return the live flow of a session, or hold the message and load the flow in a background
+    task: claiming a session another worker holds can take COORDINATION_HANDOFF_TIMEOUT seconds.
+    """
+    while True:
+        with pending_messages_lock:
+            if session_id in pending_messages or session_id not in session_registry:
+                queued = pending_messages.setdefault(session_id, [])
+                queued.append((sender_name, text))
+                if len(queued) == 1:
+                    # No loader running yet; later messages wait behind this one
+                    socketio.start_background_task(deliver_pending_messages, session_id)
+                return None
+        dialogue_flow = session_registry.get(session_id)
+        if dialogue_flow is not None:
+            return dialogue_flow
+        # Evicted in the meantime: queue the message instead
+
+def deliver_pending_messages(session_id):
+    """Background task: load (or claim) the flow of a session and pass it the messages held for it."""
+    try:
+        dialogue_flow = get_dialogue_flow(session_id)
+    except Exception as e:
+        print(f"!!! ERROR loading dialogue flow of {session_id}: {e}")
+        traceback.print_exc()
+        dialogue_flow = None
+    with pending_messages_lock:
+        messages = pending_messages.pop(session_id, [])
+    with app.app_context():
+        if dialogue_flow is None:
+            print(f"!!! WARNING: Dropping {len(messages)} message(s), dialogue flow of {session_id} is not initialized.")
+            socketio.emit('error', {'message': 'Lỗi: Phiên trò chuyện chưa được khởi tạo.'}, room=session_id, namespace='/')
+            return
+        for sender_name, text in messages:
+            try:
+                deliver_message(dialogue_flow, session_id, sender_name, text)
+            except Exception as e:
+                print(f"!!! ERROR in dialogue flow: {e}")
+                traceback.print_exc()
+                socketio.emit('error', {'message': f'Lỗi trong quá trình xử lý tin nhắn: {str(e)}'},
+                              room=session_id, namespace='/')
+
+def deliver_message(dialogue_flow, session_id, sender_name, text):
+    """Pass a message to a live flow (which schedules the turn) and broadcast it if a user sent it."""
+    try:
+        print("--- SOCKETIO: Passing message to dialogue flow...")
+        return dialogue_flow.process_new_message(sender_name, text)
+    finally:
+        # Only broadcast the message if the sender is not an agent (means it's a user message)
+        if sender_name not in dialogue_flow.state.participants:
+            socketio.emit('new_message', {
+                'source': 'user',
+                'content': {
+                    'text': text,
+                    'sender_name': sender_name,
+                    'turn_number': dialogue_flow.state.turn_number
+                },
+                'timestamp': int(time.time() * 1000)
+            }, room=session_id, namespace='/')
+
+def new_session_data(session_id, user_name, problem_text):
+    """Initial fields of a new session row; script and roles are filled in once generated."""
+    conversation = f"TIME={time.time()} | CON#0 | SENDER=System | TEXT=Chào mừng các bạn đến với lớp học. Bài toán của chúng ta là: {problem_text}\n"
+    return {
+        "session_id": session_id,
+        "user_name": user_name,
+        "problem": problem_text,
+        "script": None,
+        "roles": None,
+        "current_stage_id": "1",
+        "conversation": conversation,
+        "log_file": f"logs/{session_id}.log",
+        "stage_state": {
+            "completed_task_ids": [],
+            "signal": "1"
+        },
+        "inner_thought": [], # Initialize as an empty list, not a string "[]"
+        "turn_number": 0,
+        "status": "generating"
+    }
+
 def create_session(session_data):
     """
     Create a new session in the database.
@@ -138,72 +410,51 @@ def create_session(session_data):
     db = database.get_db()      
     db.execute(
         '''INSERT INTO sessions (
-            session_id, user_name, problem, script, roles,
-            current_stage_id, conversation, log_file, stage_state,
-            inner_thought, turn_number
-        ) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)''',
+            session_id, user_name, problem,
+            current_stage_id, conversation, log_file,
+            turn_number, status, state
+        ) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)''',
         (session_data['session_id'],
          session_data['user_name'],
          session_data['problem'],
-         json.dumps(session_data['script']),
-         json.dumps(session_data['roles']),
          session_data['current_stage_id'],
          session_data['conversation'],
          session_data['log_file'],
-         json.dumps(session_data['stage_state']),
-         json.dumps(list(session_data['inner_thought'])), # Ensure inner_thought is a list
-         session_data['turn_number'])
+         session_data['turn_number'],
+         session_data.get('status', 'ready'),
+         encode_session_state(script=session_data['script'],
+                              roles=session_data['roles'],
+                              stage_state=session_data['stage_state'],
+                              inner_thought=session_data['inner_thought']))
     )
     db.commit()
+    database.remember_session(session_data['session_id'])
     print(f"--- APP: Created session {session_data['session_id']} in DB.")
 
 
 def save_session_data(session_data):
     """
-    Save the session data to the database (update existing).
+    Save the small mutable fields of a session to the database (update existing).
+    Messages, stage changes and inner thoughts are already in the event log.
     """
     db = database.get_db()
-    # Ensure inner_thought is a list before converting to JSON for saving
-    inner_thought_list = list(session_data.get('inner_thought', []))
-
     db.execute(
         '''UPDATE sessions SET
-            problem = ?,
-            script = ?,
-            roles = ?,
             current_stage_id = ?,
-            conversation = ?,
             log_file = ?,
-            stage_state = ?,
-            inner_thought = ?,
+            state = json_set(state, '$.stage_state', json(?)),
             turn_number = ?,
             user_name = ?
             WHERE session_id = ?''',
-        (session_data['problem'],
-         json.dumps(session_data['script']),
-         json.dumps(session_data['roles']),
-         session_data['current_stage_id'],
-         session_data['conversation'],
+        (session_data['current_stage_id'],
          session_data['log_file'],
          json.dumps(session_data['stage_state']),
-         json.dumps(inner_thought_list),
          session_data['turn_number'],
          session_data['user_name'],
          session_data['session_id'])
     )
     db.commit()
     print(f"--- APP: Saved session data for session {session_data['session_id']}")
-    # print(f'''--- APP: Saved session data for session {session_data['session_id']} 
-    #       with turn number {session_data['turn_number']}
-    #       and current stage {session_data['current_stage_id']}
-    #       and conversation {session_data['conversation']}
-    #       and log file {session_data['log_file']}
-    #       and stage state {session_data['stage_state']}
-    #       and inner thought {session_data['inner_thought']}
-    #       and script {session_data['script']}
-    #       and roles {session_data['roles']}
-    #       and user name {session_data['user_name']}
-    #       ''')
 
 
 # --- Flask Routes ---
@@ -229,16 +480,35 @@ def select_problem_page():
 @app.route('/chat/<session_id>')
 def chat_interface(session_id):
     """Displays the main chat interface for a specific session."""
-    session_data = initialize_dialogue_flow(session_id)
+    session_status = get_session_status(session_id)
+    if session_status is None:
+        return redirect(url_for('list_sessions'))
+
+    if session_status['status'] == 'generating':
+        # The chat unlocks (page reloads) when the script generation job finishes
+        return render_template('chat_interface.html',
+                               participants=[],
+                               problem=session_status['problem'],
+                               session_id=session_id,
+                               user_name=session_status['user_name'],
+                               session_status='generating')
+
+    if coordinator.acquire(session_id):
+        session_data = initialize_dialogue_flow(session_id, coordinator.take_snapshot(session_id))
+        if session_data is None:
+            coordinator.release(session_id)
+    else:
+        # Another worker runs this session; it is handed off when the first message arrives here
+        session_data = database.get_db().execute(
+            "SELECT problem, user_name, state FROM sessions WHERE session_id = ? AND status = 'ready'", (session_id,)
+        ).fetchone()
     if session_data is None:
         return redirect(url_for('list_sessions'))
     
-    roles = session_data['roles']
+    participants = decode_session_state(session_data['state']).roles
     
-    if roles is None:
-        participants = load_yaml(base_participants_path)
-    else:
-        participants = json.loads(roles)
+    if participants is None:
+        participants = crew_factory.load_config(base_participants_path)
 
     participant_list = []
     
@@ -257,96 +527,103 @@ def chat_interface(session_id):
                            participants=participant_list,
                            problem=problem_for_session,
                            session_id=session_id,
-                           user_name=user_name)
+                           user_name=user_name,
+                           session_status='ready')
 
 @app.route('/history/<session_id>')
 def history(session_id):
-    """Returns event history for a specific session."""
-    db = database.get_db()
-    session_exists = db.execute('SELECT 1 FROM sessions WHERE session_id = ?', (session_id,)).fetchone()
-    if not session_exists:
-        return jsonify({"error": "Session not found"}), 404
+    """
+    Returns message history for a specific session.
+
+    Query params:
+        after_turn: Only messages after this turn number (CON#); a reconnecting client
+            passes the last turn it has. The script is only sent when omitted.
+        limit: Page size; follow `next_after_turn` while `has_more` is true.
+    """
+    after_turn = request.args.get('after_turn', type=int)
+    limit = request.args.get('limit', type=int)
+    if limit is not None and limit <= 0:
+        return jsonify({"error": "limit must be positive"}), 400
 
+    db = database.get_db()
     session_data = db.execute(
-        '''SELECT conversation, script, current_stage_id, stage_state 
+        '''SELECT conversation, current_stage_id, state
             FROM sessions 
             WHERE session_id = ?''',
         (session_id,)
     ).fetchone()
-    
-    history_list = []
-    if session_data and session_data[0]:
-        lines = session_data[0].split('\n')
-        current_message = None
-        for line in lines:
-            pattern = r"TIME=([0-9.]+) \| CON#(\d+) \| SENDER=([^|]+) \| TEXT=(.+)"
-            match = re.match(pattern, line)
-            if match:
-                # Nếu có message trước đó, lưu lại
-                if current_message:
-                    history_list.append(current_message)
-                time_val, turn, sender, text = match.groups()
-                timestamp = float(time_val)
-                turn = int(turn)
-                sender_name = sender.strip()
-                text = text.strip()
-                current_message = {
-                    "source": sender_name,
-                    "content": {
-                        "text": text,
-                        "sender_name": sender_name
-                    },
-                    "timestamp": timestamp * 1000  # Convert to milliseconds
-                }
-            else:
-                # Nếu không match, đây là dòng tiếp theo của TEXT
-                if current_message:
-                    # Nối thêm dòng này vào text, giữ nguyên xuống dòng
-                    current_message["content"]["text"] += "\n" + line
-        # Đừng quên lưu message cuối cùng
-        if current_message:
-            history_list.append(current_message)
-    
-    script_content = json.loads(session_data["script"])
-    stage_state = json.loads(session_data["stage_state"])
-    completed_task_ids = stage_state.get("completed_task_ids", [])
-    current_stage_id = session_data["current_stage_id"]
-    
-    return jsonify({
+    if session_data is None:
+        return jsonify({"error": "Session not found"}), 404
+
+    state = decode_session_state(session_data['state'])
+    backfill_legacy_conversation(session_id, session_data['conversation'])
+    rows, has_more = database.get_message_page(session_id, after_turn=after_turn, limit=limit)
+
+    last_turn = rows[-1]['turn_number'] if rows else after_turn
+    etag = hashlib.sha1(json.dumps([
+        session_id, after_turn, limit, len(rows), last_turn,
+        rows[-1]['timestamp'] if rows else None, has_more,
+        session_data['current_stage_id'], state.stage_state
+    ]).encode('utf-8')).hexdigest()
+    if request.if_none_match.contains(etag):
+        return Response(status=304, headers={'ETag': f'"{etag}"'})
+
+    history_list = [
+        {
+            "source": row['content']['sender_name'],
+            "content": {**row['content'], "turn_number": row['turn_number']},
+            "timestamp": row['timestamp']
+        }
+        for row in rows
+    ]
+    stage_state = state.stage_state or {}
+    response_data = {
         "history": history_list,
-        "script": script_content,
-        "completed_task_ids": completed_task_ids,
-        "current_stage_id": current_stage_id
-    })
+        "has_more": has_more,
+        "next_after_turn": last_turn,
+        "completed_task_ids": stage_state.get("completed_task_ids", []),
+        "current_stage_id": session_data["current_stage_id"]
+    }
+    if after_turn is None:
+        response_data["script"] = state.script
+
+    response = jsonify(response_data)
+    response.set_etag(etag)
+    return response
+
+def purge_session(session_id):
+    """Delete a session row, its events, its live flow and its log file."""
+    checkpointer.discard(session_id)
+    checkpointer.flush()
+    db = database.get_db()
+    db.execute('DELETE FROM sessions WHERE session_id = ?', (session_id,))
+    db.commit()
+    database.forget_session(session_id)
+    coordinator.forget(session_id)
+    database.delete_events(session_id)
+    database.delete_llm_calls(session_id)
+    session_registry.remove(session_id, snapshot=False)
+    agent_configs.remove(session_id)
+    
+    # The sink deletes the log files (and their rotated archives) after the writes still queued
+    log_sink.remove(f"logs/{session_id}.log")
+    log_sink.remove(f"logs/{session_id}.jsonl")
 
 @app.route('/delete_session/<session_id>', methods=['POST'])
 def delete_session(session_id):
     """Delete a chat session from the database."""
     try:
-        db = database.get_db()
         # Check if session exists
-        session = db.execute('SELECT 1 FROM sessions WHERE session_id = ?', (session_id,)).fetchone()
-        if not session:
+        if not database.session_exists(session_id):
             flash("Session not found.", "error")
             return redirect(url_for('list_sessions'))
         
-        # Delete the session
-        db.execute('DELETE FROM sessions WHERE session_id = ?', (session_id,))
-        db.commit()
-        
-        # Try to delete the log file if it exists
-        try:
-            log_file = f"logs/{session_id}.log"
-            if os.path.exists(log_file):
-                os.remove(log_file)
-        except Exception as e:
-            print(f"Warning: Could not delete log file: {e}")
-        
+        purge_session(session_id)
         flash("Session deleted successfully.", "success")
     except Exception as e:
         print(f"Error deleting session: {e}")
         flash("An error occurred while deleting the session.", "error")
-        db.rollback()
+        database.get_db().rollback()
     
     return redirect(url_for('list_sessions'))
 
@@ -359,14 +636,18 @@ def handle_connect():
 def handle_disconnect():
     print(f"--- SOCKETIO: Client disconnected: {request.sid}")
     session_id = sid_to_session.pop(request.sid, None)
-    global dialogue_flow
-    if session_id and dialogue_flow and getattr(dialogue_flow, "session_id", None) == session_id:
+    if session_id and session_id in sid_to_session.values():
+        print(f"--- SOCKETIO: Client disconnected from session {session_id}, other clients are still in the room.")
+        return
+
+    dialogue_flow = session_registry.get(session_id) if session_id else None
+    if dialogue_flow:
         # Bước 1: Yêu cầu flow hủy bỏ các tác vụ đang chạy
         try:
             print(f"--- SOCKETIO: Attempting to cancel dialogue flow for session {session_id}...")
             if hasattr(dialogue_flow, 'cancel'): # Kiểm tra xem phương thức cancel có tồn tại không
-                 dialogue_flow.cancel()
-                 print(f"--- SOCKETIO: Dialogue flow for session {session_id} cancellation requested.")
+                 call_stats = dialogue_flow.cancel()
+                 print(f"--- SOCKETIO: Dialogue flow for session {session_id} cancellation requested. LLM calls: {call_stats}")
             else:
                  print(f"--- SOCKETIO: Dialogue flow instance for session {session_id} does not have a 'cancel' method.")
 
@@ -374,18 +655,10 @@ def handle_disconnect():
             print(f"!!! ERROR requesting cancellation for {session_id}: {e}")
             traceback.print_exc()
 
-        # Bước 2: Lưu session data (có thể cần đợi cancel hoàn tất hoặc lưu trạng thái hiện tại)
-        try:
-            # dialogue_flow vẫn trỏ đến đối tượng này, ngay cả khi nó đang trong quá trình hủy
-            save_session_data(dialogue_flow.export_session_data())
-        except Exception as e:
-            print(f"!!! ERROR saving session data for {session_id} on disconnect: {e}")
-            traceback.print_exc()
-
-        # Bước 3: Giải phóng biến toàn cục
-        dialogue_flow = None
+        # Bước 2 + 3: Gỡ flow khỏi registry; registry lưu session data trước khi giải phóng
+        session_registry.remove(session_id)
     elif session_id:
-        print(f"--- SOCKETIO: Client disconnected from session {session_id}, but it was not the active flow.")
+        print(f"--- SOCKETIO: Client disconnected from session {session_id}, but it had no live flow.")
     else:
         print(f"--- SOCKETIO: Client disconnected, no active session found for sid {request.sid}.")
 
@@ -399,8 +672,7 @@ def handle_join(data):
     
     # Check if session exists
     with app.app_context():
-        db = database.get_db()
-        if not db.execute('SELECT 1 FROM sessions WHERE session_id = ?', (session_id,)).fetchone():
+        if not database.session_exists(session_id):
             emit('navigate', {'url': url_for('list_sessions')}, room=request.sid)
             return
     
@@ -415,7 +687,8 @@ def handle_leave(data):
     session_id = data.get('session_id')
     if session_id:
         # Lưu session data khi rời phòng
-        if dialogue_flow and getattr(dialogue_flow, "session_id", None) == session_id:
+        dialogue_flow = session_registry.get(session_id)
+        if dialogue_flow:
             save_session_data(dialogue_flow.export_session_data())
         leave_room(session_id)
         sid_to_session.pop(request.sid, None)  # Xóa mapping khi rời phòng
@@ -433,47 +706,72 @@ def handle_message(data):
     
     # Check if session exists
     with app.app_context():
-        db = database.get_db()
-        if not db.execute('SELECT 1 FROM sessions WHERE session_id = ?', (session_id,)).fetchone():
+        if not database.session_exists(session_id):
             emit('error', {'message': 'Session not found'})
             return
     
     sender_id = f"user-{sender_name.lower().replace(' ', '-')}"
     print(f"--- SOCKETIO [{session_id}]: Received message from '{sender_name}' ({sender_id}): {text}")
 
-    global dialogue_flow
-    agent_names = dialogue_flow.state.participants if dialogue_flow else []
-
-    # Only broadcast the message if the sender is not an agent (means it's a user message)
-    if sender_name not in agent_names: 
-        emit('new_message', {
-        'source': 'user',
-        'content': {
-            'text': text,
-            'sender_name': sender_name
-        },
-        'timestamp': int(time.time() * 1000)
-    }, room=session_id, namespace='/')
-
-    # Confirm receipt to sender
-    emit('message_received', {
-        'status': 'success',
-        'sender_used': sender_name
-    }, room=request.sid)
+    # Claiming a session from another worker can block, so it never happens in the handler
+    dialogue_flow = live_dialogue_flow_or_queue(session_id, sender_name, text)
 
     # --- DIALOGUE FLOW: Process new message ---
+    job = None
     if dialogue_flow:
         try:
-            print("--- SOCKETIO: Passing message to dialogue flow...")
-            dialogue_flow.process_new_message(sender_name, text)
+            job = deliver_message(dialogue_flow, session_id, sender_name, text)
         except Exception as e:
             print(f"!!! ERROR in dialogue flow: {e}")
             traceback.print_exc()
             emit('error', {'message': f'Lỗi trong quá trình xử lý tin nhắn: {str(e)}'})
-    else:
-        print("!!! WARNING: dialogue_flow is not initialized.")
-        emit('error', {'message': 'Lỗi: Phiên trò chuyện chưa được khởi tạo.'})
 
+    # Confirm receipt to sender
+    emit('message_received', {
+        'status': 'success',
+        'sender_used': sender_name
+    }, room=request.sid)
+    if job:
+        emit('turn_queued', job.to_dict(), room=request.sid)
+
+
+@app.route('/api/turns')
+def turn_queue_status():
+    """Returns the turn executor's queue depth and worker counters."""
+    return jsonify(turn_executor.stats())
+
+@app.route('/api/turns/<job_id>')
+def turn_job_status(job_id):
+    """Returns the status of a single queued turn job."""
+    job = turn_executor.get_job(job_id)
+    if job is None:
+        return jsonify({"error": "Job not found"}), 404
+    return jsonify(job.to_dict())
+
+@app.route('/api/crew_cache')
+def crew_cache_stats():
+    """Returns hit/miss counters of the crew factory cache."""
+    return jsonify(crew_factory.stats())
+
+@app.route('/api/script_cache')
+def script_cache_stats():
+    """Returns hit-rate and size of the generated script cache."""
+    return jsonify(script_cache.stats())
+
+@app.route('/api/llm_cache')
+def llm_cache_stats():
+    """Returns mode, hit-rate and size of the LLM response cache."""
+    return jsonify(llm_cache.stats())
+
+@app.route('/api/checkpoints')
+def checkpoint_stats():
+    """Returns the queued deltas and batch counters of the session checkpointer."""
+    return jsonify(checkpointer.stats())
+
+@app.route('/metrics')
+def prometheus_metrics():
+    """Counters and histograms in the Prometheus text format."""
+    return Response(metrics.render(), mimetype='text/plain; version=0.0.4')
 
 @app.route('/api/problems')
 def get_problems():
@@ -493,12 +791,13 @@ def get_problems():
 @app.route('/generate_script_and_start_chat', methods=['POST'])
 def generate_script_and_start_chat():
     """
-    Receives problem selection, generates script/personas, creates a new chat session,
-    and redirects to the chat interface.
+    Receives problem selection, creates a new chat session and redirects to the chat
+    interface at once; script/personas are generated by a background job.
     """
     problem_id = request.form.get('problem_id')
     username = request.form.get('username', 'User').strip()
     keywords = request.form.get('keywords', '').strip()
+    regenerate = request.form.get('regenerate') == '1'
     # --- Lấy giá trị script từ client ---
     script_from_client = request.form.get('script', None)
     
@@ -524,68 +823,21 @@ def generate_script_and_start_chat():
 
     keywords_list = [kw.strip() for kw in keywords.split(",") if kw.strip()]
 
-    if script_from_client == 'default':
-        script = load_yaml(base_script_path)
-        roles = load_yaml(base_participants_path)
-        create_agent_config(
-            base_participants_path,
-            meta_agents_path,
-            output_path
-        )
-    else:
-        try:
-            kwargs = {
-                "problem": problem_text,
-                "solution": solution_text,
-                "keywords": keywords_list
-            }
-            script, roles = generate_script_and_roles(folder_path, **kwargs)
-            
-            # Create agent config from dynamic script and roles for this session
-            create_agent_config(
-                dynamic_participants_path,
-                meta_agents_path,
-                output_path
-            )
-        except Exception as e:
-            print(f"!!! ERROR generating or saving script/personas: {e}")
-            traceback.print_exc()
-            flash("Có lỗi xảy ra trong quá trình tạo kịch bản. Sử dụng kịch bản mặc định (nếu có).", "warning")
-
-
-
     # Create new session in DB
     session_id = str(uuid.uuid4())
     db = database.get_db()
 
     try:
-        current_stage_id = "1"
-        log_file = f"logs/{session_id}.log"
-        stage_state = {
-            "completed_task_ids": [],
-            "signal": "1"
-        }
-        conversation = f"TIME={time.time()} | CON#0 | SENDER=System | TEXT=Chào mừng các bạn đến với lớp học. Bài toán của chúng ta là: {problem_text}\n"
-        inner_thought = [] # Initialize as an empty list, not a string "[]"
-        turn_number = 0
-        session_data = {
-            "session_id": session_id,
-            "user_name": username,
-            "problem": problem_text,
-            "script": script,
-            "roles": roles,
-            "current_stage_id": current_stage_id,
-            "conversation": conversation,
-            "log_file": log_file,
-            "stage_state": stage_state,
-            "inner_thought": inner_thought, # Use the list here
-            "turn_number": turn_number
-        }
+        session_data = new_session_data(session_id, username, problem_text)
+        if script_from_client == 'default':
+            session_data.update({
+                "script": load_yaml(base_script_path),
+                "roles": load_yaml(base_participants_path),
+                "status": "ready"
+            })
         # Call the new create_session function instead of save_session_data
         create_session(session_data)
         print(f"--- APP: Created new session {session_id} for user {username} (problem {problem_id}) ---")
-        
-        return redirect(url_for('chat_interface', session_id=session_id))
     
     except Exception as e:
         print(f"!!! ERROR creating new session in DB: {e}")
@@ -594,6 +846,208 @@ def generate_script_and_start_chat():
         flash("Có lỗi xảy ra khi tạo phiên trò chuyện mới.", "error")
         return redirect(url_for('select_problem_page'))
 
+    if session_data["status"] == "generating":
+        # Script generation takes tens of seconds; run it off the request and report progress to the chat page
+        socketio.start_background_task(
+            run_script_generation_job, session_id, regenerate,
+            problem=problem_text, solution=solution_text, keywords=keywords_list
+        )
+
+    return redirect(url_for('chat_interface', session_id=session_id))
+
+def get_session_status(session_id):
+    """Return the status fields of a session row, or None if it does not exist."""
+    return database.get_db().execute(
+        'SELECT user_name, problem, status, status_detail FROM sessions WHERE session_id = ?', (session_id,)
+    ).fetchone()
+
+def set_session_status(session_id, status, detail=None, script=None, roles=None):
+    """Update the generation status of a session, and its script/roles once they are known."""
+    db = database.get_db()
+    if script is not None and roles is not None:
+        db.execute(
+            '''UPDATE sessions SET status = ?, status_detail = ?,
+                   state = json_set(state, '$.script', ?, '$.roles', ?) WHERE session_id = ?''',
+            (status, detail, encode_field(script), encode_field(roles), session_id)
+        )
+    else:
+        db.execute(
+            'UPDATE sessions SET status = ?, status_detail = ? WHERE session_id = ?',
+            (status, detail, session_id)
+        )
+    db.commit()
+
+def run_script_generation_job(session_id, regenerate, **kwargs):
+    """
+    Background job: generate the script/roles of a session created in the 'generating' state,
+    then mark it ready. Falls back to the default script if generation fails.
+    """
+    def report_progress(step, detail=""):
+        set_session_status(session_id, 'generating', step)
+        socketio.emit('script_generation_progress', {
+            'session_id': session_id,
+            'step': step,
+            'detail': detail
+        }, room=session_id, namespace='/')
+
+    with app.app_context(), trace_tags(session_id=session_id, turn_number=0):
+        try:
+            script, roles = generate_script_and_roles(
+                regenerate=regenerate, on_progress=report_progress, **kwargs
+            )
+            detail = 'generated'
+        except Exception as e:
+            print(f"!!! ERROR generating script/personas: {e}")
+            traceback.print_exc()
+            # Sử dụng kịch bản mặc định
+            script = load_yaml(base_script_path)
+            roles = load_yaml(base_participants_path)
+            detail = 'fallback_default'
+
+        set_session_status(session_id, 'ready', detail, script=script, roles=roles)
+        print(f"--- APP: Script generation for session {session_id} finished ({detail})")
+        socketio.emit('script_generation_done', {
+            'session_id': session_id,
+            'status': 'ready',
+            'detail': detail
+        }, room=session_id, namespace='/')
+
+@app.route('/api/sessions/<session_id>/status')
+def session_status(session_id):
+    """Polling fallback for the script generation status of a session."""
+    status = get_session_status(session_id)
+    if status is None:
+        return jsonify({"error": "Session not found"}), 404
+    return jsonify({"session_id": session_id, "status": status['status'], "detail": status['status_detail']})
+
+@app.route('/api/sessions/<session_id>/usage')
+def session_usage(session_id):
+    """
+    Token counts and wall time of a session's LLM calls: the totals, plus one row per group
+    when `group_by` is given (comma-separated: agent, task, turn).
+    """
+    group_by = [key.strip() for key in request.args.get('group_by', '').split(',') if key.strip()]
+    unknown = [key for key in group_by if key not in database.USAGE_GROUP_COLUMNS]
+    if unknown:
+        return jsonify({"error": f"Unknown group_by: {', '.join(unknown)}"}), 400
+    if not database.session_exists(session_id):
+        return jsonify({"error": "Session not found"}), 404
+
+    response_data = {
+        "session_id": session_id,
+        "total": dict(database.get_llm_usage(session_id)[0])
+    }
+    if group_by:
+        response_data["group_by"] = group_by
+        response_data["groups"] = [dict(row) for row in database.get_llm_usage(session_id, group_by)]
+    return jsonify(response_data)
+
+@app.cli.command('export-agent-config')
+@click.argument('session_id')
+@click.option('--output', default=output_path, help='Path of the agents YAML to write.')
+def export_agent_config_command(session_id, output):
+    """Write the merged agent config of a session (participants + meta agents) to a YAML file."""
+    session = database.get_db().execute(
+        'SELECT state FROM sessions WHERE session_id = ?', (session_id,)
+    ).fetchone()
+    if session is None:
+        raise click.ClickException(f"Session ID '{session_id}' not found.")
+    roles = decode_session_state(session['state']).roles or load_yaml(base_participants_path)
+    agent_configs.register(session_id, roles)
+    click.echo(f"Exported agent config to {agent_configs.export(session_id, output)}")
+
+@app.cli.command('bench-turns')
+@click.option('--sessions', default=4, show_default=True, help='Number of simulated sessions (M).')
+@click.option('--turns', default=5, show_default=True, help='User turns per session (T).')
+@click.option('--output', default=None, help='Write the JSON report to this file instead of stdout.')
+@click.option('--live', is_flag=True, help='Allow running against the real LLM.')
+@click.option('--keep-sessions', is_flag=True, help='Keep the benchmark sessions in the database.')
+def bench_turns_command(sessions, turns, output, live, keep_sessions):
+    """
+    Run M sessions x T turns through DialogueFlow.process_new_message and report p50/p95/p99
+    per flow step, per turn, for DB writes and for Socket.IO emits as JSON.
+    """
+    if not live and os.getenv("LLM_BACKEND", "default") != "fake" and llm_cache.mode != "replay":
+        raise click.ClickException("Set LLM_BACKEND=fake or LLM_CACHE_MODE=replay (or pass --live).")
+
+    recorder = LatencyRecorder()
+    problem_text = problem_list_data['1']['problem']
+    session_ids = [str(uuid.uuid4()) for _ in range(sessions)]
+
+    def save(flow):
+        with app.app_context():
+            save_session_data(flow.export_session_data())
+
+    # record_session_event is looked up when the flows are created, so it is wrapped before that
+    with timed_attribute(sys.modules[__name__], 'record_session_event', 'db_event', recorder), \
+         timed_attribute(socket_utils, 'emit', 'emit', recorder), \
+         timed_flow_steps(recorder):
+        for session_id in session_ids:
+            session_data = new_session_data(session_id, "BenchUser", problem_text)
+            session_data.update({
+                "script": load_yaml(base_script_path),
+                "roles": load_yaml(base_participants_path),
+                "status": "ready"
+            })
+            create_session(session_data)
+        flows = [get_dialogue_flow(session_id) for session_id in session_ids]
+        started = time.perf_counter()
+        counts = run_turn_benchmark(flows, turns, recorder, save=save)
+        wall_seconds = time.perf_counter() - started
+
+    report = {
+        "sessions": sessions,
+        "turns": turns,
+        "turns_completed": counts["completed"],
+        "turns_failed": counts["failed"],
+        "wall_seconds": round(wall_seconds, 3),
+        "turns_per_second": round(counts["completed"] / wall_seconds, 3) if wall_seconds else None,
+        "config": {
+            "llm_backend": os.getenv("LLM_BACKEND", "default"),
+            "llm_cache_mode": llm_cache.mode,
+            "pipeline_mode": os.getenv("PIPELINE_MODE", "overlapped"),
+            "stream_speech": os.getenv("STREAM_SPEECH", "1") == "1",
+            "turn_workers": turn_executor.num_workers,
+        },
+        "latency": recorder.summary(),
+    }
+
+    if not keep_sessions:
+        for session_id in session_ids:
+            purge_session(session_id)
+
+    payload = json.dumps(report, indent=2, ensure_ascii=False)
+    if output:
+        with open(output, "w", encoding="utf-8") as f:
+            f.write(payload + "\n")
+        click.echo(f"Wrote benchmark report to {output}")
+    else:
+        click.echo(payload)
+
+@app.cli.command('bench-parsers')
+@click.option('--input', 'input_path', default=None,
+              help='LLM cache file (LLM_CACHE_MODE=record) or JSONL of {"task", "raw"}. Defaults to LLM_CACHE_PATH.')
+@click.option('--repeat', default=20, show_default=True, help='Parses per record and parser, for timing.')
+@click.option('--output', default=None, help='Write the JSON report to this file instead of stdout.')
+def bench_parsers_command(input_path, repeat, output):
+    """
+    Parse recorded LLM outputs with the legacy clean_response/parse_json_response chain and with
+    extract_json, and report valid/repair/failure rates per task and the parse time of each.
+    """
+    input_path = input_path or llm_cache.db_path
+    if not os.path.exists(input_path):
+        raise click.ClickException(f"No recorded outputs at {input_path} (record some with LLM_CACHE_MODE=record).")
+    records = load_recorded_outputs(input_path)
+    report = {"input": input_path, **run_parser_benchmark(records, repeat=repeat)}
+
+    payload = json.dumps(report, indent=2, ensure_ascii=False)
+    if output:
+        with open(output, "w", encoding="utf-8") as f:
+            f.write(payload + "\n")
+        click.echo(f"Wrote parser benchmark report to {output}")
+    else:
+        click.echo(payload)
+
 # Biến cờ để kiểm soát việc tắt
 shutdown_flag = False
 
@@ -601,8 +1055,11 @@ async def shutdown():
     global shutdown_flag
     shutdown_flag = True
     print("--- APP: Shutting down gracefully...")
-    if dialogue_flow:
-        save_session_data(dialogue_flow.export_session_data())
+    session_registry.close()
+    checkpointer.close()
+    log_sink.close()
+    coordinator.close()
+    database.pool.close()
     print("--- APP: Shutdown complete.")
 
 def signal_handler(sig, frame):
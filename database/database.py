@@ -1,27 +1,154 @@
 # chatcollab_app/database/database.py
+import os
+import queue
 import sqlite3
+import threading
+import time
+import uuid
 import click
 from flask import current_app, g
 from flask.cli import with_appcontext
 import json # For storing content/metadata
 
+from flow.utils.metrics import metrics, span
+from flow.utils.session_codec import legacy_session_state
+
 DATABASE = 'chat_sessions.db'
 
+# Applied to every new connection. WAL lets readers run alongside the single writer,
+# which matters with several gunicorn workers on the same file.
+PRAGMAS = [
+    'PRAGMA journal_mode=WAL',
+    'PRAGMA synchronous=NORMAL',
+    'PRAGMA temp_store=MEMORY',
+    'PRAGMA cache_size=-8000',
+    'PRAGMA busy_timeout=0',  # Lock waits are retried in Python, see TracedConnection
+]
+LOCK_TIMEOUT = float(os.getenv('DB_LOCK_TIMEOUT', '5'))
+POOL_SIZE = int(os.getenv('DB_POOL_SIZE', '8'))
+SESSION_CACHE_TTL = float(os.getenv('DB_SESSION_CACHE_TTL', '30'))
+
+db_lock_wait_seconds = metrics.histogram('classroom_db_lock_wait_seconds',
+                                         'Time statements spent waiting for a locked database.')
+db_lock_timeouts_total = metrics.counter('classroom_db_lock_timeouts_total',
+                                         'Statements that gave up waiting for a locked database.')
+session_cache_total = metrics.counter('classroom_session_cache_total',
+                                      'Session existence checks by cache result (hit/miss).', ['result'])
+
+class TracedConnection(sqlite3.Connection):
+    """
+    sqlite3 connection whose statements and commits are timed as 'db_query' / 'db_commit' spans.
+
+    SQLite's own busy handler sleeps inside the C call, which blocks a gevent worker and
+    hides the wait. Statements (execute, executemany, executescript) and commits that find
+    the database locked are instead retried here with a cooperative sleep, for up to
+    LOCK_TIMEOUT seconds, and the wait is observed in classroom_db_lock_wait_seconds.
+    """
+
+    def execute(self, sql, parameters=()):
+        with span("db_query", statement=sql.split(None, 1)[0].upper()):
+            return self._retry_locked(super().execute, sql, parameters)
+
+    def executemany(self, sql, seq_of_parameters):
+        # Materialized so a retry after a lock sees the same rows
+        rows = list(seq_of_parameters)
+        with span("db_query", statement=sql.split(None, 1)[0].upper()):
+            return self._retry_locked(super().executemany, sql, rows)
+
+    def executescript(self, sql_script):
+        # Only used for schema scripts, which are safe to run again after a partial attempt
+        with span("db_query", statement="SCRIPT"):
+            return self._retry_locked(super().executescript, sql_script)
+
+    def commit(self):
+        with span("db_commit"):
+            return self._retry_locked(super().commit)
+
+    def _retry_locked(self, call, *args):
+        waited, delay = 0.0, 0.001
+        while True:
+            try:
+                result = call(*args)
+            except sqlite3.OperationalError as e:
+                if 'locked' not in str(e) and 'busy' not in str(e):
+                    raise
+                if waited >= LOCK_TIMEOUT:
+                    db_lock_timeouts_total.inc()
+                    db_lock_wait_seconds.observe(waited)
+                    raise
+                time.sleep(delay)
+                waited += delay
+                delay = min(delay * 2, 0.05)
+                continue
+            if waited:
+                db_lock_wait_seconds.observe(waited)
+            return result
+
+def connect():
+    """Open a new connection with the pragmas applied."""
+    db = sqlite3.connect(
+        DATABASE,
+        detect_types=sqlite3.PARSE_DECLTYPES,
+        factory=TracedConnection,
+        check_same_thread=False  # Pooled connections move between threads, one user at a time
+    )
+    db.row_factory = sqlite3.Row # Access columns by name
+    for pragma in PRAGMAS:
+        db.execute(pragma)
+    return db
+
+class ConnectionPool:
+    """Idle connections kept per worker process, so app contexts reuse them instead of reconnecting."""
+
+    def __init__(self, size=POOL_SIZE):
+        self.size = size
+        self._idle = queue.LifoQueue()
+        self._pid = os.getpid()
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        self._check_fork()
+        try:
+            return self._idle.get_nowait()
+        except queue.Empty:
+            return connect()
+
+    def release(self, db):
+        if db.in_transaction:
+            db.rollback()  # Same as closing: uncommitted changes are dropped
+        if self._pid != os.getpid() or self._idle.qsize() >= self.size:
+            db.close()
+            return
+        self._idle.put(db)
+
+    def close(self):
+        while True:
+            try:
+                self._idle.get_nowait().close()
+            except queue.Empty:
+                return
+
+    def _check_fork(self):
+        # Connections must not cross a fork (gunicorn preloading)
+        if self._pid != os.getpid():
+            with self._lock:
+                if self._pid != os.getpid():
+                    self._idle = queue.LifoQueue()
+                    self._pid = os.getpid()
+
+pool = ConnectionPool()
+
 def get_db():
     """Connects to the specific database."""
     if 'db' not in g:
-        g.db = sqlite3.connect(
-            DATABASE,
-            detect_types=sqlite3.PARSE_DECLTYPES
-        )
-        g.db.row_factory = sqlite3.Row # Access columns by name
+        g.db = pool.acquire()
     return g.db
 
 def close_db(e=None):
-    """Closes the database connection."""
+    """Returns the connection to the pool."""
     db = g.pop('db', None)
     if db is not None:
-        db.close()
+        pool.release(db)
 
 def init_db():
     """Clears existing data and creates new tables."""
@@ -31,6 +158,258 @@ def init_db():
         db.executescript(f.read().decode('utf8'))
     print("Initialized the database.")
 
+# Columns added after the first release, as (table, column, definition).
+# Databases created from an older schema.sql get them on startup via migrate_db().
+MIGRATIONS = [
+    ('sessions', 'status', "TEXT NOT NULL DEFAULT 'ready'"),
+    ('sessions', 'status_detail', 'TEXT'),
+    ('events', 'turn_number', 'INTEGER'),
+    ('sessions', 'state', 'TEXT'),
+]
+
+# Tables added after the first release, created if missing by migrate_db()
+TABLES = [
+    '''CREATE TABLE IF NOT EXISTS llm_calls (
+        session_id TEXT NOT NULL,
+        timestamp INTEGER NOT NULL,
+        turn_number INTEGER,
+        agent_name TEXT NOT NULL,
+        task_name TEXT NOT NULL,
+        prompt_tokens INTEGER NOT NULL DEFAULT 0,
+        completion_tokens INTEGER NOT NULL DEFAULT 0,
+        total_tokens INTEGER NOT NULL DEFAULT 0,
+        seconds REAL NOT NULL,
+        cached INTEGER NOT NULL DEFAULT 0,
+        FOREIGN KEY (session_id) REFERENCES sessions (session_id)
+    )''',
+]
+
+# Indexes added after the first release, created if missing by migrate_db()
+INDEXES = [
+    'CREATE INDEX IF NOT EXISTS idx_events_session_type_turn ON events (session_id, event_type, turn_number)',
+    'CREATE INDEX IF NOT EXISTS idx_llm_calls_session_turn ON llm_calls (session_id, turn_number)',
+]
+
+def migrate_db():
+    """Add missing tables, columns and indexes to an existing database. Safe to run repeatedly."""
+    db = get_db()
+    for statement in TABLES:
+        db.execute(statement)
+    for table, column, definition in MIGRATIONS:
+        columns = {row['name'] for row in db.execute(f'PRAGMA table_info({table})')}
+        if column not in columns:
+            db.execute(f'ALTER TABLE {table} ADD COLUMN {column} {definition}')
+            print(f"Migrated database: added {table}.{column}")
+    for statement in INDEXES:
+        db.execute(statement)
+    migrate_session_state(db)
+    db.commit()
+
+def migrate_session_state(db):
+    """Move the script/roles/stage_state/inner_thought columns of older rows into the sessions.state document."""
+    rows = db.execute(
+        'SELECT session_id, script, roles, stage_state, inner_thought FROM sessions WHERE state IS NULL'
+    ).fetchall()
+    if not rows:
+        return
+    db.executemany(
+        '''UPDATE sessions SET state = ?, script = NULL, roles = NULL, stage_state = NULL, inner_thought = NULL
+           WHERE session_id = ?''',
+        [(legacy_session_state(row['script'], row['roles'], row['stage_state'], row['inner_thought']),
+          row['session_id']) for row in rows]
+    )
+    print(f"Migrated database: moved the state of {len(rows)} session(s) into sessions.state")
+
+# --- Event log ---
+def append_event(session_id, event_type, source, content, metadata=None, turn_number=None, timestamp=None,
+                 commit=True):
+    """
+    Append one row to the event log of a session.
+
+    Args:
+        event_type (str): 'new_message', 'stage_change', 'inner_thought' or 'summary'.
+        content (dict): Event payload.
+        timestamp (int): Milliseconds since epoch, defaults to now.
+        commit (bool): Commit right away; pass False to batch several appends.
+    """
+    db = get_db()
+    db.execute(
+        '''INSERT INTO events (event_id, session_id, timestamp, event_type, source, content, metadata, turn_number)
+           VALUES (?, ?, ?, ?, ?, ?, ?, ?)''',
+        (str(uuid.uuid4()), session_id,
+         timestamp if timestamp is not None else int(time.time() * 1000),
+         event_type, source, content, metadata, turn_number)
+    )
+    if commit:
+        db.commit()
+
+def get_events(session_id, event_type, limit=None):
+    """
+    Return the events of one type for a session, oldest first.
+
+    Args:
+        limit (int): Only return the latest `limit` events.
+    """
+    db = get_db()
+    if limit is None:
+        return db.execute(
+            '''SELECT timestamp, source, content, metadata, turn_number FROM events
+               WHERE session_id = ? AND event_type = ? ORDER BY timestamp, rowid''',
+            (session_id, event_type)
+        ).fetchall()
+    rows = db.execute(
+        '''SELECT timestamp, source, content, metadata, turn_number FROM events
+           WHERE session_id = ? AND event_type = ? ORDER BY timestamp DESC, rowid DESC LIMIT ?''',
+        (session_id, event_type, limit)
+    ).fetchall()
+    return rows[::-1]
+
+def get_message_page(session_id, after_turn=None, limit=None):
+    """
+    Return a page of message events ordered by turn, and whether more follow.
+
+    Args:
+        after_turn (int): Only messages with a larger turn number (CON#).
+        limit (int): Page size. A page never splits the messages of one turn, so it
+            may hold a few more rows than `limit`.
+
+    Returns:
+        tuple: (rows, has_more)
+    """
+    db = get_db()
+    query = '''SELECT timestamp, source, content, turn_number FROM events
+               WHERE session_id = ? AND event_type = 'new_message' AND turn_number > ?
+               ORDER BY turn_number, timestamp, rowid'''
+    params = [session_id, after_turn if after_turn is not None else -1]
+    if limit is None:
+        return db.execute(query, params).fetchall(), False
+
+    rows = db.execute(query + ' LIMIT ?', params + [limit]).fetchall()
+    if len(rows) < limit:
+        return rows, False
+    # Complete the last turn of the page so `after_turn` cursors never skip messages
+    last_turn = rows[-1]['turn_number']
+    rows = [row for row in rows if row['turn_number'] != last_turn] + db.execute(
+        '''SELECT timestamp, source, content, turn_number FROM events
+           WHERE session_id = ? AND event_type = 'new_message' AND turn_number = ?
+           ORDER BY timestamp, rowid''',
+        (session_id, last_turn)
+    ).fetchall()
+    has_more = db.execute(
+        '''SELECT 1 FROM events WHERE session_id = ? AND event_type = 'new_message' AND turn_number > ? LIMIT 1''',
+        (session_id, last_turn)
+    ).fetchone() is not None
+    return rows, has_more
+
+# --- Session checkpoints ---
+# Columns a dialogue flow checkpoints after each turn
+CHECKPOINT_COLUMNS = ('current_stage_id', 'stage_state', 'turn_number')
+# Of those, the ones kept in the sessions.state document (see flow/utils/session_codec.py)
+STATE_FIELDS = ('stage_state',)
+
+def update_session(session_id, fields, commit=True):
+    """Update some of the CHECKPOINT_COLUMNS of a session row; STATE_FIELDS are set inside sessions.state."""
+    unknown = set(fields) - set(CHECKPOINT_COLUMNS)
+    if unknown:
+        raise ValueError(f"Not checkpointed session columns: {', '.join(sorted(unknown))}")
+    if not fields:
+        return
+    assignments, params = [], []
+    for column, value in fields.items():
+        if column in STATE_FIELDS:
+            assignments.append(f"state = json_set(state, '$.{column}', json(?))")
+            params.append(json.dumps(value))
+        else:
+            assignments.append(f"{column} = ?")
+            params.append(value)
+    db = get_db()
+    db.execute(f'UPDATE sessions SET {", ".join(assignments)} WHERE session_id = ?', params + [session_id])
+    if commit:
+        db.commit()
+
+# --- Session existence ---
+# session_id -> time it was last seen in the database. Only existing sessions are cached;
+# other workers' deletes are picked up after SESSION_CACHE_TTL seconds.
+_known_sessions = {}
+_known_sessions_lock = threading.Lock()
+
+def session_exists(session_id):
+    """Whether a session row exists, served from the in-process cache when possible."""
+    now = time.monotonic()
+    with _known_sessions_lock:
+        seen = _known_sessions.get(session_id)
+    if seen is not None and now - seen < SESSION_CACHE_TTL:
+        session_cache_total.inc(result='hit')
+        return True
+    session_cache_total.inc(result='miss')
+    exists = get_db().execute('SELECT 1 FROM sessions WHERE session_id = ?', (session_id,)).fetchone() is not None
+    with _known_sessions_lock:
+        if exists:
+            _known_sessions[session_id] = now
+        else:
+            _known_sessions.pop(session_id, None)
+    return exists
+
+def remember_session(session_id):
+    """Mark a session as existing (call after creating it)."""
+    with _known_sessions_lock:
+        _known_sessions[session_id] = time.monotonic()
+
+def forget_session(session_id):
+    """Drop a session from the existence cache (call when deleting it)."""
+    with _known_sessions_lock:
+        _known_sessions.pop(session_id, None)
+
+def delete_events(session_id):
+    db = get_db()
+    db.execute('DELETE FROM events WHERE session_id = ?', (session_id,))
+    db.commit()
+
+# --- LLM call accounting ---
+USAGE_GROUP_COLUMNS = {'agent': 'agent_name', 'task': 'task_name', 'turn': 'turn_number'}
+
+def append_llm_call(session_id, agent_name, task_name, prompt_tokens, completion_tokens, total_tokens,
+                    seconds, cached=False, turn_number=None, timestamp=None, commit=True):
+    """Record the token counts and wall time of one crew kickoff (commit=False leaves the commit to the caller)."""
+    db = get_db()
+    db.execute(
+        '''INSERT INTO llm_calls (session_id, timestamp, turn_number, agent_name, task_name,
+                                  prompt_tokens, completion_tokens, total_tokens, seconds, cached)
+           VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)''',
+        (session_id, timestamp if timestamp is not None else int(time.time() * 1000), turn_number,
+         agent_name, task_name, prompt_tokens, completion_tokens, total_tokens, seconds, int(cached))
+    )
+    if commit:
+        db.commit()
+
+def get_llm_usage(session_id, group_by=()):
+    """
+    Sum the LLM calls of a session, optionally grouped.
+
+    Args:
+        group_by (list[str]): Any of 'agent', 'task' and 'turn'.
+
+    Returns:
+        list: One row per group (a single row without grouping), with calls, cached_calls,
+            prompt_tokens, completion_tokens, total_tokens and seconds.
+    """
+    columns = [USAGE_GROUP_COLUMNS[key] for key in group_by]
+    select = ''.join(f'{column}, ' for column in columns)
+    query = f'''SELECT {select}COUNT(*) AS calls, COALESCE(SUM(cached), 0) AS cached_calls,
+                      COALESCE(SUM(prompt_tokens), 0) AS prompt_tokens,
+                      COALESCE(SUM(completion_tokens), 0) AS completion_tokens,
+                      COALESCE(SUM(total_tokens), 0) AS total_tokens,
+                      COALESCE(SUM(seconds), 0) AS seconds
+               FROM llm_calls WHERE session_id = ?'''
+    if columns:
+        query += f' GROUP BY {", ".join(columns)} ORDER BY {", ".join(columns)}'
+    return get_db().execute(query, (session_id,)).fetchall()
+
+def delete_llm_calls(session_id):
+    db = get_db()
+    db.execute('DELETE FROM llm_calls WHERE session_id = ?', (session_id,))
+    db.commit()
+
 @click.command('init-db')
 @with_appcontext
 def init_db_command():
@@ -1,4 +1,5 @@
 -- schema.sql
+DROP TABLE IF EXISTS llm_calls;
 DROP TABLE IF EXISTS events;
 DROP TABLE IF EXISTS sessions;
 
@@ -7,26 +8,47 @@ CREATE TABLE sessions (
   user_name TEXT NOT NULL,          -- User who started the session
   created_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
   problem TEXT,                     -- Problem context for this session
-  script TEXT,                      -- Generated script for the session
-  roles TEXT,                       -- Roles of participants as JSON
+  script TEXT,                      -- Legacy, moved into state
+  roles TEXT,                       -- Legacy, moved into state
   current_stage_id TEXT,            -- Current stage ID in the script
   conversation TEXT,                -- Conversation history
   log_file TEXT,                    -- Path to the log file
-  stage_state TEXT,                 -- State of the current stage as string of JSON
-  inner_thought TEXT,               -- Agent's inner thoughts as string of lists
-  turn_number INTEGER                -- Number of turns in the conversation
+  stage_state TEXT,                 -- Legacy, moved into state
+  inner_thought TEXT,               -- Legacy, moved into state
+  turn_number INTEGER,               -- Number of turns in the conversation
+  status TEXT NOT NULL DEFAULT 'ready', -- 'generating' while the script is being written, then 'ready'
+  status_detail TEXT,               -- Last script generation step, or the fallback reason
+  state TEXT                        -- Versioned JSON document: script, roles, stage_state, inner_thought
 );
 
 CREATE TABLE events (
   event_id TEXT PRIMARY KEY,        -- Unique UUID for the event
   session_id TEXT NOT NULL,         -- Foreign key to sessions table
   timestamp INTEGER NOT NULL,       -- Milliseconds since epoch (compatible with JS Date.now())
-  event_type TEXT NOT NULL,         -- e.g., 'new_message', 'agent_status', 'system_message'
+  event_type TEXT NOT NULL,         -- 'new_message', 'stage_change', 'inner_thought' or 'summary'
   source TEXT NOT NULL,             -- e.g., 'user-id', 'agent-uuid', 'System', 'PhaseManager'
   content JSON_TEXT NOT NULL,       -- Event payload as JSON text
   metadata JSON_TEXT,               -- Additional context as JSON text
+  turn_number INTEGER,              -- CON# of the conversation when the event happened
   FOREIGN KEY (session_id) REFERENCES sessions (session_id)
 );
 
 -- Optional: Add indexes for faster querying
-CREATE INDEX idx_events_session_id_timestamp ON events (session_id, timestamp);
\ No newline at end of file
+CREATE INDEX idx_events_session_id_timestamp ON events (session_id, timestamp);
+CREATE INDEX idx_events_session_type_turn ON events (session_id, event_type, turn_number);
+
+CREATE TABLE llm_calls (
+  session_id TEXT NOT NULL,         -- Foreign key to sessions table
+  timestamp INTEGER NOT NULL,       -- Milliseconds since epoch, when the call finished
+  turn_number INTEGER,              -- CON# when the call was made (0 for script generation)
+  agent_name TEXT NOT NULL,         -- e.g. 'Bob', 'Evaluator', 'ScriptWriter'
+  task_name TEXT NOT NULL,          -- 'think', 'talk', 'evaluate', 'manage_stage', 'summarize', 'write_script', 'write_roles'
+  prompt_tokens INTEGER NOT NULL DEFAULT 0,
+  completion_tokens INTEGER NOT NULL DEFAULT 0,
+  total_tokens INTEGER NOT NULL DEFAULT 0,
+  seconds REAL NOT NULL,            -- Wall time of the kickoff
+  cached INTEGER NOT NULL DEFAULT 0, -- 1 if served from the LLM response cache
+  FOREIGN KEY (session_id) REFERENCES sessions (session_id)
+);
+
+CREATE INDEX idx_llm_calls_session_turn ON llm_calls (session_id, turn_number);
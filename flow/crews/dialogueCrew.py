@@ -1,96 +1,208 @@
+import hashlib
+import json
+import os
+import threading
+from collections import OrderedDict
+
 from crewai import Agent, Crew, Process, Task
-from crewai.project import CrewBase, agent, crew, task
+from crewai.llms.base_llm import BaseLLM
 from dotenv import load_dotenv
 
+from flow.utils.fake_llm import llm_backend
+from flow.utils.helpers import load_yaml, save_yaml
+
 load_dotenv()
-    
-@CrewBase
+
+CONFIG_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "config")
+AGENTS_CONFIG_PATH = os.path.join(CONFIG_DIR, "agents.yaml")
+TASKS_CONFIG_PATH = os.path.join(CONFIG_DIR, "tasks.yaml")
+META_AGENTS_CONFIG_PATH = os.path.join(CONFIG_DIR, "meta_agents.yaml")
+
+
+def config_hash(*configs):
+    """Stable hash of one or more config dicts."""
+    payload = json.dumps(configs, sort_keys=True, ensure_ascii=False, default=str)
+    return hashlib.sha1(payload.encode("utf-8")).hexdigest()
+
+
+class CrewFactory:
+    """
+    Cache of parsed crew configs and constructed single-agent crews.
+
+    YAML configs are parsed once per file version (path + mtime). Crews are built once
+    per hash of their agent and task config and kept as templates (at most `max_crews`,
+    least recently used first out); callers get a `copy()` of the template, so
+    concurrent kickoffs never share Agent/Task state.
+    """
+
+    def __init__(self, max_crews=256):
+        self.max_crews = max_crews
+        self._configs = {}  # path -> (file version, parsed config)
+        self._crews = OrderedDict()  # config hash -> template Crew
+        self._lock = threading.Lock()
+        self.config_hits = 0
+        self.config_misses = 0
+        self.crew_hits = 0
+        self.crew_misses = 0
+
+    def load_config(self, path):
+        """Return the parsed YAML at `path`, re-reading it only when the file changed."""
+        stat = os.stat(path)
+        version = (stat.st_mtime_ns, stat.st_size)
+        with self._lock:
+            cached = self._configs.get(path)
+            if cached is not None and cached[0] == version:
+                self.config_hits += 1
+                return cached[1]
+            self.config_misses += 1
+        config = load_yaml(path)
+        with self._lock:
+            self._configs[path] = (version, config)
+        return config
+
+    def get_crew(self, agent_name, task_name, agents_config=None):
+        """
+        Return a fresh copy of the crew running `task_name` with agent `agent_name`.
+
+        Args:
+            agents_config (dict): Per-session agent configs; defaults to config/agents.yaml.
+        """
+        agents_config = agents_config or self.load_config(AGENTS_CONFIG_PATH)
+        agent_config = agents_config[agent_name]
+        task_config = self.load_config(TASKS_CONFIG_PATH)[task_name]
+        key = config_hash(agent_name, task_name, agent_config, task_config)
+        with self._lock:
+            template = self._crews.get(key)
+            if template is not None:
+                self._crews.move_to_end(key)
+                self.crew_hits += 1
+            else:
+                self.crew_misses += 1
+        if template is None:
+            llm = llm_backend(agent_name, task_name)  # LLM_BACKEND=fake for offline load tests
+            agent = Agent(config=agent_config, llm=llm) if llm else Agent(config=agent_config)
+            template = Crew(
+                name=f"{agent_name}:{task_name}",
+                agents=[agent],
+                tasks=[Task(config=task_config, agent=agent)],
+                process=Process.sequential,
+                # verbose=True,
+            )
+            with self._lock:
+                self._crews[key] = template
+                while len(self._crews) > self.max_crews:
+                    self._crews.popitem(last=False)
+        return copy_crew(template)
+
+    def stats(self):
+        return {
+            "config_hits": self.config_hits,
+            "config_misses": self.config_misses,
+            "crew_hits": self.crew_hits,
+            "crew_misses": self.crew_misses,
+            "cached_crews": len(self._crews),
+        }
+
+
+def copy_crew(crew):
+    """Copy of a crew that can be kicked off concurrently with the original."""
+    copied = crew.copy()
+    # Copies share the LLM's token counters; give each its own so the
+    # CrewOutput.token_usage of a kickoff covers that call only
+    for copied_agent in copied.agents:
+        if isinstance(copied_agent.llm, BaseLLM):
+            copied_agent.llm._token_usage = dict.fromkeys(copied_agent.llm._token_usage, 0)
+    return copied
+
+
+crew_factory = CrewFactory()
+
+
+def context_budget(task_name):
+    """Token budget for the conversation context of a task (`max_context_tokens` in tasks.yaml), or None."""
+    return crew_factory.load_config(TASKS_CONFIG_PATH).get(task_name, {}).get("max_context_tokens")
+
+
+class AgentConfigRegistry:
+    """
+    In-memory agent configs per session: the session's participants merged with the
+    meta agents (StageManager, Evaluator, ...), i.e. what create_agent_config used to
+    write to agents.yaml. Nothing is written to disk unless `export()` is called.
+    """
+
+    def __init__(self, meta_agents_path=META_AGENTS_CONFIG_PATH):
+        self.meta_agents_path = meta_agents_path
+        self._configs = {}  # session_id -> merged agents config
+        self._lock = threading.Lock()
+
+    def build(self, participants_config):
+        """Merge a participants config with the meta agents config."""
+        return {**participants_config, **crew_factory.load_config(self.meta_agents_path)}
+
+    def register(self, session_id, participants_config):
+        agents_config = self.build(participants_config)
+        with self._lock:
+            self._configs[session_id] = agents_config
+        return agents_config
+
+    def get(self, session_id):
+        with self._lock:
+            return self._configs.get(session_id)
+
+    def remove(self, session_id):
+        with self._lock:
+            return self._configs.pop(session_id, None)
+
+    def export(self, session_id, output_path=AGENTS_CONFIG_PATH):
+        """Write the session's merged agents config to `output_path` (agents.yaml by default)."""
+        agents_config = self.get(session_id)
+        if agents_config is None:
+            raise KeyError(f"No agent config registered for session {session_id}")
+        save_yaml(output_path, agents_config)
+        return output_path
+
+
+agent_configs = AgentConfigRegistry()
+
+
 class Participant:
     """Participant Crew"""
 
-    def __init__(self, agent_name, task_name):
+    def __init__(self, agent_name, task_name, agents_config=None):
         self.agent_name = agent_name
         self.task_name = task_name
-        self.agents_config = "config/agents.yaml"
-        self.tasks_config = "config/tasks.yaml"
-
-    @agent
-    def agent(self) -> Agent:
-        return Agent(
-            config=self.agents_config[self.agent_name],
-        )
-
-    @task
-    def task(self) -> Task:
-        return Task(
-            config=self.tasks_config[self.task_name],
-            agent=self.agent(),
-        )
-        
-    @crew
+        self.agents_config = agents_config
+
     def crew(self) -> Crew:
-        return Crew(
-            agents=self.agents,
-            tasks=self.tasks,
-            process=Process.sequential,
-            # verbose=True,
-        )
-
-@CrewBase
+        return crew_factory.get_crew(self.agent_name, self.task_name, self.agents_config)
+
+
 class Evaluator():
     """Evaluator Crew"""
-    agents_config = "config/agents.yaml"
-    tasks_config = "config/tasks.yaml"
-    
-    @agent
-    def evaluator(self) -> Agent:
-        return Agent(
-            config=self.agents_config["Evaluator"],
-        )
-
-    @task
-    def evaluate(self) -> Task:
-        return Task(
-            config=self.tasks_config["evaluate"],
-            agent=self.evaluator(),
-        )
-    
-    @crew
+
+    def __init__(self, agents_config=None):
+        self.agents_config = agents_config
+
     def crew(self) -> Crew:
         """Creates the Evaluator Crew"""
+        return crew_factory.get_crew("Evaluator", "evaluate", self.agents_config)
 
-        return Crew(
-            agents=self.agents,
-            tasks=self.tasks,
-            process=Process.sequential,
-            # verbose=True,
-        )
 
-
-@CrewBase
 class StageManager():
     """Stage Manager Crew"""
-    agents_config = "config/agents.yaml"
-    tasks_config = "config/tasks.yaml"
-    
-    @agent
-    def stage_manager(self) -> Agent:
-        return Agent(
-            config=self.agents_config["StageManager"],
-        )
-    
-    @task
-    def manage_stage(self) -> Task:
-        return Task(
-            config=self.tasks_config["manage_stage"],
-            agent=self.stage_manager(),
-        )
-    
-    @crew
+
+    def __init__(self, agents_config=None):
+        self.agents_config = agents_config
+
+    def crew(self) -> Crew:
+        return crew_factory.get_crew("StageManager", "manage_stage", self.agents_config)
+
+
+class Summarizer():
+    """Summarizer Crew: folds older messages into the rolling conversation summary"""
+
+    def __init__(self, agents_config=None):
+        self.agents_config = agents_config
+
     def crew(self) -> Crew:
-        return Crew(
-            agents=self.agents,
-            tasks=self.tasks,
-            process=Process.sequential,
-            # verbose=True,
-        )
\ No newline at end of file
+        return crew_factory.get_crew("Summarizer", "summarize", self.agents_config)
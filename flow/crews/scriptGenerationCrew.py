@@ -2,9 +2,9 @@ from crewai import Agent, Crew, Process, Task
 from crewai.project import CrewBase, agent, crew, task
 from dotenv import load_dotenv
 
+from flow.utils.fake_llm import llm_backend
+
 load_dotenv()
-import os
-print(f"--- DEBUG: Loaded GOOGLE_API_KEY: {os.getenv('GOOGLE_API_KEY')}") # Thay 'OPENAI_API_KEY' bằng tên biến môi trường thực tế của bạn
 
 @CrewBase
 class ScriptWriter():
@@ -32,6 +32,9 @@ class ScriptWriter():
 
     @agent
     def agent(self) -> Agent:
+        llm = llm_backend(self.agent_name, self.task_name)
+        if llm:
+            return Agent(config=self.agents_config[self.agent_name], llm=llm)
         return Agent(
             config=self.agents_config[self.agent_name],
         )
@@ -45,6 +48,7 @@ class ScriptWriter():
     @crew
     def crew(self) -> Crew:
         return Crew(
+            name=f"{self.agent_name}:{self.task_name}",
             agents=self.agents,
             tasks=self.tasks,
             process=Process.sequential,
@@ -1,24 +1,35 @@
 #!/usr/bin/env python
-from ast import literal_eval
 import asyncio
 from collections import deque
 import json
+import os
 import random
+import re
 from pydantic import BaseModel
 from crewai.flow import Flow, listen, start
-from flow.crews.dialogueCrew import Participant, Evaluator, StageManager
+from flow.crews.dialogueCrew import Participant, Evaluator, StageManager, Summarizer, context_budget
 from dotenv import load_dotenv
-from flow.utils.helpers import (parse_json_response, parse_output, 
-                     clean_response)
+from flow.utils.helpers import (extract_json, parse_output, 
+                     clean_response, format_conversation_line)
 import time
 import threading
+import uuid
 
 from flow.utils.task_utils import track_task
 from flow.utils.socket_utils import (send_message_via_socketio, 
+                          send_message_chunk_via_socketio,
                           send_agent_status_via_socketio, 
                           send_stage_update_via_socketio, 
                           send_system_status)
+from flow.utils.streaming import JsonStringFieldStream
 from flow.utils.helpers import save_to_log_file
+from flow.utils.log_sink import log_format, log_sink
+from flow.utils.turn_executor import TurnQueueFull
+from flow.utils.turn_scheduler import TurnScheduler
+from flow.utils.cancellation import CallTracker, TurnCancelled
+from flow.utils.conversation_context import ConversationContext
+from flow.utils.llm_cache import llm_cache
+from flow.utils.metrics import span, trace_tags, turn_seconds
 # Import socketio from the main app module to use its sleep function
 load_dotenv()
 
@@ -37,14 +48,20 @@ class DialogueState(BaseModel):
     script: dict = {}
     current_stage_id: str = ""
     new_message: str = ""
+    speech_stream_id: str = ""  # stream_id of the 'message_chunk' events of the current speech
     is_processing: bool = False  # Thêm trạng thái để kiểm tra xem luồng có đang xử lý không
     
 class DialogueFlow(Flow[DialogueState]):
-    def __init__(self, socketio, **kwargs):
+    def __init__(self, socketio, turn_executor=None, **kwargs):
         super().__init__()
         self.socketio = socketio
+        self.turn_executor = turn_executor  # Runs turns in the background; None runs them inline
+        # Called as event_log(session_id, event_type, source, content, metadata=None, turn_number=None)
+        # to persist messages, stage changes and inner thoughts as they happen
+        self.event_log = kwargs.get("event_log")
+        # Called as checkpoint(session_id, fields) after each turn with the session columns that changed
+        self.checkpoint = kwargs.get("checkpoint")
         self.state.conversation = kwargs["conversation"]
-        save_to_log_file(f"Conversation: {self.state.conversation}\n", "test.txt")
         self.filename = kwargs["filename"]
         self.state.problem = kwargs["problem"]
         current_stage_description, completed_task_ids, current_stage_id = track_task(kwargs["stage_state"], 
@@ -55,21 +72,44 @@ class DialogueFlow(Flow[DialogueState]):
         self.state.current_stage_id = current_stage_id
         self.state.participants = kwargs["participants"]
         self.state.script = kwargs["script"]
-        self.thinker_list = [Participant(agent_name, "think") for agent_name in self.state.participants]    
-        self.talker_list = [Participant(agent_name, "talk") for agent_name in self.state.participants]
+        # Per-session agent configs (participants + meta agents); None falls back to config/agents.yaml
+        self.agents_config = kwargs.get("agents_config")
+        self.thinker_list = [Participant(agent_name, "think", self.agents_config) for agent_name in self.state.participants]    
+        self.talker_list = [Participant(agent_name, "talk", self.agents_config) for agent_name in self.state.participants]
         self.state.turn_number = kwargs["turn_number"]
         self.state.inner_thought = kwargs["inner_thought"]
+        # Session columns as last persisted, to checkpoint only what a turn changed
+        self._checkpointed = {
+            "current_stage_id": kwargs["current_stage_id"],
+            "stage_state": kwargs["stage_state"],
+            "turn_number": kwargs["turn_number"]
+        }
         self.session_id = kwargs.get("session_id", "")  # Lưu session_id để gửi thông báo đến đúng phòng
         self.user_name = kwargs.get("user_name", "User")
         self.roles = kwargs.get("roles")
         self.processing_lock = threading.Lock()  # Lock để đảm bảo chỉ có một luồng xử lý cùng lúc
         self._is_cancelled = False # Thêm cờ hủy
+        self.call_tracker = CallTracker()  # Theo dõi các lời gọi LLM đang chạy để có thể hủy
+        # "overlapped" starts the thinkers together with the stage manager, "sequential" waits for it
+        self.pipeline_mode = kwargs.get("pipeline_mode", "sequential")
+        self._thoughts_task = None
+        self.stream_speech = kwargs.get("stream_speech", False)  # Stream the talker's message to the room
+        # Last `context_window` messages verbatim + rolling summary of older ones; 0 sends the full conversation
+        self.context = ConversationContext(self.state.conversation,
+                                           window_size=kwargs.get("context_window", 0),
+                                           chunk_size=kwargs.get("summary_chunk", 10),
+                                           summary=kwargs.get("conversation_summary", ""),
+                                           summarized_upto=kwargs.get("summarized_upto", 0))
+        self._summary_task = None
+        self.turn_error = None  # Error that ended the last turn; the flow reports it instead of raising
+        self.turn_scheduler = TurnScheduler(socketio, self._start_turn,
+                                            quiet_period=kwargs.get("quiet_period", 3.0),
+                                            max_wait=kwargs.get("max_wait", 10.0))
         
         if self.state.turn_number == 0:
-            with open(self.filename, "w") as f:  # Use append mode to accumulate turns
-                script = "\n\n".join([f"{k}: {v}" for key, value in self.state.script.items() for k, v in value.items()])
-                f.write(f'Script:\n{script}\n\n')
-                f.write(f"Conversation:\n{self.state.conversation}\n")
+            script = "\n\n".join([f"{k}: {v}" for key, value in self.state.script.items() for k, v in value.items()])
+            log_sink.write(self.filename, f'Script:\n{script}\n\nConversation:\n{self.state.conversation}\n',
+                           truncate=True)
             
         # print("--- DIALOGUE FLOW INITIALIZED WITH ---")
         # print(f"Conversation: {self.state.conversation}")
@@ -85,14 +125,150 @@ class DialogueFlow(Flow[DialogueState]):
         # print(f"Roles: {self.roles}")
         # print("--- END OF DIALOGUE FLOW INITIALIZATION ---")
         
+    def is_busy(self):
+        """True while a turn is running or scheduled; such flows must not be evicted."""
+        return self.state.is_processing or self.turn_scheduler.is_pending
+
     def cancel(self):
-        """Sets the cancellation flag."""
-        print(f"--- DIALOGUE FLOW [{self.session_id}]: Cancellation requested.")
+        """
+        Sets the cancellation flag and aborts every in-flight crew call of the running turn.
+
+        Returns:
+            dict: Call counters of this flow ('completed', 'cancelled', 'in_flight').
+        """
         self._is_cancelled = True
-        # Có thể thêm logic để cố gắng dừng các tác vụ con nếu cần (phức tạp hơn)
+        aborted = self.call_tracker.cancel()
+        print(f"--- DIALOGUE FLOW [{self.session_id}]: Cancellation requested, aborting {aborted} in-flight LLM call(s).")
+        return self.call_tracker.stats()
+
+    def _record_event(self, event_type, source, content, metadata=None, timestamp=None):
+        """Append an event to the session's event log; failures are logged, never raised."""
+        if self.event_log is None or not self.session_id:
+            return
+        try:
+            self.event_log(self.session_id, event_type, source, content,
+                           metadata=metadata, turn_number=self.state.turn_number, timestamp=timestamp)
+        except Exception as e:
+            print(f"--- DIALOGUE FLOW [{self.session_id}]: Could not record {event_type} event: {e}")
+
+    def _checkpoint(self):
+        """Queue the session columns changed since the last checkpoint; failures are logged, never raised."""
+        if self.checkpoint is None or not self.session_id:
+            return
+        current = {
+            "current_stage_id": self.state.current_stage_id,
+            "stage_state": self.state.stage_state or self._checkpointed["stage_state"],  # Empty until the first turn
+            "turn_number": self.state.turn_number
+        }
+        changed = {key: value for key, value in current.items() if self._checkpointed.get(key) != value}
+        if not changed:
+            return
+        try:
+            self.checkpoint(self.session_id, json.loads(json.dumps(changed)))
+            self._checkpointed.update(current)
+        except Exception as e:
+            print(f"--- DIALOGUE FLOW [{self.session_id}]: Could not checkpoint: {e}")
+
+    async def _kickoff(self, crew, inputs):
+        """
+        Run a crew asynchronously through the call tracker so cancel() can abort it.
+        Responses go through the LLM cache (LLM_CACHE_MODE).
+        """
+        return await self.call_tracker.run(llm_cache.kickoff_async(crew, inputs))
+
+    def _conversation_for(self, task_name):
+        """Conversation context for a task, within its `max_context_tokens` budget."""
+        return self.context.render(context_budget(task_name))
+
+    async def _update_summary(self):
+        """Fold the messages that slid out of the context window into the rolling summary."""
+        chunk, summarized_upto = self.context.pending_chunk()
+        if not chunk:
+            return
+        try:
+            result = await self._kickoff(Summarizer(self.agents_config).crew(), {
+                "problem": self.state.problem,
+                "previous_summary": self.context.summary,
+                "messages": "".join(chunk)
+            })
+        except TurnCancelled:
+            return
+        except Exception as e:
+            print(f"--- DIALOGUE FLOW [{self.session_id}]: Could not update conversation summary: {e}")
+            return
+        summary = clean_response(result.raw)
+        self.context.apply_summary(summary, summarized_upto)
+        self._record_event("summary", "Summarizer", {"summary": summary, "summarized_upto": summarized_upto})
+        print(f"--- DIALOGUE FLOW [{self.session_id}]: Conversation summary now covers {summarized_upto} messages.")
+
+    async def _finish_summary(self):
+        """Wait for this turn's summary update, or drop it if the flow was cancelled."""
+        summary_task, self._summary_task = self._summary_task, None
+        if summary_task is None:
+            return
+        if self._is_cancelled:
+            summary_task.cancel()
+            return
+        await summary_task
+
+    def _drop_summary(self):
+        """
+        Cancel a summary update the turn left behind (it failed or was cancelled before the
+        speech). Its messages stay pending and are summarized on a later turn.
+        """
+        summary_task, self._summary_task = self._summary_task, None
+        if summary_task is None:
+            return
+        if not summary_task.done():
+            summary_task.cancel()
+        elif not summary_task.cancelled():
+            summary_task.exception()  # Mark it retrieved; _update_summary handles its own errors
+
+    def _discard_thoughts_task(self):
+        """Cancel thoughts started ahead of the stage manager (overlapped mode)."""
+        if self._thoughts_task is not None:
+            self._thoughts_task.cancel()
+            self._thoughts_task.add_done_callback(lambda task: task.cancelled() or task.exception())
+            self._thoughts_task = None
+
+    async def _think(self, current_stage_description):
+        """Run every thinker concurrently and return this turn's list of inner thoughts."""
+        # Cập nhật trạng thái các agent đang suy nghĩ
+        if self.session_id:
+            for agent in self.thinker_list:
+                send_agent_status_via_socketio(agent.agent_name, "thinking", self.session_id)
+        
+        # Tạo danh sách các coroutine
+        tasks = [
+            self._kickoff(agent.crew(), {
+                "problem": self.state.problem,
+                "current_stage_description": current_stage_description,
+                "conversation": self._conversation_for("think"),
+                "participants": self.state.participants,
+                "previous_thoughts": [
+                    d["inner_thought"]
+                    for turn in self.state.inner_thought
+                    for d in turn
+                    if d["agent"] == agent.agent_name
+                ]
+            })
+            for agent in self.thinker_list
+        ]
+
+        # Chờ tất cả coroutine hoàn thành
+        results = await asyncio.gather(*tasks)
+
+        # Kết quả dưới dạng list các dict (one per agent)
+        return [
+            {
+                "agent": agent.agent_name,
+                "inner_thought": clean_response(result.raw)
+            }
+            for agent, result in zip(self.thinker_list, results)
+        ]
 
     @start()    
-    def manage_stage(self):
+    async def manage_stage(self):
         if self._is_cancelled: # Kiểm tra cờ hủy
             print(f"--- DIALOGUE FLOW [{self.session_id}]: manage_stage cancelled.")
             return # Dừng xử lý
@@ -100,15 +276,30 @@ class DialogueFlow(Flow[DialogueState]):
         print("Managing stage")
         if self.session_id:
             send_system_status("Đang cập nhật trạng thái nhiệm vụ...", self.session_id)
-            
-        stage_manager = StageManager()
-        stage_manager_result = stage_manager.crew().kickoff(inputs={
-            "conversation": self.state.conversation,
-            "problem": self.state.problem,
-            "current_stage_description": self.state.current_stage_description
-        })
+
+        # The summary update runs alongside the turn; it is awaited after the speech
+        self._summary_task = None
+        if self.context.pending_chunk()[0]:
+            self._summary_task = asyncio.ensure_future(self._update_summary())
+
+        # Overlapped mode: thinkers start now with the current stage description,
+        # so the stage manager's round-trip is off the critical path
+        self._thoughts_task = None
+        if self.pipeline_mode == "overlapped":
+            self._thoughts_task = asyncio.ensure_future(self._think(self.state.current_stage_description))
+
+        stage_manager = StageManager(self.agents_config)
+        try:
+            stage_manager_result = await self._kickoff(stage_manager.crew(), {
+                "conversation": self._conversation_for("manage_stage"),
+                "problem": self.state.problem,
+                "current_stage_description": self.state.current_stage_description
+            })
+        except BaseException:
+            self._discard_thoughts_task()
+            raise
         
-        stage_state = parse_json_response(clean_response(stage_manager_result.raw))
+        stage_state = extract_json(stage_manager_result.raw, "manage_stage")
         if stage_state is not None:
             self.state.stage_state = stage_state
         else:
@@ -123,6 +314,15 @@ class DialogueFlow(Flow[DialogueState]):
         if int(current_stage_id) != int(self.state.current_stage_id):
             self.state.current_stage_id = current_stage_id
             save_to_log_file(f"Stage changed to {current_stage_id}\n", self.filename)
+            self._record_event("stage_change", "StageManager", {
+                "current_stage_id": current_stage_id,
+                "completed_task_ids": completed_task_ids,
+                "stage_state": self.state.stage_state
+            })
+            # The early thoughts were based on the previous stage: re-issue them
+            if self._thoughts_task is not None:
+                print(f"--- DIALOGUE FLOW [{self.session_id}]: Stage advanced, re-issuing inner thoughts.")
+                self._discard_thoughts_task()
         
         if self.session_id:
             send_stage_update_via_socketio({
@@ -134,42 +334,19 @@ class DialogueFlow(Flow[DialogueState]):
     async def generate_inner_thought(self):
         if self._is_cancelled: # Kiểm tra cờ hủy
             print(f"--- DIALOGUE FLOW [{self.session_id}]: generate_inner_thought cancelled.")
+            self._discard_thoughts_task()
             return # Dừng xử lý
-        
-        # Cập nhật trạng thái các agent đang suy nghĩ
-        if self.session_id:
-            for agent in self.thinker_list:
-                send_agent_status_via_socketio(agent.agent_name, "thinking", self.session_id)
-        
-        # Tạo danh sách các coroutine
-        tasks = [
-            agent.crew().kickoff_async(inputs={
-                "problem": self.state.problem,
-                "current_stage_description": self.state.current_stage_description,
-                "conversation": self.state.conversation,
-                "participants": self.state.participants,
-                "previous_thoughts": [
-                    d["inner_thought"]
-                    for turn in self.state.inner_thought
-                    for d in turn
-                    if d["agent"] == agent.agent_name
-                ]
-            })
-            for agent in self.thinker_list
-        ]
 
-        # Chờ tất cả coroutine hoàn thành
-        results = await asyncio.gather(*tasks)
+        if self._thoughts_task is not None:
+            # Overlapped mode: thoughts were started together with the stage manager
+            thoughts_task, self._thoughts_task = self._thoughts_task, None
+            inner_thought_list = await thoughts_task
+        else:
+            inner_thought_list = await self._think(self.state.current_stage_description)
 
-        # Lưu kết quả vào self.state.inner_thought dưới dạng list các dict (one per agent)
-        inner_thought_list = [
-            {
-                "agent": agent.agent_name,
-                "inner_thought": clean_response(result.raw)
-            }
-            for agent, result in zip(self.thinker_list, results)
-        ]
+        # Lưu kết quả vào self.state.inner_thought
         self.state.inner_thought.append(inner_thought_list)  # Append the list for this turn
+        self._record_event("inner_thought", "System", {"thoughts": inner_thought_list})
 
 
     @listen(generate_inner_thought)
@@ -178,26 +355,28 @@ class DialogueFlow(Flow[DialogueState]):
             print(f"--- DIALOGUE FLOW [{self.session_id}]: evaluate_inner_thought cancelled.")
             return # Dừng xử lý
 
-        evaluator = Evaluator()
+        evaluator = Evaluator(self.agents_config)
         # Take the latest list of inner thoughts (for this turn)
         latest_inner_thought_list = self.state.inner_thought[-1]
-        evaluation = evaluator.crew().kickoff(inputs={
+        evaluation = await self._kickoff(evaluator.crew(), {
             "problem": self.state.problem,
             "current_stage_description": self.state.current_stage_description,
-            "conversation": self.state.conversation,
+            "conversation": self._conversation_for("evaluate"),
             "thoughts": json.dumps(latest_inner_thought_list), # evaluate all agents' thoughts in this turn
             "roles": self.roles
         })
-        self.state.evaluation = parse_json_response(clean_response(evaluation.raw)) # [{}]
+        # An unparseable evaluation counts as everyone listening, not as a failed turn
+        self.state.evaluation = extract_json(evaluation.raw, "evaluate") or [] # [{}]
         
         # Done thinking, set all agents to idle
         for participant in self.state.participants:
             send_agent_status_via_socketio(participant, "idle", self.session_id)
         
     @listen(evaluate_inner_thought)
-    def generate_speech(self):
+    async def generate_speech(self):
         if self._is_cancelled: # Kiểm tra cờ hủy
             print(f"--- DIALOGUE FLOW [{self.session_id}]: generate_speech cancelled.")
+            await self._finish_summary()
             return # Dừng xử lý
 
         try:
@@ -210,6 +389,7 @@ class DialogueFlow(Flow[DialogueState]):
                     send_system_status("Các agent đang lắng nghe. Chưa có ai muốn nói.", self.session_id)
                 # Đặt trạng thái speech và talker để đảm bảo các bước sau không xử lý nhầm
                 self.state.speech = ""
+                return
 
             # Trường hợp 2: Đã chọn được người nói thành công
             # Lệnh print đã được chuyển vào select_talker
@@ -220,14 +400,23 @@ class DialogueFlow(Flow[DialogueState]):
 
             agent = next(talker for talker in self.talker_list if talker.agent_name == self.state.talker)
 
-            speech = agent.crew().kickoff(inputs={
+            inputs = {
                 "problem": self.state.problem,
                 "current_stage_description": self.state.current_stage_description,
-                "conversation": self.state.conversation,
+                "conversation": self._conversation_for("talk"),
                 "participants": self.state.participants,
                 "thought": next((item["inner_thought"] for item in self.state.inner_thought[-1] if item["agent"] == self.state.talker), "")
-            })
-            self.state.speech = parse_output(speech.raw, "spoken_message")
+            }
+            self.state.speech_stream_id = ""
+            talker_crew = agent.crew()
+            if self.stream_speech and hasattr(talker_crew, "stream"):
+                # A cached response is sent whole, without chunks
+                speech = await self.call_tracker.run(llm_cache.kickoff_async(
+                    talker_crew, inputs, run=lambda: self._stream_speech(talker_crew, inputs)
+                ))
+            else:
+                speech = await self._kickoff(talker_crew, inputs)
+            self.state.speech = parse_output(speech.raw, "spoken_message", "talk")
 
             self.state.turn_number += 1 # Tăng số lượt khi agent nói xong
 
@@ -239,17 +428,61 @@ class DialogueFlow(Flow[DialogueState]):
             )
 
 
+        except TurnCancelled:
+            raise
         except Exception as e:
             # Xử lý các lỗi không mong muốn khác trong quá trình tạo lời nói (không phải từ select_talker)
             print(f"--- DIALOGUE FLOW [{self.session_id}]: Unexpected error during speech generation (outside of talker selection): {e}")
             if self.session_id:
                 send_system_status(f"Đã xảy ra lỗi không mong muốn khi tạo lời nói: {e}", self.session_id)
+            self.turn_error = str(e)
             self.state.speech = ""
             self.state.talker = None
             return # Thoát khỏi hàm
+        finally:
+            await self._finish_summary()
+
+    async def _stream_speech(self, talker_crew, inputs):
+        """
+        Run the talker crew in streaming mode, forwarding the spoken message to the room
+        as 'message_chunk' events while it is generated. Returns the final crew output.
+        """
+        talker_crew.stream = True
+        self.state.speech_stream_id = str(uuid.uuid4())
+        spoken_message = JsonStringFieldStream("spoken_message")
+        streaming = await talker_crew.kickoff_async(inputs=inputs)
+        async for chunk in streaming:
+            delta = spoken_message.feed(chunk.content)
+            if delta and self.session_id:
+                send_message_chunk_via_socketio({
+                    'stream_id': self.state.speech_stream_id,
+                    'sender_name': self.state.talker,
+                    'delta': delta
+                }, self.session_id)
+        return streaming.result
 
     @listen(generate_speech)
     def save_final_answers(self):
+        if log_format == "jsonl":
+            log_sink.write_json(os.path.splitext(self.filename)[0] + ".jsonl", {
+                "session_id": self.session_id,
+                "turn_number": self.state.turn_number,
+                "timestamp": time.time(),
+                "stage_state": self.state.stage_state,
+                "inner_thoughts": self.state.inner_thought[-1] if self.state.inner_thought else [],
+                "evaluation": self.state.evaluation,
+                "talker": self.state.talker,
+                "message": self.state.new_message if self.state.talker else None
+            })
+        else:
+            log_sink.write(self.filename, self._format_turn_dump())
+
+        # Set talker to idle
+        if self.session_id and self.state.talker: # Only set status if a talker was selected
+            send_agent_status_via_socketio(self.state.talker, "idle", self.session_id)
+        
+
+    def _format_turn_dump(self):
         stage_state = "\n".join([f"{key}: {value}" for key, value in self.state.stage_state.items()])
         # Find the inner thought for the talker in the latest turn
         latest_inner_thought_list = self.state.inner_thought[-1] if self.state.inner_thought else []
@@ -259,8 +492,11 @@ class DialogueFlow(Flow[DialogueState]):
             "\n".join([f"{key}: {value}" for key, value in item.items()])
             for item in self.state.evaluation
         ])
-        with open(self.filename, "a") as f:  # Use append mode to accumulate turns
-            f.write(f'''Turn: {self.state.turn_number}.
+        if self.state.talker:
+            message = self.state.new_message
+        else:
+            message = f"TIME={time.time()} | CON#{self.state.turn_number} | SENDER=System | TEXT=No agent chose to speak.\n"
+        return f'''Turn: {self.state.turn_number}.
 ================================================= 
 Stage state:\n {stage_state}
 
@@ -268,17 +504,9 @@ Inner thoughts:\n{inner_thoughts}
 
 Evaluation:\n{evaluation}
 =================================================
-''')
-            if self.state.talker:
-                f.write(self.state.new_message)
-            else:
-                f.write(f"TIME={time.time()} | CON#{self.state.turn_number} | SENDER=System | TEXT=No agent chose to speak.\n")
-            f.write("\n")
-        
-        # Set talker to idle
-        if self.session_id and self.state.talker: # Only set status if a talker was selected
-            send_agent_status_via_socketio(self.state.talker, "idle", self.session_id)
-        
+{message}
+'''
+
     def process_new_message(self, sender_name, text):
         """
         Xử lý tin nhắn mới từ client và kích hoạt luồng xử lý nếu không có luồng nào đang chạy.
@@ -286,38 +514,55 @@ Evaluation:\n{evaluation}
         Args:
             sender_name (str): Tên người gửi
             text (str): Nội dung tin nhắn
+
+        Returns:
+            TurnJob: The queued turn job if a turn was started right away, else None.
         """
         # Kiểm tra cờ hủy ngay khi nhận tin nhắn mới
         if self._is_cancelled:
             print(f"--- DIALOGUE FLOW [{self.session_id}]: Received message '{text}' but flow is cancelled. Ignoring.")
             if self.session_id:
                  send_system_status("Phiên trò chuyện đã kết thúc hoặc đang được đóng. Vui lòng tạo phiên mới.", self.session_id)
-            return # Bỏ qua tin nhắn nếu flow đã bị hủy
+            return None # Bỏ qua tin nhắn nếu flow đã bị hủy
 
-        new_message_str = (
-            f"TIME={time.time()} | "
-            f"CON#{self.state.turn_number} | "
-            f"SENDER={sender_name} | "
-            f"TEXT={text}\n"
-        )
-        
+        now = time.time()
         # Save the new message to the log file if the sender is not a participant (means it's the user)
         # and update turn number. This happens immediately.
         if sender_name not in self.state.participants:
             self.state.turn_number += 1
-            # Update the new message string with the new turn number
-            new_message_str = (
-                f"TIME={time.time()} | "
-                f"CON#{self.state.turn_number} | "
-                f"SENDER={sender_name} | "
-                f"TEXT={text}\n"
-            )
+            new_message_str = format_conversation_line(now, self.state.turn_number, sender_name, text)
             save_to_log_file(f"Turn: {self.state.turn_number}.\n{new_message_str}\n", 
                                   self.filename)
+        else:
+            new_message_str = format_conversation_line(now, self.state.turn_number, sender_name, text)
 
         # Append to conversation history immediately
         self.state.conversation += new_message_str
+        self.context.add_message(new_message_str)
+        self._record_event("new_message", sender_name, {
+            "text": text,
+            "sender_name": sender_name
+        }, timestamp=int(now * 1000))
+
+        # Coalesce bursts of messages into one turn: start after a quiet period,
+        # or right away when the user addresses an agent by name
+        immediate = sender_name not in self.state.participants and self._addresses_agent(text)
+        return self.turn_scheduler.notify(immediate=immediate)
+
+    def _addresses_agent(self, text):
+        """Return True if the message mentions one of the agents by name (e.g. '@Bob' or 'Bob, ...')."""
+        return any(
+            re.search(rf"(?<!\w)@?{re.escape(agent_name)}(?!\w)", text, re.IGNORECASE)
+            for agent_name in self.state.participants
+        )
 
+    def _start_turn(self):
+        """
+        Start a turn if none is running. Called by the turn scheduler.
+
+        Returns:
+            TurnJob | bool: The queued job (or True when run inline), or None if no turn was started.
+        """
         should_start_flow = False
 
         # Try to acquire the processing lock
@@ -327,59 +572,91 @@ Evaluation:\n{evaluation}
             try:
                 # If lock acquired, check if a flow is already running
                 if not self.state.is_processing:
-                    print(f"Processing message from {sender_name}: {text}")
                     self.state.is_processing = True
-                    self.state.new_message = new_message_str # Store the message that triggered this turn
                     should_start_flow = True # Flag to indicate kickoff needed after lock release
                 else:
                     # Lock acquired, but a flow is already running
-                    print("A message processing flow is already running. Adding new message to conversation and logging.")
+                    print("A message processing flow is already running.")
             finally:
                 self.processing_lock.release()
         else:
             # Lock not acquired, another thread is processing
-            print("Another thread is already processing a message. Adding new message to conversation and logging.")
+            print("Another thread is already processing a message.")
 
-        # If we are not starting a new flow, handle the busy state
         if not should_start_flow:
+            return None
+
+        # Hand the turn to the background executor so the Socket.IO handler returns immediately
+        if self.turn_executor is None:
+            self.run_turn()
+            return True
+        try:
+            return self.turn_executor.submit(self.session_id, self.run_turn)
+        except TurnQueueFull as e:
+            print(f"--- DIALOGUE FLOW [{self.session_id}]: {e}")
+            self.state.is_processing = False
             if self.session_id:
-                send_system_status("Hệ thống đang xử lý tin nhắn trước đó. Vui lòng đợi.", self.session_id)
-        else:
-            # If we are starting a new flow, kickoff outside the lock
-            try:
-                # Kiểm tra cờ hủy lần nữa trước khi kickoff
-                if self._is_cancelled:
-                     print(f"--- DIALOGUE FLOW [{self.session_id}]: Flow cancelled before kickoff. Aborting.")
-                     self.state.is_processing = False
-                     if self.session_id:
-                          send_system_status("Phiên trò chuyện đã kết thúc hoặc đang được đóng. Vui lòng tạo phiên mới.", self.session_id)
-                     return
-
-                # Add the non-blocking sleep here before kicking off the main flow
-                print(f"--- DIALOGUE FLOW [{self.session_id}]: Waiting for 10 seconds before starting flow...")
-                self.socketio.sleep(10) # Use socketio.sleep for non-blocking delay
-                print(f"--- DIALOGUE FLOW [{self.session_id}]: Starting flow after delay.")
+                send_system_status("Máy chủ đang bận, vui lòng gửi lại tin nhắn sau.", self.session_id)
+            return None
 
-                self.kickoff()
-                self.state.is_processing = False
+    def run_turn(self):
+        """
+        Run one full dialogue turn (stage, thoughts, evaluation, speech) and push the
+        selected agent's message to the room. Called from a turn executor worker.
 
-                # Send the agent's message after the flow completes, if a talker was selected
-                if self.session_id and not self._is_cancelled and self.state.talker:
-                    send_message_via_socketio({
-                        'source': 'agent',
-                        'content': {
-                            'text': self.state.speech,
-                            'sender_name': self.state.talker
-                        }
-                    }, self.session_id)
-            except Exception as e:
-                print(f"Error kicking off flow: {e}")
-                # Đảm bảo reset trạng thái xử lý và giải phóng lock nếu có lỗi
-                if self.processing_lock.locked():
-                     self.processing_lock.release()
+        Returns:
+            str | None: The error that ended the turn (it is also sent to the room), or None.
+        """
+        self.turn_error = None
+        try:
+            # Kiểm tra cờ hủy lần nữa trước khi kickoff
+            if self._is_cancelled:
+                 print(f"--- DIALOGUE FLOW [{self.session_id}]: Flow cancelled before kickoff. Aborting.")
+                 self.state.is_processing = False
+                 if self.session_id:
+                      send_system_status("Phiên trò chuyện đã kết thúc hoặc đang được đóng. Vui lòng tạo phiên mới.", self.session_id)
+                 return
+
+            print(f"--- DIALOGUE FLOW [{self.session_id}]: Starting flow.")
+            # Crew kickoffs, DB queries and emits of this turn are tagged with the session and turn
+            with trace_tags(session_id=self.session_id, turn_number=self.state.turn_number), \
+                 span("turn", histogram=turn_seconds):
+                self.kickoff()
+            self.state.is_processing = False
+
+            # Send the agent's message after the flow completes, if a talker was selected
+            if self.session_id and not self._is_cancelled and self.state.talker:
+                send_message_via_socketio({
+                    'source': 'agent',
+                    'content': {
+                        'text': self.state.speech,
+                        'sender_name': self.state.talker,
+                        'stream_id': self.state.speech_stream_id,
+                        'turn_number': self.state.turn_number
+                    }
+                }, self.session_id)
+        except TurnCancelled:
+            self.state.is_processing = False
+            print(f"--- DIALOGUE FLOW [{self.session_id}]: Turn cancelled, LLM calls: {self.call_tracker.stats()}")
+        except Exception as e:
+            if self._is_cancelled:
                 self.state.is_processing = False
-                if self.session_id:
-                     send_system_status(f"Đã xảy ra lỗi trong quá trình xử lý: {e}", self.session_id)
+                print(f"--- DIALOGUE FLOW [{self.session_id}]: Turn aborted after cancellation ({e}), LLM calls: {self.call_tracker.stats()}")
+                return
+            print(f"Error kicking off flow: {e}")
+            self.turn_error = str(e)
+            # Đảm bảo reset trạng thái xử lý và giải phóng lock nếu có lỗi
+            if self.processing_lock.locked():
+                 self.processing_lock.release()
+            self.state.is_processing = False
+            if self.session_id:
+                 send_system_status(f"Đã xảy ra lỗi trong quá trình xử lý: {e}", self.session_id)
+        finally:
+            self._drop_summary()
+            self._checkpoint()
+            # Messages that arrived during this turn are folded into one follow-up turn
+            self.turn_scheduler.turn_finished()
+        return self.turn_error
 
     def export_session_data(self):
         """
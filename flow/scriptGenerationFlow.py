@@ -2,11 +2,33 @@ import os
 from pydantic import BaseModel
 from crewai.flow import Flow, start
 from flow.crews.scriptGenerationCrew import ScriptWriter
+from flow.crews.dialogueCrew import AGENTS_CONFIG_PATH, TASKS_CONFIG_PATH, config_hash, crew_factory
 from dotenv import load_dotenv
-from flow.utils.helpers import parse_yaml, save_yaml
+from flow.utils.helpers import parse_yaml
+from flow.utils.llm_cache import llm_cache
+from flow.utils.script_cache import ScriptCache
 
 load_dotenv()
 
+# Generated (script, roles) pairs, reused across sessions for the same problem/keywords
+script_cache = ScriptCache(
+    os.getenv("SCRIPT_CACHE_PATH", "script_cache.db"),
+    max_entries=int(os.getenv("SCRIPT_CACHE_MAX_ENTRIES", "200")),
+    max_age=float(os.getenv("SCRIPT_CACHE_MAX_AGE", str(30 * 24 * 3600)))
+)
+
+
+def script_prompt_version() -> str:
+    '''
+    Hash of the agent and task configs used for script generation; changes whenever a prompt is edited
+    '''
+    agents_config = crew_factory.load_config(AGENTS_CONFIG_PATH)
+    tasks_config = crew_factory.load_config(TASKS_CONFIG_PATH)
+    return config_hash(
+        agents_config.get("ScriptWriter"), agents_config.get("RolesWriter"),
+        tasks_config.get("write_script"), tasks_config.get("write_roles")
+    )
+
 
 class ScriptGenerationState(BaseModel):
     script: dict = {}
@@ -18,33 +40,61 @@ class ScriptGenerationFlow(Flow[ScriptGenerationState]):
         self.problem = kwargs["problem"]
         self.solution = kwargs["solution"]
         self.keywords = kwargs["keywords"]
+        # Called as on_progress(step, detail) after each crew finishes
+        self.on_progress = kwargs.get("on_progress") or (lambda step, detail="": None)
 
     @start()
     def generate_script_and_roles(self):
         script_writer = ScriptWriter(agent_name="ScriptWriter", task_name="write_script")
         roles_writer = ScriptWriter(agent_name="RolesWriter", task_name="write_roles")
-        script = script_writer.crew().kickoff(inputs={
+        script = llm_cache.kickoff(script_writer.crew(), {
             "problem": self.problem,
             "solution": self.solution,
             "keywords": self.keywords
         })
         self.state.script = script.raw.replace("```yaml", "").replace("```", "")
+        self.on_progress("script_written")
         
-        roles = roles_writer.crew().kickoff(inputs={
+        roles = llm_cache.kickoff(roles_writer.crew(), {
             "problem": self.problem,
             "solution": self.solution,
             "keywords": self.keywords,
             "script": self.state.script
         })
         self.state.roles = roles.raw.replace("```yaml", "").replace("```", "")
+        self.on_progress("roles_written")
         
         return self.state.script, self.state.roles
     
-def generate_script_and_roles(folder_path: str, **kwargs: dict) -> tuple[dict, dict]:
+def validate_script_and_roles(script, roles) -> list[str]:
+    '''
+    Check that a generated script and roles can drive a DialogueFlow
+    Output:
+        errors: Human-readable problems, empty if both are valid
+    '''
+    errors = []
+    if not isinstance(script, dict) or not script:
+        errors.append("script is empty or not a mapping of stages")
+    else:
+        for stage_id, stage in script.items():
+            if not isinstance(stage, dict) or not isinstance(stage.get("tasks"), list):
+                errors.append(f"stage {stage_id} has no task list")
+    if not isinstance(roles, dict) or not roles:
+        errors.append("roles is empty or not a mapping of participants")
+    else:
+        for agent_name, role in roles.items():
+            if not isinstance(role, dict) or not role.get("role"):
+                errors.append(f"participant {agent_name} has no role")
+    return errors
+
+def generate_script_and_roles(regenerate: bool = False, on_progress=None, **kwargs: dict) -> tuple[dict, dict]:
     '''
-    Generate script and roles for the given problem and solution and save them to the given folder
+    Generate script and roles for the given problem and solution. Nothing is written to disk
+    except the persistent script cache, which results are served from / stored in.
     Input:
-        folder_path: The path to the folder where the script and roles will be saved
+        regenerate: Skip the cache lookup and always run the ScriptGenerationFlow
+        on_progress: Optional callback on_progress(step, detail) for "cached", "script_written",
+            "roles_written", "parsed" and "validated"
         kwargs: The keyword arguments for the ScriptGenerationFlow 
             - problem: The problem for the script generation
             - solution: The solution for the script generation
@@ -53,16 +103,29 @@ def generate_script_and_roles(folder_path: str, **kwargs: dict) -> tuple[dict, d
         script: The script for the given problem and solution
         roles: The roles for the given problem and solution
     '''
-    dynamic_script_path = f"{folder_path}/dynamic_script.yaml"
-    dynamic_participants_path = f"{folder_path}/dynamic_participants.yaml"
-    scriptFlow = ScriptGenerationFlow(**kwargs)
+    cache_key = ScriptCache.make_key(
+        kwargs["problem"], kwargs["solution"], kwargs["keywords"], script_prompt_version()
+    )
+    on_progress = on_progress or (lambda step, detail="": None)
+    cached = None if regenerate else script_cache.get(cache_key)
+    if cached is not None:
+        print(f"--- SCRIPT CACHE: Hit {cache_key[:12]}")
+        on_progress("cached")
+        return cached
+
+    scriptFlow = ScriptGenerationFlow(on_progress=on_progress, **kwargs)
     
     script, roles = scriptFlow.kickoff()
     script = parse_yaml(script)
     roles = parse_yaml(roles)
-    
-    save_yaml(dynamic_script_path, script)
-    save_yaml(dynamic_participants_path, roles)
+    on_progress("parsed")
+
+    errors = validate_script_and_roles(script, roles)
+    if errors:
+        raise ValueError("Invalid generated script/roles: " + "; ".join(errors))
+    on_progress("validated")
 
+    # Only valid pairs reach the cache
+    script_cache.put(cache_key, script, roles)
 
     return script, roles
\ No newline at end of file
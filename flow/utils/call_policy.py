@@ -0,0 +1,378 @@
+import asyncio
+import concurrent.futures
+import contextvars
+import itertools
+import os
+import threading
+import time
+from collections import deque
+
+from dotenv import load_dotenv
+from tenacity import AsyncRetrying, Retrying, retry_if_exception, stop_after_attempt, wait_random_exponential
+
+from flow.utils.metrics import metrics
+
+load_dotenv()
+
+llm_call_attempts_total = metrics.counter("classroom_llm_call_attempts_total",
+                                          "LLM call attempts by task and outcome (ok/timeout/error/rejected).",
+                                          ["task", "outcome"])
+llm_hedges_total = metrics.counter("classroom_llm_hedges_total",
+                                   "Hedged duplicate LLM requests by task and result (launched/won).",
+                                   ["task", "result"])
+
+BREAKER_STATES = {"closed": 0, "open": 1, "half_open": 2}
+
+# Built-in per-task settings, used when neither LLM_CALL_<SETTING>_<TASK> nor LLM_CALL_<SETTING> is set;
+# script writing produces long YAML documents
+TASK_DEFAULTS = {
+    "write_script": {"TIMEOUT": "180"},
+    "write_roles": {"TIMEOUT": "180"},
+}
+
+
+# Provider/transport errors worth retrying, by class name (litellm, openai, httpx, google-genai / api_core)
+TRANSIENT_ERROR_NAMES = {
+    "RateLimitError", "APIConnectionError", "APITimeoutError", "InternalServerError", "ServiceUnavailableError",
+    "ServerError", "ConnectError", "ConnectTimeout", "ReadTimeout", "ReadError", "RemoteProtocolError",
+    "ResourceExhausted", "ServiceUnavailable", "DeadlineExceeded", "TooManyRequests",
+}
+TRANSIENT_STATUS_CODES = {408, 425, 429, 500, 502, 503, 504}
+
+
+class CircuitOpenError(RuntimeError):
+    """Raised without calling the LLM while the circuit breaker is open."""
+
+
+def is_transient(error):
+    """
+    Whether a failed LLM call may succeed if repeated: timeouts, transport errors, rate limits
+    and 5xx responses. Validation errors, auth failures, other 4xx and bugs are not. The error's
+    causes are checked too, since CrewAI re-raises provider errors wrapped.
+    """
+    seen = set()
+    while error is not None and id(error) not in seen and not isinstance(error, CircuitOpenError):
+        seen.add(id(error))
+        if isinstance(error, (TimeoutError, ConnectionError)):
+            return True
+        status = getattr(error, "status_code", None)
+        if isinstance(status, int):
+            return status in TRANSIENT_STATUS_CODES
+        if any(cls.__name__ in TRANSIENT_ERROR_NAMES for cls in type(error).__mro__):
+            return True
+        error = error.__cause__ or error.__context__
+    return False
+
+
+class CircuitBreaker:
+    """
+    Fails LLM calls fast while the provider is degraded.
+
+    After `threshold` consecutive failed attempts (transient errors, see `is_transient`) the breaker opens and every call is
+    rejected for `cooldown` seconds. Then one probe call is let through (half open):
+    its success closes the breaker, its failure opens it again. A probe that is cancelled
+    frees the slot for the next call (`release_probe`), and one that has not finished
+    after `cooldown` seconds is given up on, so the breaker cannot stay stuck half open.
+    """
+
+    def __init__(self, threshold=5, cooldown=30.0):
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self.state = "closed"
+        self._failures = 0
+        self._opened_at = 0.0
+        self._probing = False
+        self._probe_started = 0.0
+        self._lock = threading.Lock()
+
+    def before_call(self):
+        """
+        Raises CircuitOpenError if the call must not go to the provider.
+
+        Returns:
+            bool: True if the call is the half-open probe (see `release_probe`).
+        """
+        if self.threshold <= 0:
+            return False
+        with self._lock:
+            now = time.monotonic()
+            if self.state == "open" and now - self._opened_at >= self.cooldown:
+                self.state = "half_open"
+                self._probing = False
+            if self._probing and now - self._probe_started >= self.cooldown:
+                self._probing = False
+            if self.state == "open" or (self.state == "half_open" and self._probing):
+                retry_in = max(0.0, self.cooldown - (now - self._opened_at))
+                raise CircuitOpenError(f"LLM circuit breaker is open (retry in {retry_in:.1f}s)")
+            if self.state == "half_open":
+                self._probing = True
+                self._probe_started = now
+                return True
+            return False
+
+    def release_probe(self):
+        """Let the next call probe again; used when the probe ended without an outcome (cancelled)."""
+        with self._lock:
+            self._probing = False
+
+    def record_success(self):
+        with self._lock:
+            self._failures = 0
+            self._probing = False
+            if self.state != "closed":
+                print("--- LLM CALLS: Circuit breaker closed.")
+            self.state = "closed"
+
+    def record_failure(self):
+        with self._lock:
+            self._failures += 1
+            self._probing = False
+            if self.threshold > 0 and self.state != "open" and (
+                    self.state == "half_open" or self._failures >= self.threshold):
+                self.state = "open"
+                self._opened_at = time.monotonic()
+                print(f"!!! WARNING: LLM circuit breaker opened after {self._failures} failed calls.")
+
+    def value(self):
+        return BREAKER_STATES[self.state]
+
+
+class CallPolicy:
+    """
+    Timeout, retries and hedging of the LLM calls of one task.
+
+    Args:
+        timeout (float): Seconds one attempt may take (0 disables the timeout).
+        max_attempts (int): Attempts per call, the first one included; only transient errors are retried.
+        backoff (float): Base of the jittered exponential wait between attempts, in seconds.
+        backoff_max (float): Max wait between attempts, in seconds.
+        hedge_after (str): Seconds after which a duplicate request is sent if the first has not
+            answered, "p95" for the task's observed p95 latency, or "" to disable hedging.
+    """
+
+    def __init__(self, timeout=60.0, max_attempts=3, backoff=1.0, backoff_max=20.0, hedge_after=""):
+        self.timeout = timeout
+        self.max_attempts = max(1, max_attempts)
+        self.backoff = backoff
+        self.backoff_max = backoff_max
+        self.hedge_after = hedge_after
+
+    @classmethod
+    def from_env(cls, task_name):
+        """Policy of a task: LLM_CALL_<SETTING>_<TASK> (e.g. LLM_CALL_TIMEOUT_THINK), then LLM_CALL_<SETTING>, then TASK_DEFAULTS."""
+        def setting(name, default):
+            default = TASK_DEFAULTS.get(task_name, {}).get(name, default)
+            return os.getenv(f"LLM_CALL_{name}_{task_name.upper()}", os.getenv(f"LLM_CALL_{name}", default))
+
+        return cls(timeout=float(setting("TIMEOUT", "60")),
+                   max_attempts=int(setting("MAX_ATTEMPTS", "3")),
+                   backoff=float(setting("BACKOFF", "1.0")),
+                   backoff_max=float(setting("BACKOFF_MAX", "20")),
+                   hedge_after=setting("HEDGE_AFTER", "").strip())
+
+
+class CallPolicies:
+    """
+    Applies the per-task CallPolicy and the shared circuit breaker to crew calls.
+
+    `call_async` / `call` take a factory `attempt(n)` returning the n-th request of a call
+    (0 for the first, hedges and retries get n > 0) so each request can run on its own
+    crew copy. The loser of a hedged pair is cancelled; a request already handed to a
+    worker thread keeps running until the provider answers and its result is dropped.
+    """
+
+    def __init__(self, breaker, hedge_window=200, hedge_min_samples=20, max_threads=16):
+        self.breaker = breaker
+        self.hedge_min_samples = hedge_min_samples
+        self._policies = {}
+        self._latencies = {}  # task -> recent successful attempt durations
+        self._hedge_window = hedge_window
+        self._lock = threading.Lock()
+        self._executor = concurrent.futures.ThreadPoolExecutor(max_workers=max_threads,
+                                                               thread_name_prefix="llm-call")
+
+    def policy(self, task_name):
+        with self._lock:
+            if task_name not in self._policies:
+                self._policies[task_name] = CallPolicy.from_env(task_name)
+            return self._policies[task_name]
+
+    def hedge_delay(self, task_name, policy):
+        """Seconds to wait before a hedged request, or None if the call is not hedged."""
+        if not policy.hedge_after:
+            return None
+        if policy.hedge_after != "p95":
+            return float(policy.hedge_after)
+        with self._lock:
+            samples = sorted(self._latencies.get(task_name, ()))
+        if len(samples) < self.hedge_min_samples:
+            return None
+        return samples[int(0.95 * (len(samples) - 1))]
+
+    def _record(self, task_name, seconds):
+        with self._lock:
+            self._latencies.setdefault(task_name, deque(maxlen=self._hedge_window)).append(seconds)
+
+    def _retrying(self, retrying_class, policy, task_name, retry):
+        return retrying_class(
+            stop=stop_after_attempt(policy.max_attempts if retry else 1),
+            wait=wait_random_exponential(multiplier=policy.backoff, max=policy.backoff_max),
+            retry=retry_if_exception(is_transient),
+            before_sleep=lambda state: print(
+                f"--- LLM CALLS: {task_name} attempt {state.attempt_number} failed "
+                f"({state.outcome.exception()!r}), retrying..."),
+            reraise=True,
+        )
+
+    def _outcome(self, task_name, error, probe=False):
+        if error is None:
+            self.breaker.record_success()
+            llm_call_attempts_total.inc(task=task_name, outcome="ok")
+            return
+        if isinstance(error, CircuitOpenError):
+            llm_call_attempts_total.inc(task=task_name, outcome="rejected")
+            return
+        if is_transient(error):
+            self.breaker.record_failure()
+        elif probe:
+            # Says nothing about the provider's health (e.g. a bad request): let another call probe
+            self.breaker.release_probe()
+        llm_call_attempts_total.inc(task=task_name, outcome="timeout" if isinstance(error, TimeoutError) else "error")
+
+    # --- Async ---
+    async def call_async(self, task_name, attempt, hedge=True, retry=True):
+        """
+        Await one crew call under the task's policy.
+
+        Args:
+            attempt (callable): attempt(n) returns a coroutine running the n-th request.
+            hedge (bool): Allow a hedged duplicate request.
+            retry (bool): Allow retries (off for calls with side effects, e.g. streamed chunks).
+        Raises:
+            CircuitOpenError: While the circuit breaker is open.
+            TimeoutError: If the last attempt timed out.
+        """
+        policy = self.policy(task_name)
+        requests = itertools.count()
+        async for attempt_state in self._retrying(AsyncRetrying, policy, task_name, retry):
+            with attempt_state:
+                probe = False
+                try:
+                    probe = self.breaker.before_call()
+                    result = await self._attempt_async(task_name, policy, attempt, requests, hedge)
+                except Exception as e:
+                    self._outcome(task_name, e, probe)
+                    raise
+                except BaseException:
+                    # Cancelled (e.g. the turn was aborted): no outcome, but the probe slot is freed
+                    if probe:
+                        self.breaker.release_probe()
+                    raise
+                self._outcome(task_name, None)
+                return result
+
+    async def _attempt_async(self, task_name, policy, attempt, requests, hedge):
+        loop = asyncio.get_running_loop()
+        started = loop.time()
+        pending = {asyncio.ensure_future(attempt(next(requests))): started}
+        hedge_delay = self.hedge_delay(task_name, policy) if hedge else None
+        try:
+            first_error = None
+            while pending:
+                waits = [policy.timeout - (loop.time() - started)] if policy.timeout else []
+                if hedge_delay is not None and len(pending) == 1 and first_error is None:
+                    waits.append(hedge_delay - (loop.time() - started))
+                timeout = max(0.0, min(waits)) if waits else None
+                done, _ = await asyncio.wait(pending, timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+                if not done:
+                    if policy.timeout and loop.time() - started >= policy.timeout:
+                        raise TimeoutError(f"{task_name} call timed out after {policy.timeout:g}s")
+                    # Hedge: the first request is slower than expected, race a duplicate against it
+                    hedge_delay = None
+                    llm_hedges_total.inc(task=task_name, result="launched")
+                    pending[asyncio.ensure_future(attempt(next(requests)))] = loop.time()
+                    continue
+                for task in done:
+                    request_started = pending.pop(task)
+                    if task.exception() is None:
+                        if request_started != started:
+                            llm_hedges_total.inc(task=task_name, result="won")
+                        self._record(task_name, loop.time() - request_started)
+                        return task.result()
+                    first_error = first_error or task.exception()
+                hedge_delay = None
+            raise first_error
+        finally:
+            for task in pending:
+                task.cancel()
+                task.add_done_callback(lambda t: t.cancelled() or t.exception())
+
+    # --- Sync ---
+    def call(self, task_name, attempt, hedge=True, retry=True):
+        """Blocking counterpart of `call_async`; attempt(n) runs the n-th request and returns its result."""
+        policy = self.policy(task_name)
+        requests = itertools.count()
+        for attempt_state in self._retrying(Retrying, policy, task_name, retry):
+            with attempt_state:
+                probe = False
+                try:
+                    probe = self.breaker.before_call()
+                    result = self._attempt(task_name, policy, attempt, requests, hedge)
+                except Exception as e:
+                    self._outcome(task_name, e, probe)
+                    raise
+                except BaseException:
+                    # Cancelled (e.g. the turn was aborted): no outcome, but the probe slot is freed
+                    if probe:
+                        self.breaker.release_probe()
+                    raise
+                self._outcome(task_name, None)
+                return result
+
+    def _submit(self, attempt, n):
+        # The request thread keeps the caller's trace tags
+        return self._executor.submit(contextvars.copy_context().run, attempt, n)
+
+    def _attempt(self, task_name, policy, attempt, requests, hedge):
+        started = time.monotonic()
+        pending = {self._submit(attempt, next(requests)): started}
+        hedge_delay = self.hedge_delay(task_name, policy) if hedge else None
+        try:
+            first_error = None
+            while pending:
+                waits = [policy.timeout - (time.monotonic() - started)] if policy.timeout else []
+                if hedge_delay is not None and len(pending) == 1 and first_error is None:
+                    waits.append(hedge_delay - (time.monotonic() - started))
+                timeout = max(0.0, min(waits)) if waits else None
+                done, _ = concurrent.futures.wait(pending, timeout=timeout,
+                                                  return_when=concurrent.futures.FIRST_COMPLETED)
+                if not done:
+                    if policy.timeout and time.monotonic() - started >= policy.timeout:
+                        raise TimeoutError(f"{task_name} call timed out after {policy.timeout:g}s")
+                    hedge_delay = None
+                    llm_hedges_total.inc(task=task_name, result="launched")
+                    pending[self._submit(attempt, next(requests))] = time.monotonic()
+                    continue
+                for future in done:
+                    request_started = pending.pop(future)
+                    if future.exception() is None:
+                        if request_started != started:
+                            llm_hedges_total.inc(task=task_name, result="won")
+                        self._record(task_name, time.monotonic() - request_started)
+                        return future.result()
+                    first_error = first_error or future.exception()
+                hedge_delay = None
+            raise first_error
+        finally:
+            for future in pending:
+                future.cancel()
+
+
+call_policies = CallPolicies(
+    CircuitBreaker(threshold=int(os.getenv("LLM_BREAKER_THRESHOLD", "5")),
+                   cooldown=float(os.getenv("LLM_BREAKER_COOLDOWN", "30"))),
+    hedge_min_samples=int(os.getenv("LLM_HEDGE_MIN_SAMPLES", "20"))
+)
+
+metrics.gauge("classroom_llm_circuit_state", "LLM circuit breaker state (0 closed, 1 open, 2 half open).",
+              fn=call_policies.breaker.value)
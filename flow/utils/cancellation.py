@@ -0,0 +1,82 @@
+import asyncio
+import threading
+
+
+class TurnCancelled(Exception):
+    """Raised inside a flow step when its LLM call was aborted by `CallTracker.cancel()`."""
+
+
+class CallTracker:
+    """
+    Tracks the in-flight crew calls of a flow so they can be cancelled cooperatively.
+
+    Every crew kickoff goes through `run()`, which wraps the coroutine in an asyncio
+    task bound to the flow's event loop. `cancel()` may be called from any thread or
+    greenlet: it marks the tracker as cancelled and cancels every pending task on its
+    own loop, so the awaiting step stops immediately and no further calls are issued.
+
+    Note: a call that has already been handed to a worker thread (e.g. by
+    `Crew.kickoff_async`) cannot be interrupted mid-request; its result is discarded.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._pending = {}  # asyncio.Task -> event loop
+        self.cancelled = False
+        self.completed_calls = 0
+        self.cancelled_calls = 0
+
+    async def run(self, coro):
+        """
+        Await `coro` as a tracked, cancellable call.
+
+        Raises:
+            TurnCancelled: If the tracker was cancelled before or while the call ran.
+        """
+        if self.cancelled:
+            coro.close()
+            with self._lock:
+                self.cancelled_calls += 1
+            raise TurnCancelled("Call skipped: flow was cancelled")
+
+        task = asyncio.ensure_future(coro)
+        with self._lock:
+            self._pending[task] = asyncio.get_running_loop()
+        try:
+            result = await task
+        except asyncio.CancelledError:
+            if not self.cancelled:
+                raise
+            with self._lock:
+                self.cancelled_calls += 1
+            raise TurnCancelled("Call aborted: flow was cancelled")
+        finally:
+            with self._lock:
+                self._pending.pop(task, None)
+
+        with self._lock:
+            self.completed_calls += 1
+        return result
+
+    def cancel(self):
+        """
+        Cancel every pending call and refuse new ones.
+
+        Returns:
+            int: Number of in-flight calls that were asked to abort.
+        """
+        with self._lock:
+            self.cancelled = True
+            pending = list(self._pending.items())
+        for task, loop in pending:
+            if not loop.is_closed():
+                loop.call_soon_threadsafe(task.cancel)
+        return len(pending)
+
+    def stats(self):
+        with self._lock:
+            return {
+                "completed": self.completed_calls,
+                "cancelled": self.cancelled_calls,
+                "in_flight": len(self._pending),
+            }
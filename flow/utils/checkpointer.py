@@ -0,0 +1,166 @@
+import os
+import threading
+import time
+
+from dotenv import load_dotenv
+
+from flow.utils.metrics import metrics
+
+load_dotenv()
+
+checkpoint_lag_seconds = metrics.histogram("classroom_checkpoint_lag_seconds",
+                                           "Time from a session delta being queued to its commit.")
+
+
+class Checkpointer:
+    """
+    Background writer of session deltas: event log rows, changed session columns and
+    LLM usage rows.
+
+    Dialogue flows queue their events and, after each turn, the session columns that
+    changed; the usage accountant queues one row per LLM call. A writer thread commits
+    everything queued in one transaction per batch.
+    Deltas of one session that pile up while a batch is written (or within `interval`)
+    are coalesced: events are kept in order, column values are merged, latest wins.
+
+    Args:
+        write (callable): Called as write(events, fields, llm_calls) from the writer thread, where
+            `events` is a list of event kwargs, `fields` maps session_id -> {column: value} and
+            `llm_calls` is a list of usage records. Must persist the batch atomically.
+        interval (float): Minimum seconds between two batches.
+        max_attempts (int): Attempts per batch before it is dropped.
+    """
+
+    def __init__(self, write=None, interval=0.2, max_attempts=3):
+        self.write = write
+        self.interval = interval
+        self.max_attempts = max_attempts
+        self.batches = 0
+        self.failures = 0
+        self._events = []   # [(queued_at, kwargs)]
+        self._fields = {}   # session_id -> [queued_at, {column: value}]
+        self._llm_calls = []  # [(queued_at, usage record)]
+        self._writing = False
+        self._cond = threading.Condition()
+        self._thread = None
+        self._closed = False
+
+    def record_event(self, session_id, event_type, source, content, metadata=None, turn_number=None,
+                     timestamp=None):
+        """Queue one event log row (same signature as the DialogueFlow `event_log` sink)."""
+        self._submit(lambda: self._events.append((time.monotonic(), {
+            "session_id": session_id, "event_type": event_type, "source": source, "content": content,
+            "metadata": metadata, "turn_number": turn_number,
+            "timestamp": timestamp if timestamp is not None else int(time.time() * 1000)
+        })))
+
+    def record_llm_call(self, record):
+        """Queue the usage record of one LLM call (the `usage_accountant` sink)."""
+        self._submit(lambda: self._llm_calls.append((time.monotonic(), record)))
+
+    def checkpoint(self, session_id, fields):
+        """Queue changed session columns; merged into any delta of the session not yet written."""
+        def merge():
+            pending = self._fields.setdefault(session_id, [time.monotonic(), {}])
+            pending[1].update(fields)
+        self._submit(merge)
+
+    def discard(self, session_id):
+        """Drop the queued deltas of a session (used when it is deleted)."""
+        with self._cond:
+            self._events = [item for item in self._events if item[1]["session_id"] != session_id]
+            self._fields.pop(session_id, None)
+            self._llm_calls = [item for item in self._llm_calls if item[1]["session_id"] != session_id]
+
+    def flush(self, timeout=5.0):
+        """Block until everything queued so far is written; returns False on timeout."""
+        deadline = time.monotonic() + timeout
+        with self._cond:
+            self._cond.notify_all()
+            while self._has_pending() or self._writing:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0 or self._thread is None:
+                    return False
+                self._cond.wait(remaining)
+        return True
+
+    def pending_age(self):
+        """Seconds the oldest queued delta has been waiting (0 when nothing is queued)."""
+        with self._cond:
+            queued = ([item[0] for item in self._events + self._llm_calls]
+                      + [pending[0] for pending in self._fields.values()])
+        return time.monotonic() - min(queued) if queued else 0.0
+
+    def stats(self):
+        with self._cond:
+            return {
+                "queued_events": len(self._events),
+                "queued_sessions": len(self._fields),
+                "queued_llm_calls": len(self._llm_calls),
+                "batches": self.batches,
+                "failures": self.failures,
+                "pending_age_seconds": round(self.pending_age(), 3)
+            }
+
+    def close(self, timeout=5.0):
+        """Write what is queued and stop the writer thread (used on shutdown)."""
+        self.flush(timeout)
+        with self._cond:
+            self._closed = True
+            self._cond.notify_all()
+        if self._thread is not None:
+            self._thread.join(timeout)
+
+    def _has_pending(self):
+        return bool(self._events or self._fields or self._llm_calls)
+
+    def _submit(self, enqueue):
+        with self._cond:
+            enqueue()
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name="checkpointer", daemon=True)
+                self._thread.start()
+            self._cond.notify_all()
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while not (self._has_pending() or self._closed):
+                    self._cond.wait()
+                if self._closed and not self._has_pending():
+                    return
+                events, self._events = self._events, []
+                fields, self._fields = self._fields, {}
+                llm_calls, self._llm_calls = self._llm_calls, []
+                self._writing = True
+            self._write_batch(events, fields, llm_calls)
+            with self._cond:
+                self._writing = False
+                self._cond.notify_all()
+            time.sleep(self.interval)  # Deltas queued meanwhile are coalesced into the next batch
+
+    def _write_batch(self, events, fields, llm_calls):
+        for attempt in range(1, self.max_attempts + 1):
+            try:
+                self.write([kwargs for _, kwargs in events],
+                           {session_id: values for session_id, (_, values) in fields.items()},
+                           [record for _, record in llm_calls])
+                break
+            except Exception as e:
+                print(f"!!! ERROR writing checkpoint (attempt {attempt}/{self.max_attempts}): {e}")
+                time.sleep(self.interval)
+        else:
+            self.failures += 1
+            print(f"!!! ERROR: Dropped a checkpoint of {len(events)} event(s) and {len(llm_calls)} LLM call(s) "
+                  f"for {len(fields)} session(s).")
+            return
+        self.batches += 1
+        now = time.monotonic()
+        for queued_at in [queued_at for queued_at, _ in events + llm_calls] + [queued_at for queued_at, _ in fields.values()]:
+            checkpoint_lag_seconds.observe(now - queued_at)
+
+
+checkpointer = Checkpointer(interval=float(os.getenv("CHECKPOINT_INTERVAL", "0.2")))
+
+metrics.gauge("classroom_checkpoint_pending_age_seconds", "Age of the oldest session delta not yet written.",
+              fn=checkpointer.pending_age)
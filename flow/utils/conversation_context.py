@@ -0,0 +1,90 @@
+from flow.utils.helpers import CONVERSATION_LINE_PATTERN
+
+CHARS_PER_TOKEN = 3  # Rough average for Vietnamese text; only used to enforce budgets
+
+
+def estimate_tokens(text):
+    return len(text) // CHARS_PER_TOKEN
+
+
+def split_messages(conversation):
+    """Split a conversation string into one string per message (continuation lines included)."""
+    messages = []
+    for line in (conversation or "").splitlines(keepends=True):
+        if CONVERSATION_LINE_PATTERN.match(line) or not messages:
+            messages.append(line)
+        else:
+            messages[-1] += line
+    return messages
+
+
+class ConversationContext:
+    """
+    What the crews see of the conversation: a rolling summary of older messages plus
+    the last `window_size` messages verbatim.
+
+    Messages leave the verbatim part in chunks of `chunk_size`: `pending_chunk()` only
+    returns something once a full chunk sits outside the window, so the summary is
+    recomputed once per `chunk_size` messages instead of on every call. Until it is,
+    those messages simply stay verbatim.
+
+    Args:
+        conversation (str): Conversation so far.
+        window_size (int): Messages always kept verbatim; 0 disables the window and
+            summary, so the full conversation is used (still subject to budgets).
+        chunk_size (int): Messages folded into the summary at a time.
+        summary (str): Summary restored from a previous run.
+        summarized_upto (int): Number of leading messages `summary` covers.
+    """
+
+    def __init__(self, conversation="", window_size=20, chunk_size=10, summary="", summarized_upto=0):
+        self.window_size = window_size
+        self.chunk_size = max(1, chunk_size)
+        self.summary = summary
+        self.summarized_upto = summarized_upto
+        self.messages = split_messages(conversation)
+
+    def add_message(self, message):
+        self.messages.append(message)
+
+    def pending_chunk(self):
+        """
+        Return the messages to fold into the summary next and the new `summarized_upto`,
+        or ([], summarized_upto) if the window has not slid past a chunk boundary.
+        """
+        if self.window_size <= 0:
+            return [], self.summarized_upto
+        outside = len(self.messages) - self.window_size - self.summarized_upto
+        if outside < self.chunk_size:
+            return [], self.summarized_upto
+        upto = self.summarized_upto + outside // self.chunk_size * self.chunk_size
+        return self.messages[self.summarized_upto:upto], upto
+
+    def apply_summary(self, summary, summarized_upto):
+        self.summary = summary
+        self.summarized_upto = summarized_upto
+
+    def render(self, max_tokens=None):
+        """
+        Render the context for a prompt. With `max_tokens`, the oldest verbatim messages
+        are dropped until it fits (the latest message is always kept).
+        """
+        summary = self.summary if self.window_size > 0 else ""
+        recent = self.messages[self.summarized_upto:] if self.window_size > 0 else list(self.messages)
+
+        if max_tokens is not None:
+            budget = max_tokens - estimate_tokens(summary)
+            kept = []
+            for message in reversed(recent):
+                budget -= estimate_tokens(message)
+                if budget < 0 and kept:
+                    break
+                kept.append(message)
+            recent = kept[::-1]
+
+        if not summary:
+            return "".join(recent)
+        return (
+            f"[Tóm tắt các lượt trước]\n{summary}\n\n"
+            f"[Các tin nhắn gần đây]\n{''.join(recent)}"
+        )
@@ -0,0 +1,319 @@
+import importlib
+import json
+import os
+import socket
+import sqlite3
+import threading
+import time
+import uuid
+
+from dotenv import load_dotenv
+from socketio import PubSubManager
+
+load_dotenv()
+
+
+class Coordinator:
+    """
+    Cross-worker coordination of live sessions.
+
+    A worker only runs a session's DialogueFlow while it holds the session's lease.
+    A worker that receives a message for a session leased by another worker asks
+    for a hand-off: the owner snapshots the flow (`export_session_data()`), stores
+    the snapshot, releases the lease, and the requester builds its flow from the
+    snapshot. Socket.IO events are fanned out to every worker's clients through
+    the message queue returned by `socketio_options()`.
+
+    This base class is the single-process backend: every lease is granted and
+    nothing is shared, which is the behaviour of a single worker. Other backends
+    subclass it and are selected with COORDINATION_BACKEND (see `make_coordinator`).
+    """
+
+    name = "memory"
+
+    def __init__(self, lease_ttl=30.0, poll_interval=0.2, message_queue=None):
+        self.lease_ttl = lease_ttl
+        self.poll_interval = poll_interval
+        self.message_queue = message_queue
+        self.worker_id = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+
+    def socketio_options(self):
+        """Extra SocketIO(...) arguments for room fan-out across workers."""
+        return {"message_queue": self.message_queue} if self.message_queue else {}
+
+    # --- Leases ---
+    def acquire(self, session_id):
+        """Take (or refresh) the lease of a session; False while another worker holds it."""
+        return True
+
+    def release(self, session_id):
+        pass
+
+    def renew(self, session_ids):
+        """Extend the leases of `session_ids`; returns the ones this worker no longer holds."""
+        return []
+
+    def request_handoff(self, session_id):
+        """Ask the current owner of a session to hand it off."""
+
+    def pending_handoffs(self):
+        """Sessions held by this worker that another worker asked for."""
+        return []
+
+    # --- Snapshots ---
+    def put_snapshot(self, session_id, session_data):
+        pass
+
+    def take_snapshot(self, session_id):
+        """Return and remove the hand-off snapshot of a session, or None."""
+        return None
+
+    def forget(self, session_id):
+        """Drop the lease, hand-off request and snapshot of a deleted session."""
+
+    def claim(self, session_id, timeout):
+        """
+        Acquire the lease of a session, asking its owner for a hand-off if needed.
+
+        Returns:
+            bool: False if the owner did not hand the session off within `timeout` seconds.
+        """
+        if self.acquire(session_id):
+            return True
+        self.request_handoff(session_id)
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline:
+            time.sleep(self.poll_interval)
+            if self.acquire(session_id):
+                return True
+        return False
+
+    # --- Heartbeat ---
+    def start(self, owned_sessions, on_handoff, on_lost):
+        """
+        Start the heartbeat renewing this worker's leases and serving hand-off requests.
+
+        Args:
+            owned_sessions (callable): Returns the session ids this worker runs.
+            on_handoff (callable): Called as on_handoff(session_id) when another worker asks for a session.
+            on_lost (callable): Called as on_lost(session_id) when a lease was taken over (e.g. it expired).
+        """
+
+    def close(self):
+        pass
+
+
+class SqliteCoordinator(Coordinator):
+    """
+    Local stand-in backend: leases, hand-off requests, snapshots and the Socket.IO
+    message queue live in one SQLite file shared by the workers of a host.
+
+    Args:
+        db_path (str): Path of the SQLite file, the same for every worker.
+        lease_ttl (float): Seconds a lease lasts without renewal (a crashed worker's sessions free up after it).
+        poll_interval (float): Seconds between hand-off checks and message queue polls.
+    """
+
+    name = "local"
+
+    def __init__(self, db_path, lease_ttl=30.0, poll_interval=0.2):
+        super().__init__(lease_ttl=lease_ttl, poll_interval=poll_interval)
+        self.db_path = db_path
+        self._lock = threading.Lock()
+        self._conn = _connect(db_path)
+        with self._lock:
+            self._conn.executescript(
+                '''CREATE TABLE IF NOT EXISTS leases (
+                    session_id TEXT PRIMARY KEY,
+                    owner TEXT NOT NULL,
+                    expires_at REAL NOT NULL
+                );
+                CREATE TABLE IF NOT EXISTS handoffs (
+                    session_id TEXT PRIMARY KEY,
+                    requester TEXT NOT NULL,
+                    requested_at REAL NOT NULL
+                );
+                CREATE TABLE IF NOT EXISTS snapshots (
+                    session_id TEXT PRIMARY KEY,
+                    data TEXT NOT NULL,
+                    created_at REAL NOT NULL
+                );'''
+            )
+        self._stop = threading.Event()
+        self._thread = None
+
+    def socketio_options(self):
+        return {"client_manager": SqliteSocketIOManager(self.db_path, poll_interval=min(self.poll_interval, 0.05))}
+
+    def acquire(self, session_id):
+        now = time.time()
+        with self._lock:
+            acquired = self._conn.execute(
+                '''INSERT INTO leases (session_id, owner, expires_at) VALUES (?, ?, ?)
+                   ON CONFLICT(session_id) DO UPDATE SET owner = excluded.owner, expires_at = excluded.expires_at
+                   WHERE leases.owner = excluded.owner OR leases.expires_at < ?''',
+                (session_id, self.worker_id, now + self.lease_ttl, now)
+            ).rowcount == 1
+            if acquired:
+                self._conn.execute('DELETE FROM handoffs WHERE session_id = ?', (session_id,))
+        return acquired
+
+    def release(self, session_id):
+        with self._lock:
+            self._conn.execute('DELETE FROM leases WHERE session_id = ? AND owner = ?', (session_id, self.worker_id))
+
+    def renew(self, session_ids):
+        session_ids = list(session_ids)
+        if not session_ids:
+            return []
+        placeholders = ",".join("?" * len(session_ids))
+        with self._lock:
+            self._conn.execute(
+                f'UPDATE leases SET expires_at = ? WHERE owner = ? AND session_id IN ({placeholders})',
+                [time.time() + self.lease_ttl, self.worker_id, *session_ids]
+            )
+            held = {row[0] for row in self._conn.execute(
+                f'SELECT session_id FROM leases WHERE owner = ? AND session_id IN ({placeholders})',
+                [self.worker_id, *session_ids]
+            )}
+        return [session_id for session_id in session_ids if session_id not in held]
+
+    def request_handoff(self, session_id):
+        with self._lock:
+            self._conn.execute('INSERT OR REPLACE INTO handoffs (session_id, requester, requested_at) VALUES (?, ?, ?)',
+                               (session_id, self.worker_id, time.time()))
+
+    def pending_handoffs(self):
+        with self._lock:
+            return [row[0] for row in self._conn.execute(
+                '''SELECT h.session_id FROM handoffs h JOIN leases l ON l.session_id = h.session_id
+                   WHERE l.owner = ? AND h.requester != ?''',
+                (self.worker_id, self.worker_id)
+            )]
+
+    def put_snapshot(self, session_id, session_data):
+        with self._lock:
+            self._conn.execute('INSERT OR REPLACE INTO snapshots (session_id, data, created_at) VALUES (?, ?, ?)',
+                               (session_id, json.dumps(session_data, ensure_ascii=False, default=str), time.time()))
+
+    def take_snapshot(self, session_id):
+        with self._lock:
+            row = self._conn.execute('SELECT data FROM snapshots WHERE session_id = ?', (session_id,)).fetchone()
+            self._conn.execute('DELETE FROM snapshots WHERE session_id = ?', (session_id,))
+        return json.loads(row[0]) if row else None
+
+    def forget(self, session_id):
+        with self._lock:
+            for table in ("leases", "handoffs", "snapshots"):
+                self._conn.execute(f'DELETE FROM {table} WHERE session_id = ?', (session_id,))
+
+    def start(self, owned_sessions, on_handoff, on_lost):
+        if self._thread is not None:
+            return
+
+        def heartbeat():
+            last_renewal = 0.0
+            while not self._stop.wait(self.poll_interval):
+                try:
+                    if time.monotonic() - last_renewal >= self.lease_ttl / 3:
+                        last_renewal = time.monotonic()
+                        for session_id in self.renew(owned_sessions()):
+                            on_lost(session_id)
+                    for session_id in self.pending_handoffs():
+                        on_handoff(session_id)
+                except Exception as e:
+                    print(f"!!! ERROR in coordination heartbeat: {e}")
+
+        self._thread = threading.Thread(target=heartbeat, name="coordination-heartbeat", daemon=True)
+        self._thread.start()
+
+    def close(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join(timeout=5)
+
+
+class SqliteSocketIOManager(PubSubManager):
+    """Socket.IO message queue on a table of the coordination SQLite file, polled by each worker."""
+
+    name = "sqlite"
+
+    def __init__(self, db_path, channel="socketio", poll_interval=0.05, retention=60.0, write_only=False,
+                 logger=None):
+        super().__init__(channel=channel, write_only=write_only, logger=logger)
+        self.db_path = db_path
+        self.poll_interval = poll_interval
+        self.retention = retention
+        self._lock = threading.Lock()
+        self._conn = _connect(db_path)
+        with self._lock:
+            self._conn.execute(
+                '''CREATE TABLE IF NOT EXISTS socketio_messages (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    channel TEXT NOT NULL,
+                    data TEXT NOT NULL,
+                    created_at REAL NOT NULL
+                )'''
+            )
+
+    def _publish(self, data):
+        with self._lock:
+            self._conn.execute('INSERT INTO socketio_messages (channel, data, created_at) VALUES (?, ?, ?)',
+                               (self.channel, json.dumps(data), time.time()))
+
+    def _listen(self):
+        with self._lock:
+            last_id = self._conn.execute('SELECT COALESCE(MAX(id), 0) FROM socketio_messages').fetchone()[0]
+        last_prune = time.monotonic()
+        while True:
+            with self._lock:
+                rows = self._conn.execute(
+                    'SELECT id, data FROM socketio_messages WHERE id > ? AND channel = ? ORDER BY id',
+                    (last_id, self.channel)
+                ).fetchall()
+                if time.monotonic() - last_prune > self.retention:
+                    last_prune = time.monotonic()
+                    self._conn.execute('DELETE FROM socketio_messages WHERE created_at < ?',
+                                       (time.time() - self.retention,))
+            for message_id, data in rows:
+                last_id = message_id
+                yield data
+            if not rows:
+                time.sleep(self.poll_interval)
+
+
+def _connect(db_path):
+    conn = sqlite3.connect(db_path, check_same_thread=False, isolation_level=None, timeout=5)
+    conn.execute('PRAGMA journal_mode=WAL')
+    conn.execute('PRAGMA synchronous=NORMAL')
+    return conn
+
+
+def make_coordinator():
+    """
+    Coordinator selected by COORDINATION_BACKEND:
+        memory  single worker, nothing shared (default)
+        local   SqliteCoordinator on COORDINATION_PATH, for several workers on one host
+        package.module:Class  any Coordinator subclass, built with the lease settings
+
+    SOCKETIO_MESSAGE_QUEUE (e.g. redis://...) sets the Socket.IO message queue of the
+    memory backend and of custom backends that keep the default `socketio_options()`.
+    """
+    backend = os.getenv("COORDINATION_BACKEND", "memory")
+    lease_ttl = float(os.getenv("COORDINATION_LEASE_TTL", "30"))
+    poll_interval = float(os.getenv("COORDINATION_POLL_INTERVAL", "0.2"))
+    if backend == "memory":
+        return Coordinator(lease_ttl=lease_ttl, poll_interval=poll_interval,
+                           message_queue=os.getenv("SOCKETIO_MESSAGE_QUEUE") or None)
+    if backend == "local":
+        return SqliteCoordinator(os.getenv("COORDINATION_PATH", "coordination.db"),
+                                 lease_ttl=lease_ttl, poll_interval=poll_interval)
+    module_name, _, class_name = backend.partition(":")
+    if not class_name:
+        raise ValueError(f"Unknown COORDINATION_BACKEND '{backend}', expected memory, local or module:Class")
+    coordinator_class = getattr(importlib.import_module(module_name), class_name)
+    return coordinator_class(lease_ttl=lease_ttl, poll_interval=poll_interval,
+                             message_queue=os.getenv("SOCKETIO_MESSAGE_QUEUE") or None)
+
+
+coordinator = make_coordinator()
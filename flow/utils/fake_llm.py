@@ -0,0 +1,166 @@
+import json
+import os
+import random
+import re
+import time
+
+from crewai.llms.base_llm import BaseLLM, llm_call_context
+from dotenv import load_dotenv
+
+from flow.utils.conversation_context import estimate_tokens
+from flow.utils.helpers import CONVERSATION_LINE_PATTERN, dummy_llm_call
+
+load_dotenv()
+
+CONFIG_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "crews", "config")
+TASK_MARKER_PATTERN = re.compile(r"\[(X|!|)\] \[([\w.]+)\]")
+THOUGHT_PATTERN = re.compile(r'\{"agent": "([^"]+)", "inner_thought": "((?:[^"\\]|\\.)*)"\}')
+STREAM_CHUNK_CHARS = 16
+
+
+class Latency:
+    """
+    Latency distribution parsed from a spec string (seconds):
+        fixed:S, uniform:A,B, normal:MEAN,STD, lognormal:MEDIAN,SIGMA
+    """
+
+    KINDS = ("fixed", "uniform", "normal", "lognormal")
+
+    def __init__(self, spec="fixed:0"):
+        kind, _, params = spec.partition(":")
+        self.kind = kind.strip()
+        self.params = [float(p) for p in params.split(",") if p.strip()]
+        if self.kind not in self.KINDS:
+            raise ValueError(f"Unknown latency distribution '{spec}', expected one of {self.KINDS}")
+        self.spec = spec
+
+    def sample(self, rng):
+        if self.kind == "fixed":
+            return self.params[0] if self.params else 0.0
+        if self.kind == "uniform":
+            return rng.uniform(self.params[0], self.params[1])
+        if self.kind == "normal":
+            return max(0.0, rng.gauss(self.params[0], self.params[1]))
+        return self.params[0] * rng.lognormvariate(0.0, self.params[1])
+
+
+class FakeLLM(BaseLLM):
+    """
+    Offline LLM for load tests: answers every task of the dialogue and script crews with
+    schema-valid output after a sampled latency, without any network access.
+
+    think:        {"stimuli", "thought", "action"}; speaks with probability `speak_probability`.
+    evaluate:     one entry per thinker found in the prompt, with random scores.
+    manage_stage: completes the next open task with probability `progress_probability`
+                  and signals a stage change once every task is done.
+    talk:         {"spoken_message"}, streamed in chunks when the crew streams.
+    summarize:    plain text.
+    write_script / write_roles: the base script / participants.
+    """
+
+    llm_type: str = "fake"
+    task_name: str = ""
+    agent_name: str = ""
+    latency: Latency = Latency()
+    speak_probability: float = 0.5
+    progress_probability: float = 0.3
+    rng: random.Random = random.Random()
+
+    def call(self, messages, tools=None, callbacks=None, available_functions=None,
+             from_task=None, from_agent=None, response_model=None):
+        prompt = messages if isinstance(messages, str) else "\n".join(
+            str(message.get("content", "")) for message in messages
+        )
+        with llm_call_context():
+            time.sleep(self.latency.sample(self.rng))
+            response = self.respond(prompt)
+            prompt_tokens, completion_tokens = estimate_tokens(prompt), estimate_tokens(response)
+            self._track_token_usage_internal({
+                "prompt_tokens": prompt_tokens,
+                "completion_tokens": completion_tokens,
+                "total_tokens": prompt_tokens + completion_tokens
+            })
+            if self._effective_stream():
+                for i in range(0, len(response), STREAM_CHUNK_CHARS):
+                    self._emit_stream_chunk_event(
+                        response[i:i + STREAM_CHUNK_CHARS], from_task=from_task, from_agent=from_agent
+                    )
+        return response
+
+    def respond(self, prompt):
+        """Build the response of `task_name` for a rendered prompt."""
+        if self.task_name == "think":
+            turns = [int(match.group(2)) for match in CONVERSATION_LINE_PATTERN.finditer(prompt)]
+            return json.dumps({
+                "stimuli": [f"CON#{max(turns)}"] if turns else [],
+                "thought": f"{self.agent_name} đang theo dõi cuộc thảo luận.",
+                "action": "speak" if self.rng.random() < self.speak_probability else "listen"
+            }, ensure_ascii=False)
+        if self.task_name == "evaluate":
+            return json.dumps([
+                {
+                    "name": name,
+                    "action": "speak" if '\\"action\\": \\"speak\\"' in thought else "listen",
+                    "score": "Đánh giá giả lập.",
+                    "internal_score": round(self.rng.uniform(1, 5), 1),
+                    "external_score": round(self.rng.uniform(1, 5), 1)
+                }
+                for name, thought in THOUGHT_PATTERN.findall(prompt)
+            ], ensure_ascii=False)
+        if self.task_name == "manage_stage":
+            tasks = TASK_MARKER_PATTERN.findall(prompt)
+            completed = [task_id for marker, task_id in tasks if marker == "X"]
+            next_task = next((task_id for marker, task_id in tasks if marker == "!"), None)
+            if next_task is not None and self.rng.random() < self.progress_probability:
+                completed.append(next_task)
+            done = bool(tasks) and len(completed) == len(tasks)
+            return json.dumps({
+                "explain": "Trạng thái giả lập.",
+                "signal": ["3", "Chuyển stage mới"] if done else ["2", "Tiếp tục"],
+                "completed_task_ids": completed
+            }, ensure_ascii=False)
+        if self.task_name == "talk":
+            return json.dumps({
+                "spoken_message": f"Mình là {self.agent_name}, mình nghĩ nhóm mình nên làm tiếp nhiệm vụ hiện tại."
+            }, ensure_ascii=False)
+        if self.task_name == "summarize":
+            return "Nhóm đã thảo luận các bước đầu của bài toán."
+        if self.task_name == "write_script":
+            return f"```yaml\n{_read_config('base_script.yaml')}\n```"
+        if self.task_name == "write_roles":
+            return f"```yaml\n{_read_config('base_participants.yaml')}\n```"
+        return dummy_llm_call("json")
+
+    def supports_function_calling(self):
+        return False
+
+    def get_context_window_size(self):
+        return 1_000_000
+
+
+def _read_config(filename):
+    with open(os.path.join(CONFIG_DIR, filename), encoding="utf-8") as f:
+        return f.read()
+
+
+def llm_backend(agent_name, task_name):
+    """
+    LLM to give a crew's agent instead of the one in its config, or None.
+
+    LLM_BACKEND=fake answers every crew with FakeLLM; latency comes from
+    FAKE_LLM_LATENCY_<TASK> (e.g. FAKE_LLM_LATENCY_THINK=lognormal:1.5,0.4),
+    falling back to FAKE_LLM_LATENCY.
+    """
+    if os.getenv("LLM_BACKEND", "default") != "fake":
+        return None
+    latency = os.getenv(f"FAKE_LLM_LATENCY_{task_name.upper()}", os.getenv("FAKE_LLM_LATENCY", "fixed:0"))
+    seed = os.getenv("FAKE_LLM_SEED")
+    return FakeLLM(
+        model="fake",
+        task_name=task_name,
+        agent_name=agent_name,
+        latency=Latency(latency),
+        speak_probability=float(os.getenv("FAKE_LLM_SPEAK_PROBABILITY", "0.5")),
+        progress_probability=float(os.getenv("FAKE_LLM_PROGRESS_PROBABILITY", "0.3")),
+        rng=random.Random(f"{seed}:{agent_name}:{task_name}") if seed else random.Random()
+    )
@@ -7,6 +7,9 @@ import uuid
 import json
 import re
 
+from flow.utils.log_sink import log_sink
+from flow.utils.metrics import json_extract_total, parse_failures_total
+
 
 def get_timestamp():
     return int(time.time() * 1000)
@@ -46,8 +49,243 @@ def parse_json_response(cleaned_response):
             return json.loads(fix_missing_commas(cleaned_response))
         except Exception as e:
             print(f"Still error parsing JSON: {e}")
+            parse_failures_total.inc(parser="json")
             return None
 
+# --- Tolerant JSON extraction ---
+# Expected shape of each task's output: a dict is an object with these required keys, a
+# one-item list is an array of that item, a type (or tuple of types) is checked with isinstance
+TASK_SCHEMAS = {
+    "think": {"stimuli": list, "thought": str, "action": str},
+    "evaluate": [{"name": str, "action": str, "internal_score": (int, float), "external_score": (int, float)}],
+    "manage_stage": {"signal": list, "completed_task_ids": list},
+    "talk": {"spoken_message": str},
+}
+
+JSON_SCALAR_PATTERN = re.compile(r'-?\d+(?:\.\d+)?(?:[eE][+-]?\d+)?|true|false|null|True|False|None')
+PYTHON_LITERALS = {"True": "true", "False": "false", "None": "null"}
+CLOSERS = {"{": "}", "[": "]"}
+CONTROL_ESCAPES = {"\n": "\\n", "\r": "\\r", "\t": "\\t"}
+STRING_RUN_PATTERNS = {'"': re.compile(r'[^"\\\x00-\x1f]+'), "'": re.compile(r"[^'\"\\\x00-\x1f]+")}
+# A quoted key right after a string: the comma between two members is missing
+KEY_AHEAD_PATTERN = re.compile(r"""[ \t]*(?:"[^"\\\n]*"|'[^'\\\n]*')[ \t]*:""")
+
+def repair_json(text):
+    '''
+    Single pass over `text`: cut out the first JSON object/array and fix the usual LLM defects
+    on the way (markdown fences and prose around it, doubled braces, raw newlines and LaTeX
+    backslashes inside strings, unescaped quotes, Python literals and single-quoted strings,
+    missing or trailing commas, truncated output).
+    Output:
+        (json_text, repaired): json_text is None when there is no object/array in `text`
+    '''
+    match = re.search(r'[{\[]', text)
+    if match is None:
+        return None, False
+    out = []
+    stack = []
+    repaired = False
+    in_string = False
+    quote = '"'  # delimiter of the current string; Python reprs use '
+    prev = None  # last token outside strings: open | colon | comma | value
+    i, n = match.start(), len(text)
+    while i < n:
+        c = text[i]
+        if in_string:
+            run = STRING_RUN_PATTERNS[quote].match(text, i)
+            if run:
+                # Plain text is copied as is
+                out.append(run.group(0))
+                i = run.end()
+                continue
+            if c == '\\':
+                nxt = text[i + 1] if i + 1 < n else ''
+                if nxt == "'" and quote == "'":
+                    out.append(nxt)
+                    i += 2
+                    continue
+                if nxt == 'u' and re.match(r'[0-9a-fA-F]{4}', text[i + 2:i + 6]):
+                    out.append(text[i:i + 6])
+                    i += 6
+                    continue
+                # \frac, \beta, \times, \right...: a JSON escape followed by a letter is LaTeX
+                if nxt in '"\\/' or (nxt in 'bfnrt' and not (nxt != 'n' and text[i + 2:i + 3].isalpha())):
+                    out.append(c + nxt)
+                    i += 2
+                    continue
+                out.append('\\\\')
+                repaired = True
+            elif c == quote:
+                # A quote closes the string only if what follows fits; otherwise it is part of the text
+                rest = text[i + 1:].lstrip(' \t')
+                if not rest or rest[0] in ',:}]\r\n' or KEY_AHEAD_PATTERN.match(text, i + 1):
+                    in_string = False
+                    prev = "value"
+                    out.append('"')
+                else:
+                    out.append('\\"')
+                    repaired = True
+            elif c == '"':
+                # Double quote inside a single-quoted string
+                out.append('\\"')
+                repaired = True
+            elif c < ' ':
+                out.append(CONTROL_ESCAPES.get(c, '\\u%04x' % ord(c)))
+                repaired = True
+            else:
+                out.append(c)
+            i += 1
+            continue
+
+        if c in '{[':
+            if c == '{' and prev == "open" and stack[-1] == '{':
+                # {{ ... }} left over from a prompt template: the outer pair is dropped
+                repaired = True
+                i += 1
+                continue
+            if prev == "value":
+                out.append(',')
+                repaired = True
+            stack.append(c)
+            out.append(c)
+            prev = "open"
+        elif c in '}]':
+            if not stack:
+                break
+            if prev == "comma":
+                out.pop()
+                repaired = True
+            elif prev == "colon":
+                out.append('null')
+                repaired = True
+            closer = CLOSERS[stack.pop()]
+            repaired = repaired or closer != c
+            out.append(closer)
+            prev = "value"
+            if not stack:
+                break
+        elif c in '"\'':
+            if prev == "value":
+                out.append(',')
+                repaired = True
+            in_string = True
+            quote = c
+            repaired = repaired or c == "'"
+            out.append('"')
+        elif c == ':':
+            out.append(c)
+            prev = "colon"
+        elif c == ',':
+            if prev in ("open", "comma"):
+                repaired = True
+            else:
+                out.append(c)
+                prev = "comma"
+        elif c in ' \t\r\n':
+            out.append(c)
+        else:
+            scalar = JSON_SCALAR_PATTERN.match(text, i)
+            if scalar is None:
+                # Stray character (prose, markdown) between JSON tokens
+                repaired = True
+                i += 1
+                continue
+            if prev == "value":
+                out.append(',')
+                repaired = True
+            token = scalar.group(0)
+            if token in PYTHON_LITERALS:
+                token = PYTHON_LITERALS[token]
+                repaired = True
+            out.append(token)
+            prev = "value"
+            i = scalar.end()
+            continue
+        i += 1
+
+    if stack:
+        # Truncated output: close what is still open
+        repaired = True
+        if in_string:
+            out.append('"')
+            prev = "value"
+        if prev == "comma":
+            out.pop()
+        elif prev == "colon":
+            out.append('null')
+        out.extend(CLOSERS[opener] for opener in reversed(stack))
+    return "".join(out), repaired
+
+def schema_error(value, schema):
+    """Reason `value` does not match `schema`, or None if it does."""
+    if isinstance(schema, dict):
+        if not isinstance(value, dict):
+            return "expected an object"
+        for key, item_schema in schema.items():
+            if key not in value:
+                return f"missing '{key}'"
+            error = schema_error(value[key], item_schema)
+            if error:
+                return f"'{key}': {error}"
+        return None
+    if isinstance(schema, list):
+        return None if isinstance(value, list) else "expected an array"
+    types = schema if isinstance(schema, tuple) else (schema,)
+    if not isinstance(value, types) or (isinstance(value, bool) and bool not in types):
+        return "expected " + " or ".join(t.__name__ for t in types)
+    return None
+
+def extract_json(text, task=None, schema=None):
+    '''
+    Parse the first JSON object/array of an LLM response, repairing it in one pass (see
+    repair_json), and validate it against the schema of `task` (TASK_SCHEMAS) or `schema`.
+    For array schemas, items that do not match are dropped.
+    Counted in classroom_json_extract_total by task and result (ok, repaired, invalid, failed).
+    Output:
+        The parsed value, or None if there is no parseable JSON or it does not match the schema
+    '''
+    label = task or "unknown"
+    schema = schema if schema is not None else TASK_SCHEMAS.get(task)
+    text = (text or "").strip()
+    value = None
+    if text.startswith(("{", "[")) and "\\" not in text:
+        # Fast path for clean output; backslashes always go through repair_json for the LaTeX check
+        try:
+            value, repaired = json.loads(text), False
+        except ValueError:
+            pass
+    if value is None:
+        json_text, repaired = repair_json(text)
+        try:
+            if json_text is None:
+                raise ValueError("no JSON object or array found")
+            value = json.loads(json_text)
+        except ValueError as e:
+            print(f"Error extracting JSON ({label}): {e}")
+            json_extract_total.inc(task=label, result="failed")
+            parse_failures_total.inc(parser="json")
+            return None
+
+    if schema is not None:
+        if isinstance(schema, list) and isinstance(value, list):
+            items = [item for item in value if schema_error(item, schema[0]) is None]
+            if value and not items:
+                error = schema_error(value[0], schema[0])
+            else:
+                error = None
+                repaired = repaired or len(items) != len(value)
+                value = items
+        else:
+            error = schema_error(value, schema)
+        if error:
+            print(f"Invalid JSON output ({label}): {error}")
+            json_extract_total.inc(task=label, result="invalid")
+            parse_failures_total.inc(parser="json")
+            return None
+
+    json_extract_total.inc(task=label, result="repaired" if repaired else "ok")
+    return value
+
 def process_content(content):
     """Chuyển đổi định dạng markdown sang HTML"""
     # Xử lý bullet points và số thứ tự
@@ -74,17 +312,16 @@ def process_content(content):
     
     return content
     
-def parse_output(content, key):
+def parse_output(content, key, task=None):
     try:
-        # Remove prefix and suffix
-        cleaned_response = clean_response(content)
-        # Parse JSON response
-        response_data = parse_json_response(cleaned_response)
+        # Extract, repair and validate the JSON response
+        response_data = extract_json(content, task, schema=None if task else {key: str})
         # Process content with LaTeX formatting
         bot_response = process_content(response_data.get(key, ""))
         return bot_response
     except Exception as e:
         print(f"Error parsing output: {e}")
+        parse_failures_total.inc(parser="output")
         return "..."
 
 
@@ -96,6 +333,7 @@ def parse_yaml(yaml_string: str) -> dict:
         return data
     except yaml.YAMLError as e:
         print(f"Error parsing YAML: {e}")
+        parse_failures_total.inc(parser="yaml")
         return {}
 
 def load_yaml(yaml_path: str) -> dict:
@@ -124,6 +362,39 @@ def create_agent_config(participants_path, meta_agents_path, output_path):
     with open(output_path, "w") as f:
         yaml.dump(combined_agents_config, f, indent=2, sort_keys=False, allow_unicode=True)
         
+CONVERSATION_LINE_PATTERN = re.compile(r"TIME=([0-9.]+) \| CON#(\d+) \| SENDER=([^|]+) \| TEXT=(.*)")
+
+def format_conversation_line(timestamp, turn_number, sender_name, text):
+    '''
+    Format one message the way it is kept in the conversation string (timestamp in seconds)
+    '''
+    return f"TIME={timestamp} | CON#{turn_number} | SENDER={sender_name} | TEXT={text}\n"
+
+def parse_conversation(conversation):
+    '''
+    Split a conversation string into messages. Lines that do not start a message are
+    continuation lines of the previous message's text.
+    Output:
+        messages: list of {"timestamp", "turn_number", "sender_name", "text"}, timestamp in seconds
+    '''
+    messages = []
+    for line in (conversation or "").split("\n"):
+        match = CONVERSATION_LINE_PATTERN.match(line)
+        if match:
+            time_val, turn, sender, text = match.groups()
+            messages.append({
+                "timestamp": float(time_val),
+                "turn_number": int(turn),
+                "sender_name": sender.strip(),
+                "text": text.strip()
+            })
+        elif messages:
+            messages[-1]["text"] += "\n" + line
+    # The conversation string ends with a newline: drop the empty continuation it leaves
+    if messages and messages[-1]["text"].endswith("\n"):
+        messages[-1]["text"] = messages[-1]["text"].rstrip("\n")
+    return messages
+
 def dummy_llm_call(data_type):
     if data_type == "yaml":
         return "```yaml\nHello: world!\n```"
@@ -137,8 +408,5 @@ def dummy_llm_call(data_type):
         return "Hello, world!"
 
 def save_to_log_file(message, filename):
-    dir_name = os.path.dirname(filename)
-    if dir_name and not os.path.exists(dir_name):
-        os.makedirs(dir_name, exist_ok=True)
-    with open(filename, "a") as f:
-        f.write(message)
+    """Append `message` to `filename` through the background log sink (does not block on disk)."""
+    log_sink.write(filename, message)
@@ -0,0 +1,249 @@
+import hashlib
+import json
+import os
+import re
+import sqlite3
+import threading
+import time
+
+from dotenv import load_dotenv
+
+from flow.crews.dialogueCrew import copy_crew
+from flow.utils.call_policy import call_policies
+from flow.utils.metrics import crew_labels, llm_calls_in_flight, llm_calls_total, span
+from flow.utils.usage import usage_accountant
+
+load_dotenv()
+
+MODES = ("off", "record", "replay")
+
+
+class LLMCacheMiss(RuntimeError):
+    """Raised in replay mode when a crew call has no recorded response."""
+
+
+class CachedCrewOutput:
+    """Stand-in for a CrewOutput served from the cache; callers only read `raw`."""
+
+    def __init__(self, raw):
+        self.raw = raw
+
+    def __str__(self):
+        return self.raw
+
+
+# Wall-clock message timestamps in conversation text ("TIME=1712345678.9 | CON#1 | ...")
+TIMESTAMP_PATTERN = re.compile(r'TIME=[0-9.]+ \| ')
+
+# Inputs that differ on every run without changing what is asked of the LLM
+VOLATILE_INPUTS = ("session_id", "timestamp", "stream_id")
+
+
+def stable_inputs(value):
+    """
+    Crew inputs without their run-specific parts (message timestamps, VOLATILE_INPUTS), so a
+    re-run of a recorded session produces the same cache keys.
+    """
+    if isinstance(value, str):
+        return TIMESTAMP_PATTERN.sub('', value)
+    if isinstance(value, dict):
+        return {key: stable_inputs(item) for key, item in value.items() if key not in VOLATILE_INPUTS}
+    if isinstance(value, (list, tuple)):
+        return [stable_inputs(item) for item in value]
+    return value
+
+
+def crew_cache_key(crew, inputs):
+    """Hash of the agent configs, task configs and rendered inputs (see `stable_inputs`) of a crew call."""
+    payload = {
+        "agents": [
+            [agent.role, agent.goal, agent.backstory, getattr(agent.llm, "model", str(agent.llm))]
+            for agent in crew.agents
+        ],
+        "tasks": [[task.description, task.expected_output] for task in crew.tasks],
+        "inputs": stable_inputs(inputs),
+    }
+    data = json.dumps(payload, sort_keys=True, ensure_ascii=False, default=str)
+    return hashlib.sha256(data.encode("utf-8")).hexdigest()
+
+
+class LLMResponseCache:
+    """
+    On-disk cache of crew responses around `kickoff` / `kickoff_async`.
+
+    Modes:
+        off:    every call goes to the LLM (default).
+        record: serve hits from the cache, call the LLM on a miss and store the response.
+        replay: serve only from the cache; a miss raises LLMCacheMiss. Used to re-run
+                recorded sessions deterministically without touching the API.
+
+    Entries are kept in their own SQLite file, at most `max_entries`, least recently
+    used first out.
+    """
+
+    def __init__(self, db_path, mode="off", max_entries=5000):
+        if mode not in MODES:
+            raise ValueError(f"Unknown LLM cache mode '{mode}', expected one of {MODES}")
+        self.db_path = db_path
+        self.mode = mode
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._conn = None
+
+    @property
+    def enabled(self):
+        return self.mode != "off"
+
+    def _connect(self):
+        # Opened lazily so the default "off" mode never creates the file
+        if self._conn is None:
+            self._conn = sqlite3.connect(self.db_path, check_same_thread=False)
+            self._conn.execute(
+                '''CREATE TABLE IF NOT EXISTS llm_cache (
+                    cache_key TEXT PRIMARY KEY,
+                    response TEXT NOT NULL,
+                    created_at REAL NOT NULL,
+                    last_access REAL NOT NULL,
+                    task TEXT
+                )'''
+            )
+            columns = [row[1] for row in self._conn.execute('PRAGMA table_info(llm_cache)')]
+            if "task" not in columns:
+                # Caches recorded before the task name was stored
+                self._conn.execute('ALTER TABLE llm_cache ADD COLUMN task TEXT')
+            self._conn.commit()
+        return self._conn
+
+    def key(self, crew, inputs):
+        """
+        Cache key of a crew call, or None when the cache is off. Computed before the kickoff:
+        CrewAI interpolates the inputs into the task description in place while it runs.
+        """
+        return crew_cache_key(crew, inputs) if self.enabled else None
+
+    def get(self, key):
+        """
+        Return the cached response text of the call with cache key `key`, or None on a miss.
+
+        Raises:
+            LLMCacheMiss: On a miss in replay mode.
+        """
+        if not self.enabled:
+            return None
+        with self._lock:
+            conn = self._connect()
+            row = conn.execute('SELECT response FROM llm_cache WHERE cache_key = ?', (key,)).fetchone()
+            if row is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+                conn.execute('UPDATE llm_cache SET last_access = ? WHERE cache_key = ?', (time.time(), key))
+                conn.commit()
+        if row is None and self.mode == "replay":
+            raise LLMCacheMiss(f"No recorded response for crew call {key[:12]}")
+        return row[0] if row else None
+
+    def put(self, key, task_name, response):
+        if self.mode != "record":
+            return
+        now = time.time()
+        with self._lock:
+            conn = self._connect()
+            conn.execute(
+                'INSERT OR REPLACE INTO llm_cache (cache_key, response, created_at, last_access, task) '
+                'VALUES (?, ?, ?, ?, ?)',
+                (key, response, now, now, task_name or None)
+            )
+            conn.execute(
+                '''DELETE FROM llm_cache WHERE cache_key NOT IN (
+                       SELECT cache_key FROM llm_cache ORDER BY last_access DESC LIMIT ?
+                   )''',
+                (self.max_entries,)
+            )
+            conn.commit()
+
+    def kickoff(self, crew, inputs):
+        """Cached `crew.kickoff(inputs=inputs)`, under the task's call policy like `kickoff_async`."""
+        agent_name, task_name = crew_labels(crew)
+        start = time.perf_counter()
+        with span("crew_kickoff", agent=agent_name, task=task_name):
+            key = self.key(crew, inputs)
+            cached = self.get(key)
+            llm_calls_total.inc(task=task_name, cached=str(cached is not None).lower())
+            if cached is not None:
+                result = CachedCrewOutput(cached)
+                usage_accountant.record(crew, result, time.perf_counter() - start, cached=True)
+                return result
+            llm_calls_in_flight.inc()
+            try:
+                result = call_policies.call(
+                    task_name, lambda n: (crew if n == 0 else copy_crew(crew)).kickoff(inputs=inputs)
+                )
+            finally:
+                llm_calls_in_flight.dec()
+            usage_accountant.record(crew, result, time.perf_counter() - start)
+            self.put(key, task_name, result.raw)
+            return result
+
+    async def kickoff_async(self, crew, inputs, run=None):
+        """
+        Cached `crew.kickoff_async(inputs=inputs)`. Calls to the LLM run under the task's
+        call policy (timeout, retries, hedging, circuit breaker; see call_policy.py).
+
+        Args:
+            run: Optional coroutine factory used instead of `kickoff_async` on a miss
+                (e.g. a streaming kickoff); it must return an object with `raw`.
+        """
+        agent_name, task_name = crew_labels(crew)
+        start = time.perf_counter()
+        with span("crew_kickoff", agent=agent_name, task=task_name):
+            key = self.key(crew, inputs)
+            cached = self.get(key)
+            llm_calls_total.inc(task=task_name, cached=str(cached is not None).lower())
+            if cached is not None:
+                result = CachedCrewOutput(cached)
+                usage_accountant.record(crew, result, time.perf_counter() - start, cached=True)
+                return result
+            llm_calls_in_flight.inc()
+            try:
+                if run is not None:
+                    # A streamed request emits as it goes, so it is neither hedged nor retried
+                    result = await call_policies.call_async(task_name, lambda n: run(), hedge=False, retry=False)
+                else:
+                    result = await call_policies.call_async(
+                        task_name, lambda n: (crew if n == 0 else copy_crew(crew)).kickoff_async(inputs=inputs)
+                    )
+            finally:
+                llm_calls_in_flight.dec()
+            usage_accountant.record(crew, result, time.perf_counter() - start)
+            self.put(key, task_name, result.raw)
+            return result
+
+    def recorded_outputs(self):
+        """(task, response) of every cached crew call; task is None for entries recorded before it was stored."""
+        with self._lock:
+            return self._connect().execute('SELECT task, response FROM llm_cache ORDER BY created_at').fetchall()
+
+    def stats(self):
+        entries = 0
+        if self.enabled:
+            with self._lock:
+                entries = self._connect().execute('SELECT COUNT(*) FROM llm_cache').fetchone()[0]
+        lookups = self.hits + self.misses
+        return {
+            "mode": self.mode,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+            "entries": entries,
+            "max_entries": self.max_entries,
+        }
+
+
+llm_cache = LLMResponseCache(
+    os.getenv("LLM_CACHE_PATH", "llm_cache.db"),
+    mode=os.getenv("LLM_CACHE_MODE", "off"),
+    max_entries=int(os.getenv("LLM_CACHE_MAX_ENTRIES", "5000"))
+)
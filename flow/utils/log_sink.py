@@ -0,0 +1,191 @@
+import atexit
+import gzip
+import json
+import os
+import queue
+import shutil
+import threading
+from collections import OrderedDict
+
+from dotenv import load_dotenv
+
+from flow.utils.metrics import metrics
+
+load_dotenv()
+
+LOG_FORMATS = ("text", "jsonl")
+
+
+class LogSink:
+    """
+    Background writer for the session log files.
+
+    Callers only enqueue; a single writer thread owns the file handles, keeps up to
+    `max_open_files` of them open (least-recently-used closed first) with a write buffer,
+    and flushes them every `flush_interval` seconds or when the queue runs dry.
+    A file growing past `max_bytes` is rotated to `<file>.1.gz` (older archives shift to
+    `.2.gz` ... `.<backups>.gz`) and compressed on the writer thread.
+
+    Operations on the same path are applied in submission order, so a `remove()` never
+    races the writes queued before it.
+
+    Args:
+        max_bytes (int): Size after which a file is rotated (0 disables rotation).
+        backups (int): Number of gzip archives kept per file.
+        flush_interval (float): Max seconds a buffered line waits before reaching the disk.
+        max_open_files (int): Max file handles kept open at once.
+        buffer_size (int): Write buffer per handle, in bytes.
+    """
+
+    def __init__(self, max_bytes=10 * 1024 * 1024, backups=5, flush_interval=1.0,
+                 max_open_files=64, buffer_size=64 * 1024):
+        self.max_bytes = max_bytes
+        self.backups = backups
+        self.flush_interval = flush_interval
+        self.max_open_files = max_open_files
+        self.buffer_size = buffer_size
+        self._queue = queue.SimpleQueue()
+        self._handles = OrderedDict()  # path -> [file, size]; writer thread only
+        self._thread = None
+        self._start_lock = threading.Lock()
+        self._closed = False
+
+    # --- Caller side ---
+    def write(self, filename, message, truncate=False):
+        """Append `message` to `filename` (or replace its content when `truncate`)."""
+        self._submit(("truncate" if truncate else "write", filename, message))
+
+    def write_json(self, filename, record):
+        """Append `record` to `filename` as one JSON line."""
+        self._submit(("write", filename, json.dumps(record, ensure_ascii=False, default=str) + "\n"))
+
+    def remove(self, filename):
+        """Delete `filename` and its rotated archives once the writes queued before are done."""
+        self._submit(("remove", filename, None))
+
+    def flush(self, timeout=5.0):
+        """Block until everything queued so far is on disk; returns False on timeout."""
+        if self._thread is None:
+            return True
+        done = threading.Event()
+        self._queue.put(("flush", None, done))
+        return done.wait(timeout)
+
+    def close(self, timeout=5.0):
+        """Flush and close every handle, then stop the writer thread (used on shutdown)."""
+        if self._thread is None or self._closed:
+            return
+        self._closed = True
+        self._queue.put(("stop", None, None))
+        self._thread.join(timeout)
+
+    def queue_depth(self):
+        return self._queue.qsize()
+
+    def _submit(self, op):
+        if self._closed:
+            self._apply(*op)  # Late writes during shutdown go straight to disk
+            self._close_all()
+            return
+        if self._thread is None:
+            with self._start_lock:
+                if self._thread is None:
+                    self._thread = threading.Thread(target=self._run, name="log-sink", daemon=True)
+                    self._thread.start()
+        self._queue.put(op)
+
+    # --- Writer thread ---
+    def _run(self):
+        while True:
+            try:
+                op = self._queue.get(timeout=self.flush_interval)
+            except queue.Empty:
+                self._flush_all()
+                continue
+            if op[0] == "stop":
+                self._close_all()
+                return
+            try:
+                self._apply(*op)
+            except Exception as e:
+                print(f"!!! ERROR writing log file {op[1]}: {e}")
+            if self._queue.empty():
+                self._flush_all()
+
+    def _apply(self, kind, filename, payload):
+        if kind == "flush":
+            self._flush_all()
+            payload.set()
+        elif kind == "remove":
+            self._close(filename)
+            for path in [filename] + [self._archive(filename, i) for i in range(1, self.backups + 1)]:
+                if os.path.exists(path):
+                    os.remove(path)
+        else:
+            if kind == "truncate":
+                self._close(filename)
+            entry = self._open(filename, "w" if kind == "truncate" else "a")
+            entry[0].write(payload)
+            entry[1] += len(payload.encode("utf-8"))
+            if self.max_bytes and entry[1] >= self.max_bytes:
+                self._rotate(filename)
+
+    def _open(self, filename, mode):
+        entry = self._handles.get(filename)
+        if entry is not None:
+            self._handles.move_to_end(filename)
+            return entry
+        dir_name = os.path.dirname(filename)
+        if dir_name:
+            os.makedirs(dir_name, exist_ok=True)
+        f = open(filename, mode, encoding="utf-8", buffering=self.buffer_size)
+        entry = self._handles[filename] = [f, f.tell()]
+        while len(self._handles) > self.max_open_files:
+            _, (oldest, _) = self._handles.popitem(last=False)
+            oldest.close()
+        return entry
+
+    def _close(self, filename):
+        entry = self._handles.pop(filename, None)
+        if entry is not None:
+            entry[0].close()
+
+    def _archive(self, filename, index):
+        return f"{filename}.{index}.gz"
+
+    def _rotate(self, filename):
+        self._close(filename)
+        if self.backups <= 0:
+            os.remove(filename)
+            return
+        for i in range(self.backups - 1, 0, -1):
+            if os.path.exists(self._archive(filename, i)):
+                os.replace(self._archive(filename, i), self._archive(filename, i + 1))
+        with open(filename, "rb") as src, gzip.open(self._archive(filename, 1), "wb") as dst:
+            shutil.copyfileobj(src, dst)
+        os.remove(filename)
+
+    def _flush_all(self):
+        for f, _ in self._handles.values():
+            f.flush()
+
+    def _close_all(self):
+        for filename in list(self._handles):
+            self._close(filename)
+
+
+log_format = os.getenv("LOG_FORMAT", "text")
+if log_format not in LOG_FORMATS:
+    print(f"--- LOG SINK: Unknown LOG_FORMAT '{log_format}', using 'text'.")
+    log_format = "text"
+
+log_sink = LogSink(
+    max_bytes=int(os.getenv("LOG_MAX_BYTES", str(10 * 1024 * 1024))),
+    backups=int(os.getenv("LOG_BACKUPS", "5")),
+    flush_interval=float(os.getenv("LOG_FLUSH_INTERVAL", "1.0")),
+    max_open_files=int(os.getenv("LOG_MAX_OPEN_FILES", "64"))
+)
+atexit.register(log_sink.close)
+
+metrics.gauge("classroom_log_queue_depth", "Log writes waiting for the background writer.",
+              fn=log_sink.queue_depth)
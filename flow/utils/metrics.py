@@ -0,0 +1,242 @@
+import bisect
+import contextvars
+import json
+import logging
+import threading
+import time
+from contextlib import contextmanager
+
+trace_logger = logging.getLogger("classroom.trace")
+
+DEFAULT_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _format_labels(labelnames, values, extra=()):
+    pairs = list(zip(labelnames, values)) + list(extra)
+    if not pairs:
+        return ""
+    return "{" + ",".join(f'{name}="{_escape(value)}"' for name, value in pairs) + "}"
+
+
+def _format_value(value):
+    return repr(float(value)) if value != int(value) else str(int(value))
+
+
+class _Metric:
+    kind = "untyped"
+
+    def __init__(self, name, help_text, labelnames=()):
+        self.name = name
+        self.help_text = help_text
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def _key(self, labels):
+        return tuple(str(labels.get(name, "")) for name in self.labelnames)
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} {self.kind}"]
+        with self._lock:
+            items = sorted(self._values.items())
+        for key, value in items:
+            lines.append(f"{self.name}{_format_labels(self.labelnames, key)} {_format_value(value)}")
+        return lines
+
+
+class Counter(_Metric):
+    kind = "counter"
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+
+class Gauge(_Metric):
+    """A gauge set explicitly, or read from `fn()` at scrape time."""
+
+    kind = "gauge"
+
+    def __init__(self, name, help_text, labelnames=(), fn=None):
+        super().__init__(name, help_text, labelnames)
+        self.fn = fn
+
+    def set(self, value, **labels):
+        with self._lock:
+            self._values[self._key(labels)] = value
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def dec(self, amount=1, **labels):
+        self.inc(-amount, **labels)
+
+    def render(self):
+        if self.fn is not None:
+            try:
+                self.set(self.fn())
+            except Exception as e:
+                print(f"--- METRICS: Could not read gauge {self.name}: {e}")
+        return super().render()
+
+
+class Histogram(_Metric):
+    kind = "histogram"
+
+    def __init__(self, name, help_text, labelnames=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, help_text, labelnames)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            counts, total = self._values.get(key, ([0] * (len(self.buckets) + 1), 0.0))
+            counts[bisect.bisect_left(self.buckets, value)] += 1
+            self._values[key] = (counts, total + value)
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} {self.kind}"]
+        with self._lock:
+            items = sorted((key, (list(counts), total)) for key, (counts, total) in self._values.items())
+        for key, (counts, total) in items:
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float("inf"),), counts):
+                cumulative += count
+                le = "+Inf" if bound == float("inf") else _format_value(bound)
+                lines.append(f"{self.name}_bucket{_format_labels(self.labelnames, key, [('le', le)])} {cumulative}")
+            lines.append(f"{self.name}_sum{_format_labels(self.labelnames, key)} {_format_value(total)}")
+            lines.append(f"{self.name}_count{_format_labels(self.labelnames, key)} {cumulative}")
+        return lines
+
+
+class MetricsRegistry:
+    """Process-wide metrics, rendered in the Prometheus text exposition format."""
+
+    def __init__(self):
+        self._metrics = {}
+        self._lock = threading.Lock()
+
+    def _register(self, metric):
+        with self._lock:
+            return self._metrics.setdefault(metric.name, metric)
+
+    def counter(self, name, help_text, labelnames=()):
+        return self._register(Counter(name, help_text, labelnames))
+
+    def gauge(self, name, help_text, labelnames=(), fn=None):
+        return self._register(Gauge(name, help_text, labelnames, fn=fn))
+
+    def histogram(self, name, help_text, labelnames=(), buckets=DEFAULT_BUCKETS):
+        return self._register(Histogram(name, help_text, labelnames, buckets))
+
+    def render(self):
+        with self._lock:
+            metrics = list(self._metrics.values())
+        return "\n".join(line for metric in metrics for line in metric.render()) + "\n"
+
+
+metrics = MetricsRegistry()
+
+span_seconds = metrics.histogram("classroom_span_seconds", "Duration of traced spans.", ["span"])
+turn_seconds = metrics.histogram("classroom_turn_seconds", "Duration of a full dialogue turn.")
+llm_calls_in_flight = metrics.gauge("classroom_llm_calls_in_flight", "Crew kickoffs waiting for the LLM.")
+llm_calls_total = metrics.counter("classroom_llm_calls_total", "Crew kickoffs by task and cache use.",
+                                  ["task", "cached"])
+llm_tokens_total = metrics.counter("classroom_llm_tokens_total", "LLM tokens by task and kind (prompt/completion).",
+                                   ["task", "kind"])
+parse_failures_total = metrics.counter("classroom_parse_failures_total", "LLM outputs that could not be parsed.",
+                                       ["parser"])
+json_extract_total = metrics.counter("classroom_json_extract_total",
+                                    "JSON extractions of LLM outputs by task and result (ok/repaired/invalid/failed).",
+                                    ["task", "result"])
+
+
+# --- Spans ---
+_trace_tags = contextvars.ContextVar("trace_tags", default={})
+
+
+@contextmanager
+def trace_tags(**tags):
+    """Tags (session_id, turn_number, ...) added to every span started inside the block, threads and tasks included."""
+    token = _trace_tags.set({**_trace_tags.get(), **tags})
+    try:
+        yield
+    finally:
+        _trace_tags.reset(token)
+
+
+def current_trace_tags():
+    return _trace_tags.get()
+
+
+def record_span(name, seconds, error=None, **tags):
+    """Record a finished span: observed in classroom_span_seconds and logged as JSON on 'classroom.trace'."""
+    span_seconds.observe(seconds, span=name)
+    if trace_logger.isEnabledFor(logging.DEBUG):
+        record = {"span": name, "duration_ms": round(seconds * 1000, 3), **_trace_tags.get(), **tags}
+        if error is not None:
+            record["error"] = error
+        trace_logger.debug(json.dumps(record, ensure_ascii=False, default=str))
+
+
+@contextmanager
+def span(name, histogram=None, **tags):
+    """Time the block as span `name`; also observed in `histogram` when given."""
+    start = time.perf_counter()
+    error = None
+    try:
+        yield
+    except BaseException as e:
+        error = type(e).__name__
+        raise
+    finally:
+        seconds = time.perf_counter() - start
+        record_span(name, seconds, error=error, **tags)
+        if histogram is not None:
+            histogram.observe(seconds)
+
+
+def crew_labels(crew):
+    """(agent name, task name) of a crew built as '<agent>:<task>'."""
+    agent_name, _, task_name = (crew.name or "").partition(":")
+    return agent_name, task_name
+
+
+def install_flow_step_spans(flow_name="DialogueFlow"):
+    """
+    Record a span per executed method of `flow_name`, from the CrewAI method execution events.
+    The flow instance is the event source, so its session_id and turn_number tag the span.
+    """
+    from crewai.events import crewai_event_bus
+    from crewai.events.types.flow_events import (MethodExecutionFailedEvent, MethodExecutionFinishedEvent,
+                                                  MethodExecutionStartedEvent)
+
+    started = {}
+    lock = threading.Lock()
+
+    def on_started(source, event):
+        if event.flow_name == flow_name:
+            with lock:
+                started[(id(source), event.method_name)] = event.timestamp
+
+    def on_finished(source, event):
+        if event.flow_name != flow_name:
+            return
+        with lock:
+            start = started.pop((id(source), event.method_name), None)
+        if start is not None:
+            record_span(event.method_name, (event.timestamp - start).total_seconds(),
+                        error=type(event.error).__name__ if isinstance(event, MethodExecutionFailedEvent) else None,
+                        session_id=getattr(source, "session_id", None),
+                        turn_number=getattr(getattr(source, "state", None), "turn_number", None))
+
+    crewai_event_bus.register_handler(MethodExecutionStartedEvent, on_started)
+    crewai_event_bus.register_handler(MethodExecutionFinishedEvent, on_finished)
+    crewai_event_bus.register_handler(MethodExecutionFailedEvent, on_finished)
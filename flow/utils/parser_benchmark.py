@@ -0,0 +1,92 @@
+import contextlib
+import io
+import json
+import time
+
+from flow.utils.helpers import (TASK_SCHEMAS, schema_error, clean_response, extract_json, parse_json_response,
+                                process_content, repair_json)
+from flow.utils.turn_benchmark import LatencyRecorder
+
+# Output field rendered to the chat for tasks whose JSON holds a message
+MESSAGE_FIELDS = {"talk": "spoken_message"}
+
+RATES = {
+    "legacy_valid": "legacy_valid_rate", "legacy_failed": "legacy_failure_rate",
+    "extract_valid": "extract_valid_rate", "extract_failed": "extract_failure_rate",
+    "extract_repaired": "extract_repair_rate",
+}
+
+
+def load_recorded_outputs(path):
+    """
+    Recorded LLM outputs as (task, raw) pairs, from a JSONL file of {"task", "raw"} objects
+    or from an LLM response cache file (LLM_CACHE_MODE=record).
+    """
+    if path.endswith(".jsonl"):
+        with open(path, encoding="utf-8") as f:
+            records = [json.loads(line) for line in f if line.strip()]
+        return [(record.get("task"), record["raw"]) for record in records]
+    from flow.utils.llm_cache import LLMResponseCache
+    return [tuple(row) for row in LLMResponseCache(path, mode="replay").recorded_outputs()]
+
+
+def legacy_parse(raw, task):
+    """The chain used before extract_json: clean_response -> parse_json_response -> process_content."""
+    value = parse_json_response(clean_response(raw))
+    if task in MESSAGE_FIELDS and isinstance(value, dict):
+        process_content(value.get(MESSAGE_FIELDS[task], ""))
+    return value
+
+
+def extract_parse(raw, task):
+    value = extract_json(raw, task)
+    if task in MESSAGE_FIELDS and isinstance(value, dict):
+        process_content(value[MESSAGE_FIELDS[task]])
+    return value
+
+
+def _is_valid(value, task):
+    schema = TASK_SCHEMAS.get(task)
+    if value is None:
+        return False
+    if schema is None:
+        return True
+    if isinstance(schema, list):
+        return isinstance(value, list) and all(schema_error(item, schema[0]) is None for item in value)
+    return schema_error(value, schema) is None
+
+
+def run_parser_benchmark(records, repeat=1):
+    """
+    Parse every (task, raw) record with the legacy chain and with extract_json.
+
+    Output:
+        report: per task and in total, the parse/valid/failure counts of each chain, how often
+        extract_json had to repair the JSON, and the p50/p95/p99 parse time of each chain
+    """
+    recorder = LatencyRecorder()
+    by_task = {}
+
+    def count(task, key):
+        for bucket in (by_task.setdefault(task or "unknown", {}), by_task.setdefault("total", {})):
+            bucket[key] = bucket.get(key, 0) + 1
+
+    # Both chains print on bad input; keep the report readable
+    with contextlib.redirect_stdout(io.StringIO()):
+        for task, raw in records:
+            count(task, "records")
+            for name, parse in (("legacy", legacy_parse), ("extract", extract_parse)):
+                for _ in range(repeat):
+                    start = time.perf_counter()
+                    value = parse(raw, task)
+                    recorder.add(name, time.perf_counter() - start)
+                count(task, f"{name}_parsed" if value is not None else f"{name}_failed")
+                if _is_valid(value, task):
+                    count(task, f"{name}_valid")
+            if repair_json(raw)[1]:
+                count(task, "extract_repaired")
+
+    for bucket in by_task.values():
+        for key, rate in RATES.items():
+            bucket[rate] = round(bucket.setdefault(key, 0) / bucket["records"], 4)
+    return {"records": len(records), "repeat": repeat, "tasks": by_task, "latency": recorder.summary()}
@@ -0,0 +1,115 @@
+import hashlib
+import json
+import sqlite3
+import threading
+import time
+
+
+def normalize_keywords(keywords):
+    """Lower-case, strip, de-duplicate and sort keywords so equivalent inputs share a cache key."""
+    return sorted({kw.strip().lower() for kw in keywords or [] if kw and kw.strip()})
+
+
+class ScriptCache:
+    """
+    Persistent cache of generated (script, roles) pairs.
+
+    Entries are keyed by a hash of the problem, the solution, the normalized keywords
+    and the prompt version (a hash of the ScriptWriter/RolesWriter agent and task
+    configs), so editing a prompt invalidates the old entries automatically. Stored in
+    its own SQLite file; entries older than `max_age` seconds are dropped and at most
+    `max_entries` are kept, least recently used first out.
+
+    Args:
+        db_path (str): Path of the SQLite file.
+        max_entries (int): Maximum number of cached pairs.
+        max_age (float): Maximum age of an entry in seconds (0 = no limit).
+    """
+
+    def __init__(self, db_path, max_entries=200, max_age=30 * 24 * 3600):
+        self.db_path = db_path
+        self.max_entries = max_entries
+        self.max_age = max_age
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(db_path, check_same_thread=False)
+        self._conn.execute(
+            '''CREATE TABLE IF NOT EXISTS script_cache (
+                cache_key TEXT PRIMARY KEY,
+                script TEXT NOT NULL,
+                roles TEXT NOT NULL,
+                created_at REAL NOT NULL,
+                last_access REAL NOT NULL,
+                hits INTEGER NOT NULL DEFAULT 0
+            )'''
+        )
+        self._conn.commit()
+
+    @staticmethod
+    def make_key(problem, solution, keywords, prompt_version):
+        payload = json.dumps(
+            [problem, solution, normalize_keywords(keywords), prompt_version],
+            ensure_ascii=False
+        )
+        return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+    def get(self, key):
+        """Return the cached (script, roles) for `key`, or None."""
+        now = time.time()
+        with self._lock:
+            row = self._conn.execute(
+                'SELECT script, roles, created_at FROM script_cache WHERE cache_key = ?', (key,)
+            ).fetchone()
+            if row is not None and self.max_age and now - row[2] > self.max_age:
+                self._conn.execute('DELETE FROM script_cache WHERE cache_key = ?', (key,))
+                self._conn.commit()
+                row = None
+            if row is None:
+                self.misses += 1
+                return None
+            self._conn.execute(
+                'UPDATE script_cache SET last_access = ?, hits = hits + 1 WHERE cache_key = ?', (now, key)
+            )
+            self._conn.commit()
+            self.hits += 1
+        return json.loads(row[0]), json.loads(row[1])
+
+    def put(self, key, script, roles):
+        now = time.time()
+        with self._lock:
+            self._conn.execute(
+                '''INSERT OR REPLACE INTO script_cache (cache_key, script, roles, created_at, last_access, hits)
+                   VALUES (?, ?, ?, ?, ?, 0)''',
+                (key, json.dumps(script, ensure_ascii=False), json.dumps(roles, ensure_ascii=False), now, now)
+            )
+            self._evict(now)
+            self._conn.commit()
+
+    def _evict(self, now):
+        if self.max_age:
+            self._conn.execute('DELETE FROM script_cache WHERE created_at < ?', (now - self.max_age,))
+        self._conn.execute(
+            '''DELETE FROM script_cache WHERE cache_key NOT IN (
+                   SELECT cache_key FROM script_cache ORDER BY last_access DESC LIMIT ?
+               )''',
+            (self.max_entries,)
+        )
+
+    def clear(self):
+        with self._lock:
+            self._conn.execute('DELETE FROM script_cache')
+            self._conn.commit()
+
+    def stats(self):
+        with self._lock:
+            entries = self._conn.execute('SELECT COUNT(*) FROM script_cache').fetchone()[0]
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+            "entries": entries,
+            "max_entries": self.max_entries,
+            "max_age": self.max_age,
+        }
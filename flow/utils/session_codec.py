@@ -0,0 +1,92 @@
+import json
+from functools import cached_property
+
+# Version of the document in the sessions.state column; bump it and add an entry to
+# UPGRADES whenever the layout changes
+SCHEMA_VERSION = 1
+
+# Large fields are stored as nested JSON strings so decoding the document does not build them;
+# they are parsed on first access
+LAZY_FIELDS = ("script", "roles", "inner_thought")
+
+
+def _dumps(value):
+    return json.dumps(value, ensure_ascii=False, separators=(",", ":"))
+
+
+def encode_field(value):
+    """Encoded form of a lazy field, e.g. for json_set(state, '$.script', ?)."""
+    return None if value is None else _dumps(value)
+
+
+def encode_session_state(script=None, roles=None, stage_state=None, inner_thought=None):
+    """Encode the session state document stored in sessions.state."""
+    return _dumps({
+        "v": SCHEMA_VERSION,
+        "stage_state": stage_state,
+        "script": encode_field(script),
+        "roles": encode_field(roles),
+        "inner_thought": encode_field(list(inner_thought) if inner_thought is not None else None)
+    })
+
+
+def legacy_session_state(script, roles, stage_state, inner_thought):
+    """
+    Build a state document from the JSON text columns used before sessions.state.
+    Values that are not valid JSON are dropped with a warning.
+    """
+    def load(name, text):
+        if not text:
+            return None
+        try:
+            return json.loads(text)
+        except ValueError:
+            print(f"!!! WARNING: Dropping unreadable legacy session field '{name}'.")
+            return None
+
+    return encode_session_state(script=load("script", script), roles=load("roles", roles),
+                                stage_state=load("stage_state", stage_state),
+                                inner_thought=load("inner_thought", inner_thought))
+
+
+# Upgrades from older document versions, as version -> function(doc) returning the next version
+UPGRADES = {}
+
+
+class SessionState:
+    """
+    Decoded sessions.state document. `stage_state` is read right away; `script`, `roles`
+    and `inner_thought` are parsed the first time they are accessed.
+    """
+
+    def __init__(self, doc):
+        self._doc = doc
+        self.stage_state = doc.get("stage_state")
+
+    @cached_property
+    def script(self):
+        return self._lazy("script")
+
+    @cached_property
+    def roles(self):
+        return self._lazy("roles")
+
+    @cached_property
+    def inner_thought(self):
+        return self._lazy("inner_thought") or []
+
+    def _lazy(self, field):
+        text = self._doc.get(field)
+        return json.loads(text) if text is not None else None
+
+
+def decode_session_state(text):
+    """Decode a sessions.state document (None or empty gives an empty state)."""
+    doc = json.loads(text) if text else {"v": SCHEMA_VERSION}
+    version = doc.get("v", 0)
+    while version < SCHEMA_VERSION:
+        doc = UPGRADES[version](doc)
+        version = doc["v"]
+    if version > SCHEMA_VERSION:
+        raise ValueError(f"Session state version {version} is newer than this code ({SCHEMA_VERSION})")
+    return SessionState(doc)
@@ -0,0 +1,138 @@
+import threading
+import time
+from collections import OrderedDict
+
+
+class SessionRegistry:
+    """
+    Registry of live DialogueFlow instances keyed by session_id.
+
+    Entries are kept in least-recently-used order. An entry is evicted when it
+    has been idle for longer than `idle_ttl` seconds, or when the registry grows
+    past `max_sessions` (oldest idle entry first). Before an entry is dropped,
+    `on_evict(session_id, flow)` is called so the caller can snapshot the flow
+    (e.g. through `export_session_data()`) to the database.
+
+    Args:
+        max_sessions (int): Maximum number of live flows kept in memory.
+        idle_ttl (float): Seconds without access after which a flow is evicted.
+        on_evict (callable): Called as on_evict(session_id, flow) before an entry is dropped.
+        is_busy (callable): Called as is_busy(flow); busy flows are never evicted automatically.
+    """
+
+    def __init__(self, max_sessions=50, idle_ttl=1800, on_evict=None, is_busy=None):
+        self.max_sessions = max_sessions
+        self.idle_ttl = idle_ttl
+        self.on_evict = on_evict
+        self.is_busy = is_busy or (lambda flow: False)
+        self._entries = OrderedDict()  # session_id -> [flow, last_access]
+        self._lock = threading.RLock()
+
+    def __contains__(self, session_id):
+        with self._lock:
+            return session_id in self._entries
+
+    def __len__(self):
+        with self._lock:
+            return len(self._entries)
+
+    def session_ids(self):
+        with self._lock:
+            return list(self._entries.keys())
+
+    def get(self, session_id):
+        """Return the live flow for `session_id` (or None) and mark it as recently used."""
+        with self._lock:
+            entry = self._entries.get(session_id)
+            if entry is None:
+                return None
+            entry[1] = time.monotonic()
+            self._entries.move_to_end(session_id)
+            flow = entry[0]
+        self.evict_idle()
+        return flow
+
+    def put(self, session_id, flow):
+        """Register `flow` for `session_id`, replacing (and snapshotting) any previous flow."""
+        with self._lock:
+            previous = self._entries.pop(session_id, None)
+            self._entries[session_id] = [flow, time.monotonic()]
+        if previous is not None and previous[0] is not flow:
+            self._snapshot(session_id, previous[0])
+        self.evict_idle()
+        return flow
+
+    def get_or_create(self, session_id, factory):
+        """
+        Return the live flow for `session_id`, building it with `factory()` on a miss.
+
+        The factory runs outside the registry lock. If another caller registered a
+        flow for the same session in the meantime, that flow wins and the freshly
+        built one is discarded. Returns None if the factory returns None.
+        """
+        flow = self.get(session_id)
+        if flow is not None:
+            return flow
+        flow = factory()
+        if flow is None:
+            return None
+        with self._lock:
+            entry = self._entries.get(session_id)
+            if entry is not None:
+                entry[1] = time.monotonic()
+                return entry[0]
+            self._entries[session_id] = [flow, time.monotonic()]
+        self.evict_idle()
+        return flow
+
+    def remove(self, session_id, snapshot=True):
+        """Drop the flow for `session_id`, snapshotting it first unless `snapshot` is False."""
+        with self._lock:
+            entry = self._entries.pop(session_id, None)
+        if entry is None:
+            return None
+        if snapshot:
+            self._snapshot(session_id, entry[0])
+        return entry[0]
+
+    def evict_idle(self):
+        """Evict idle entries past `idle_ttl` and, if still over capacity, the least recently used ones."""
+        evicted = []
+        now = time.monotonic()
+        with self._lock:
+            for session_id, (flow, last_access) in list(self._entries.items()):
+                if now - last_access > self.idle_ttl and not self.is_busy(flow):
+                    evicted.append((session_id, flow))
+                    del self._entries[session_id]
+
+            overflow = len(self._entries) - self.max_sessions
+            if overflow > 0:
+                for session_id, (flow, _) in list(self._entries.items()):
+                    if overflow <= 0:
+                        break
+                    if self.is_busy(flow):
+                        continue
+                    evicted.append((session_id, flow))
+                    del self._entries[session_id]
+                    overflow -= 1
+
+        for session_id, flow in evicted:
+            print(f"--- SESSION REGISTRY: Evicting session {session_id}")
+            self._snapshot(session_id, flow)
+        return len(evicted)
+
+    def close(self):
+        """Snapshot and drop every live flow (used on shutdown)."""
+        with self._lock:
+            entries = list(self._entries.items())
+            self._entries.clear()
+        for session_id, (flow, _) in entries:
+            self._snapshot(session_id, flow)
+
+    def _snapshot(self, session_id, flow):
+        if self.on_evict is None:
+            return
+        try:
+            self.on_evict(session_id, flow)
+        except Exception as e:
+            print(f"!!! ERROR snapshotting session {session_id} on eviction: {e}")
@@ -1,5 +1,12 @@
 import time
-from flask_socketio import emit
+from flask_socketio import emit as socketio_emit
+
+from flow.utils.metrics import span
+
+def emit(event, data, **kwargs):
+    """flask_socketio.emit, timed as a 'socket_emit' span."""
+    with span("socket_emit", event=event):
+        socketio_emit(event, data, **kwargs)
 
 def send_message_via_socketio(message_data, session_id):
     """
@@ -68,4 +75,19 @@ def send_system_status(message, session_id):
         'timestamp': int(time.time() * 1000)
     }
     
-    emit('system_status', status_data, room=session_id, namespace='/')
\ No newline at end of file
+    emit('system_status', status_data, room=session_id, namespace='/')
+
+def send_message_chunk_via_socketio(chunk_data, session_id):
+    """
+    Send an incremental piece of an agent message via Socket.IO to clients in the session room.
+    The message is completed by a regular 'new_message' event carrying the same stream_id.
+    
+    Args:
+        chunk_data (dict): The chunk data ('stream_id', 'sender_name', 'delta')
+        session_id (str): The session ID to send the chunk to
+    """
+    emit('message_chunk', {
+        'source': 'agent',
+        'content': chunk_data,
+        'timestamp': int(time.time() * 1000)
+    }, room=session_id, namespace='/')
@@ -0,0 +1,75 @@
+import re
+
+_ESCAPES = {'"': '"', '\\': '\\', '/': '/', 'b': '\b', 'f': '\f', 'n': '\n', 'r': '\r', 't': '\t'}
+
+
+class JsonStringFieldStream:
+    """
+    Incrementally extract the value of one string field from a streamed JSON response.
+
+    The talker answers with `{"spoken_message": "..."}` (often wrapped in a ```json
+    fence). Feeding the raw LLM chunks to `feed()` returns only the newly decoded
+    characters of that field's value, so they can be forwarded to the browser as
+    they arrive without any JSON syntax around them.
+
+    Args:
+        key (str): Name of the field to extract, e.g. "spoken_message".
+    """
+
+    def __init__(self, key):
+        self._key_pattern = re.compile(r'"' + re.escape(key) + r'"\s*:\s*"')
+        self._tail_size = len(key) + 16
+        self._buffer = ""   # Raw text not yet consumed
+        self._in_value = False
+        self.done = False
+        self.text = ""      # Decoded value so far
+
+    def feed(self, chunk):
+        """
+        Consume a raw chunk and return the newly decoded part of the field value.
+        """
+        if self.done or not chunk:
+            return ""
+        self._buffer += chunk
+
+        if not self._in_value:
+            match = self._key_pattern.search(self._buffer)
+            if match is None:
+                # Keep only a tail long enough to contain a split key
+                self._buffer = self._buffer[-self._tail_size:]
+                return ""
+            self._buffer = self._buffer[match.end():]
+            self._in_value = True
+
+        decoded = []
+        i = 0
+        while i < len(self._buffer):
+            char = self._buffer[i]
+            if char == '"':
+                self.done = True
+                i += 1
+                break
+            if char != '\\':
+                decoded.append(char)
+                i += 1
+                continue
+            # Escape sequence: wait for the rest of it if it was split across chunks
+            if i + 1 >= len(self._buffer):
+                break
+            escape = self._buffer[i + 1]
+            if escape == 'u':
+                if i + 6 > len(self._buffer):
+                    break
+                try:
+                    decoded.append(chr(int(self._buffer[i + 2:i + 6], 16)))
+                except ValueError:
+                    decoded.append(self._buffer[i:i + 6])
+                i += 6
+            else:
+                decoded.append(_ESCAPES.get(escape, '\\' + escape))
+                i += 2
+        self._buffer = self._buffer[i:]
+
+        delta = "".join(decoded)
+        self.text += delta
+        return delta
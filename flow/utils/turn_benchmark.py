@@ -0,0 +1,159 @@
+import threading
+import time
+from contextlib import contextmanager
+from functools import wraps
+
+from crewai.events import crewai_event_bus
+from crewai.events.types.flow_events import (MethodExecutionFailedEvent, MethodExecutionFinishedEvent,
+                                              MethodExecutionStartedEvent)
+
+FLOW_STEPS = ("manage_stage", "generate_inner_thought", "evaluate_inner_thought",
+              "generate_speech", "save_final_answers")
+
+
+def summarize(samples):
+    """Count, mean and p50/p95/p99/max of a list of durations in seconds, reported in milliseconds."""
+    if not samples:
+        return {"count": 0}
+    ordered = sorted(samples)
+
+    def percentile(q):
+        # Nearest-rank percentile
+        return ordered[min(len(ordered) - 1, max(0, int(round(q / 100 * len(ordered))) - 1))]
+
+    return {
+        "count": len(ordered),
+        "mean_ms": round(sum(ordered) / len(ordered) * 1000, 3),
+        "p50_ms": round(percentile(50) * 1000, 3),
+        "p95_ms": round(percentile(95) * 1000, 3),
+        "p99_ms": round(percentile(99) * 1000, 3),
+        "max_ms": round(ordered[-1] * 1000, 3),
+    }
+
+
+class LatencyRecorder:
+    """Thread-safe collection of duration samples by name."""
+
+    def __init__(self):
+        self._samples = {}
+        self._lock = threading.Lock()
+
+    def add(self, name, seconds):
+        with self._lock:
+            self._samples.setdefault(name, []).append(seconds)
+
+    def summary(self):
+        with self._lock:
+            return {name: summarize(samples) for name, samples in self._samples.items()}
+
+
+@contextmanager
+def timed_attribute(owner, attr, name, recorder):
+    """Time every call of `owner.attr` under `name` while the context is active."""
+    original = getattr(owner, attr)
+
+    @wraps(original)
+    def timed(*args, **kwargs):
+        start = time.perf_counter()
+        try:
+            return original(*args, **kwargs)
+        finally:
+            recorder.add(name, time.perf_counter() - start)
+
+    setattr(owner, attr, timed)
+    try:
+        yield
+    finally:
+        setattr(owner, attr, original)
+
+
+@contextmanager
+def timed_flow_steps(recorder, flow_name="DialogueFlow", steps=FLOW_STEPS):
+    """
+    Record the duration of the flow methods in `steps` while the context is active.
+    Durations come from the start/finish timestamps of the CrewAI method execution events.
+    """
+    started = {}
+    lock = threading.Lock()
+
+    def on_started(source, event):
+        if event.flow_name == flow_name and event.method_name in steps:
+            with lock:
+                started[(id(source), event.method_name)] = event.timestamp
+
+    def on_finished(source, event):
+        if event.flow_name == flow_name and event.method_name in steps:
+            with lock:
+                start = started.pop((id(source), event.method_name), None)
+            if start is not None:
+                recorder.add(event.method_name, (event.timestamp - start).total_seconds())
+
+    handlers = [(MethodExecutionStartedEvent, on_started),
+                (MethodExecutionFinishedEvent, on_finished),
+                (MethodExecutionFailedEvent, on_finished)]
+    for event_type, handler in handlers:
+        crewai_event_bus.register_handler(event_type, handler)
+    try:
+        yield
+    finally:
+        crewai_event_bus.flush()  # Sync handlers run on the bus's thread pool
+        for event_type, handler in handlers:
+            crewai_event_bus.off(event_type, handler)
+
+
+def wait_for_turn(job, timeout):
+    """Block until a turn returned by `process_new_message` is over; returns False on failure or timeout."""
+    if job is None or job is True:
+        return job is True
+    deadline = time.monotonic() + timeout
+    while job.finished_at is None:
+        if time.monotonic() > deadline:
+            return False
+        time.sleep(0.01)
+    return job.status == "done"
+
+
+def run_turn_benchmark(flows, turns, recorder, save=None, user_name="BenchUser", turn_timeout=300):
+    """
+    Drive `turns` user turns through each flow, all sessions concurrently.
+
+    Every turn sends a user message addressed to the first participant (so the turn starts
+    without the quiet period), waits for it, optionally persists the session with `save`,
+    then feeds the agent's reply back the way the chat client echoes it.
+
+    Args:
+        flows (list[DialogueFlow]): One flow per simulated session.
+        turns (int): Turns per session.
+        recorder (LatencyRecorder): Receives 'turn' and 'db_save' samples.
+        save (callable): Optional save(flow) run after each turn.
+
+    Returns:
+        dict: Completed and failed turn counts.
+    """
+    counts = {"completed": 0, "failed": 0}
+    counts_lock = threading.Lock()
+
+    def drive(flow):
+        addressee = flow.state.participants[0]
+        for turn in range(turns):
+            start = time.perf_counter()
+            job = flow.process_new_message(user_name, f"{addressee}, lượt {turn + 1}: nhóm mình làm tiếp nhé?")
+            # Inline turns (no executor) only report their outcome on the flow
+            ok = wait_for_turn(job, turn_timeout) and not flow.turn_error
+            recorder.add("turn", time.perf_counter() - start)
+            with counts_lock:
+                counts["completed" if ok else "failed"] += 1
+            if save is not None:
+                save_start = time.perf_counter()
+                save(flow)
+                recorder.add("db_save", time.perf_counter() - save_start)
+            # The client echoes agent messages back; skip it after the last turn so no follow-up turn is left pending
+            if turn < turns - 1 and flow.state.talker:
+                flow.process_new_message(flow.state.talker, flow.state.speech)
+
+    threads = [threading.Thread(target=drive, args=(flow,), daemon=True) for flow in flows]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return counts
@@ -0,0 +1,152 @@
+import threading
+import time
+import traceback
+import uuid
+from collections import OrderedDict
+
+
+class TurnQueueFull(RuntimeError):
+    """Raised when a turn is submitted while the executor queue is at capacity."""
+
+
+class TurnJob:
+    """
+    A single queued dialogue turn.
+
+    Status goes through 'queued' -> 'running' -> 'done' | 'failed'.
+    """
+
+    def __init__(self, session_id, func):
+        self.job_id = str(uuid.uuid4())
+        self.session_id = session_id
+        self.func = func
+        self.status = "queued"
+        self.error = None
+        self.created_at = time.time()
+        self.started_at = None
+        self.finished_at = None
+
+    def to_dict(self):
+        return {
+            "job_id": self.job_id,
+            "session_id": self.session_id,
+            "status": self.status,
+            "error": self.error,
+            "created_at": self.created_at,
+            "started_at": self.started_at,
+            "finished_at": self.finished_at,
+            "queued_seconds": (self.started_at or time.time()) - self.created_at,
+            "run_seconds": (self.finished_at or time.time()) - self.started_at if self.started_at else None,
+        }
+
+
+class TurnExecutor:
+    """
+    Bounded pool of background workers that run dialogue turns off the Socket.IO handlers.
+
+    Handlers call `submit()` and return immediately; a worker picks the job up and runs
+    it inside a Flask app context, so the `send_*_via_socketio` helpers keep working.
+    Workers and the job queue are created through the Socket.IO server, so they are
+    threads or greenlets depending on the configured async mode.
+
+    Args:
+        socketio: The Flask-SocketIO instance.
+        app: The Flask app used to push an app context around each job.
+        num_workers (int): Number of concurrent turn workers.
+        max_queue_size (int): Maximum number of queued (not yet running) jobs.
+        max_finished_jobs (int): Number of finished jobs kept for status lookups.
+    """
+
+    def __init__(self, socketio, app, num_workers=4, max_queue_size=100, max_finished_jobs=500):
+        self.socketio = socketio
+        self.app = app
+        self.num_workers = num_workers
+        self.max_queue_size = max_queue_size
+        self.max_finished_jobs = max_finished_jobs
+        self._queue = None
+        self._jobs = OrderedDict()  # job_id -> TurnJob
+        self._lock = threading.Lock()
+        self._started = False
+        self._completed = 0
+        self._failed = 0
+
+    def start(self):
+        """Create the job queue and spawn the workers (idempotent)."""
+        with self._lock:
+            if self._started:
+                return
+            self._queue = self.socketio.server.eio.create_queue()
+            self._started = True
+        for _ in range(self.num_workers):
+            self.socketio.start_background_task(self._worker_loop)
+        print(f"--- TURN EXECUTOR: Started {self.num_workers} workers (queue size {self.max_queue_size})")
+
+    def submit(self, session_id, func):
+        """
+        Enqueue `func` as a turn for `session_id`. A turn that returns an error message
+        instead of raising is counted as failed too.
+
+        Returns:
+            TurnJob: The queued job.
+        Raises:
+            TurnQueueFull: If `max_queue_size` jobs are already waiting.
+        """
+        self.start()
+        job = TurnJob(session_id, func)
+        with self._lock:
+            if self.queue_depth() >= self.max_queue_size:
+                raise TurnQueueFull(f"Turn queue is full ({self.max_queue_size} jobs waiting)")
+            self._jobs[job.job_id] = job
+        self._queue.put(job)
+        return job
+
+    def queue_depth(self):
+        """Number of jobs waiting for a worker."""
+        return sum(1 for job in list(self._jobs.values()) if job.status == "queued")
+
+    def get_job(self, job_id):
+        return self._jobs.get(job_id)
+
+    def stats(self):
+        jobs = list(self._jobs.values())
+        return {
+            "workers": self.num_workers,
+            "max_queue_size": self.max_queue_size,
+            "queue_depth": sum(1 for job in jobs if job.status == "queued"),
+            "running": sum(1 for job in jobs if job.status == "running"),
+            "completed": self._completed,
+            "failed": self._failed,
+        }
+
+    def _worker_loop(self):
+        while True:
+            job = self._queue.get()
+            job.status = "running"
+            job.started_at = time.time()
+            try:
+                with self.app.app_context():
+                    error = job.func()
+                if error:
+                    # The turn handled its own error (and told the room), but it still failed
+                    job.status = "failed"
+                    job.error = error
+                    self._failed += 1
+                else:
+                    job.status = "done"
+                    self._completed += 1
+            except Exception as e:
+                print(f"!!! ERROR in turn job {job.job_id} for session {job.session_id}: {e}")
+                traceback.print_exc()
+                job.status = "failed"
+                job.error = str(e)
+                self._failed += 1
+            finally:
+                job.finished_at = time.time()
+                job.func = None  # Drop the reference to the flow once the turn is over
+                self._prune_finished()
+
+    def _prune_finished(self):
+        with self._lock:
+            finished = [job_id for job_id, job in self._jobs.items() if job.status in ("done", "failed")]
+            for job_id in finished[:max(0, len(finished) - self.max_finished_jobs)]:
+                del self._jobs[job_id]
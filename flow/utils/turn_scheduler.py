@@ -0,0 +1,117 @@
+import threading
+import time
+
+
+class TurnScheduler:
+    """
+    Per-session debounce/coalescing of dialogue turns.
+
+    Every appended message calls `notify()`. While the session is idle, a turn is
+    started once no new message has arrived for `quiet_period` seconds (but never
+    later than `max_wait` seconds after the first pending message), or at once when
+    `immediate=True`. Messages that arrive while a turn is running are folded into
+    exactly one follow-up turn, scheduled when `turn_finished()` is called.
+
+    Args:
+        socketio: The Flask-SocketIO instance, used for background timers and sleeps.
+        start_turn (callable): Starts a turn; returns a truthy value if one was started.
+        quiet_period (float): Seconds of silence before a turn starts.
+        max_wait (float): Upper bound on how long a pending message can wait.
+    """
+
+    def __init__(self, socketio, start_turn, quiet_period=3.0, max_wait=10.0):
+        self.socketio = socketio
+        self.start_turn = start_turn
+        self.quiet_period = quiet_period
+        self.max_wait = max_wait
+        self._lock = threading.Lock()
+        self._running = False
+        self._followup = False
+        self._deadline = None
+        self._first_pending_at = None
+        self._timer_active = False
+        self._cancelled = False
+
+    @property
+    def is_running(self):
+        return self._running
+
+    @property
+    def is_pending(self):
+        """True while a turn is scheduled (waiting for its deadline) or a follow-up turn is owed."""
+        with self._lock:
+            return self._deadline is not None or self._followup
+
+    def cancel(self):
+        """Drop the scheduled and follow-up turns and ignore later messages (the flow is being dropped)."""
+        with self._lock:
+            self._cancelled = True
+            self._deadline = None
+            self._first_pending_at = None
+            self._followup = False
+
+    def notify(self, immediate=False):
+        """
+        Register a new message.
+
+        Returns:
+            The value returned by `start_turn` if a turn was started synchronously, else None.
+        """
+        with self._lock:
+            if self._cancelled:
+                return None
+            if self._running:
+                self._followup = True
+                return None
+            now = time.monotonic()
+            if self._first_pending_at is None:
+                self._first_pending_at = now
+            if immediate:
+                self._deadline = now
+            else:
+                self._deadline = min(now + self.quiet_period, self._first_pending_at + self.max_wait)
+                if not self._timer_active:
+                    self._timer_active = True
+                    self.socketio.start_background_task(self._timer_loop)
+                return None
+        return self._fire()
+
+    def turn_finished(self):
+        """Mark the running turn as done and schedule the follow-up turn, if any message arrived meanwhile."""
+        with self._lock:
+            self._running = False
+            followup, self._followup = self._followup, False
+        if followup:
+            self.notify()
+
+    def _timer_loop(self):
+        while True:
+            with self._lock:
+                if self._deadline is None:
+                    # Already fired by an immediate notify()
+                    self._timer_active = False
+                    return
+                remaining = self._deadline - time.monotonic()
+                if remaining <= 0:
+                    self._timer_active = False
+                    break
+            self.socketio.sleep(remaining)
+        self._fire()
+
+    def _fire(self):
+        with self._lock:
+            if self._running or self._deadline is None:
+                return None
+            self._running = True
+            self._deadline = None
+            self._first_pending_at = None
+        try:
+            started = self.start_turn()
+        except Exception:
+            with self._lock:
+                self._running = False
+            raise
+        if not started:
+            with self._lock:
+                self._running = False
+        return started
@@ -0,0 +1,45 @@
+import time
+
+from flow.utils.metrics import crew_labels, current_trace_tags, llm_tokens_total
+
+
+class UsageAccountant:
+    """
+    Token and wall-time accounting of every crew kickoff.
+
+    Each call is attributed to the session and turn of the current trace tags and to the
+    agent and task of the crew, counted in classroom_llm_tokens_total, and handed to
+    `sink(record)` (set by the app to persist it with the session). Calls made outside a
+    session (e.g. the CLI) are only counted.
+    """
+
+    def __init__(self, sink=None):
+        self.sink = sink
+
+    def record(self, crew, result, seconds, cached=False):
+        agent_name, task_name = crew_labels(crew)
+        usage = getattr(result, "token_usage", None)
+        tags = current_trace_tags()
+        record = {
+            "session_id": tags.get("session_id"),
+            "turn_number": tags.get("turn_number"),
+            "agent_name": agent_name,
+            "task_name": task_name,
+            "prompt_tokens": usage.prompt_tokens if usage else 0,
+            "completion_tokens": usage.completion_tokens if usage else 0,
+            "total_tokens": usage.total_tokens if usage else 0,
+            "seconds": seconds,
+            "cached": cached,
+            "timestamp": int(time.time() * 1000),
+        }
+        llm_tokens_total.inc(record["prompt_tokens"], task=task_name, kind="prompt")
+        llm_tokens_total.inc(record["completion_tokens"], task=task_name, kind="completion")
+        if self.sink is not None and record["session_id"]:
+            try:
+                self.sink(record)
+            except Exception as e:
+                print(f"--- USAGE [{record['session_id']}]: Could not record LLM call: {e}")
+        return record
+
+
+usage_accountant = UsageAccountant()
@@ -32,11 +32,24 @@ document.addEventListener('DOMContentLoaded', () => {
     let messageCounter = 0;
     let currentTypingAgents = new Set();
     let agentStatuses = {};
+    let streamingMessages = {}; // stream_id -> { element, text } of agent messages being streamed
+    let lastTurn = null; // Highest turn number (CON#) displayed; a reconnect only fetches what comes after
+    const HISTORY_PAGE_SIZE = 200;
     let socket = null;
 
     // --- Get session ID and username from HTML data attributes ---
     const currentSessionId = container?.dataset.sessionId;
     let currentUsername = container?.dataset.userName || '';
+    // 'generating' while the script for this session is still being written
+    const sessionGenerating = container?.dataset.sessionStatus === 'generating';
+    const generationStatusTextEl = document.getElementById('generationStatusText');
+    const generationStepLabels = {
+        cached: 'Đã tìm thấy kịch bản có sẵn...',
+        script_written: 'Đã viết xong kịch bản, đang tạo vai trò...',
+        roles_written: 'Đã tạo xong vai trò, đang kiểm tra...',
+        parsed: 'Đang kiểm tra kịch bản...',
+        validated: 'Kịch bản hợp lệ, đang mở lớp học...'
+    };
 
     // --- Check if essential data is present ---
     if (!currentSessionId) {
@@ -164,6 +177,37 @@ document.addEventListener('DOMContentLoaded', () => {
 
         messageCounter++;
         if (messageCountEl) messageCountEl.textContent = messageCounter;
+        return msg;
+    }
+
+    function displayMessageChunk(eventData) {
+        if (!chatbox) return;
+
+        const streamId = eventData.content?.stream_id;
+        if (!streamId) return;
+
+        let entry = streamingMessages[streamId];
+        if (!entry) {
+            const senderName = eventData.content?.sender_name || 'AI';
+            const msg = document.createElement('div');
+            msg.classList.add('message', 'ai-message', 'streaming-message');
+            msg.classList.add(`agent-${senderName.toLowerCase().replace(/[^a-z0-9]+/g, '-')}`);
+            msg.innerHTML = `
+            <div class="message-header">
+                <strong class="sender-name">${escapeHTML(senderName)}</strong>
+                <span class="timestamp">${formatTimestamp(eventData.timestamp)}</span>
+            </div>
+            <div class="message-content">
+                <div class="message-text"></div>
+            </div>`;
+            chatbox.appendChild(msg);
+            entry = streamingMessages[streamId] = { element: msg, text: '' };
+        }
+
+        entry.text += eventData.content?.delta || '';
+        const messageTextDiv = entry.element.querySelector('.message-text');
+        if (messageTextDiv) messageTextDiv.innerHTML = marked.parse(entry.text);
+        chatbox.scrollTop = chatbox.scrollHeight;
     }
 
     function updateParticipantDisplay() {
@@ -315,6 +359,53 @@ document.addEventListener('DOMContentLoaded', () => {
             });
     });
 
+    // --- Script generation ---
+    function lockChatWhileGenerating() {
+        if (messageInput) messageInput.disabled = true;
+        if (sendButton) sendButton.disabled = true;
+    }
+
+    function checkGenerationStatus() {
+        // Covers a job that finished before this page joined the room
+        fetch(`/api/sessions/${currentSessionId}/status`)
+            .then(r => r.json())
+            .then(data => {
+                if (data.status === 'ready') {
+                    window.location.reload();
+                } else if (data.detail && generationStatusTextEl) {
+                    generationStatusTextEl.textContent = generationStepLabels[data.detail] || data.detail;
+                }
+            })
+            .catch(err => console.error("Generation status fetch error:", err));
+    }
+
+    // --- History ---
+    function trackTurn(message) {
+        const turn = message.content?.turn_number;
+        if (typeof turn === 'number' && (lastTurn === null || turn > lastTurn)) lastTurn = turn;
+    }
+
+    function fetchMissedHistory(afterTurn) {
+        fetch(`/history/${currentSessionId}?after_turn=${afterTurn}&limit=${HISTORY_PAGE_SIZE}`)
+            .then(r => {
+                if (!r.ok) throw new Error(`HTTP error! status: ${r.status}`);
+                return r.json();
+            })
+            .then(data => {
+                (data.history || []).forEach(msg => {
+                    displayMessage(msg);
+                    trackTurn(msg);
+                });
+                if (data.current_stage_id) {
+                    currentStageId = data.current_stage_id;
+                    completedTaskIds = data.completed_task_ids;
+                    updateStageInformation();
+                }
+                if (data.has_more) fetchMissedHistory(data.next_after_turn);
+            })
+            .catch(err => console.error("History delta fetch error:", err));
+    }
+
     // --- Socket.IO Setup ---
     function connectSocketIO() {
         updateConnectionStatus('connecting');
@@ -329,7 +420,20 @@ document.addEventListener('DOMContentLoaded', () => {
             
             // Join the session room
             socket.emit('join', { session_id: currentSessionId });
+
+            if (sessionGenerating) {
+                // Chat stays locked until the script generation job finishes
+                lockChatWhileGenerating();
+                checkGenerationStatus();
+                return;
+            }
             
+            if (lastTurn !== null) {
+                // Reconnect: only fetch the messages sent while disconnected
+                fetchMissedHistory(lastTurn);
+                return;
+            }
+
             initializeUserDisplay();
             initializeAgentStatuses();
             renderMathInElement(problemDisplayEl);
@@ -348,7 +452,10 @@ document.addEventListener('DOMContentLoaded', () => {
                     if (chatbox) chatbox.innerHTML = '';
                     messageCounter = 0;
                     if (data.history) {
-                        data.history.forEach(displayMessage);
+                        data.history.forEach(msg => {
+                            displayMessage(msg);
+                            trackTurn(msg);
+                        });
                     }
                     if (messageInput) messageInput.focus();
                     
@@ -370,6 +477,16 @@ document.addEventListener('DOMContentLoaded', () => {
                 });
         });
         
+        socket.on('script_generation_progress', (data) => {
+            if (data.session_id !== currentSessionId || !generationStatusTextEl) return;
+            generationStatusTextEl.textContent = generationStepLabels[data.step] || data.step;
+        });
+
+        socket.on('script_generation_done', (data) => {
+            if (data.session_id !== currentSessionId) return;
+            window.location.reload();
+        });
+        
         socket.on('disconnect', () => {
             console.log('Disconnected from Socket.IO server');
             updateConnectionStatus('disconnected');
@@ -399,7 +516,16 @@ document.addEventListener('DOMContentLoaded', () => {
         // Handle incoming messages
         socket.on('new_message', (data) => {
             console.log("New message received:", data); // Debug: Log the received data
-            displayMessage(data);
+            const msgEl = displayMessage(data);
+            trackTurn(data);
+
+            // Replace the progressively rendered bubble with the final, cleaned message
+            const streamId = data.content?.stream_id;
+            if (streamId && streamingMessages[streamId]) {
+                if (msgEl) streamingMessages[streamId].element.replaceWith(msgEl);
+                else streamingMessages[streamId].element.remove();
+                delete streamingMessages[streamId];
+            }
             
             // If it's an agent message, clear typing status
             const senderName = data.content?.sender_name;
@@ -418,6 +544,15 @@ document.addEventListener('DOMContentLoaded', () => {
             }
         });
         
+        // Render streamed pieces of an agent message as they arrive
+        socket.on('message_chunk', (data) => {
+            try {
+                displayMessageChunk(data);
+            } catch (err) {
+                console.error('Error handling message_chunk:', err);
+            }
+        });
+        
         // Handle agent status updates
         socket.on('agent_status', (data) => {
             try {
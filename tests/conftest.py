@@ -0,0 +1,49 @@
+import os
+
+import pytest
+from flask import Flask
+from flask_socketio import SocketIO
+
+from database import database
+from flow import dialogueFlow
+from flow.dialogueFlow import DialogueFlow
+from flow.utils.helpers import format_conversation_line, load_yaml
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+@pytest.fixture
+def db(tmp_path, monkeypatch):
+    """A fresh database from schema.sql, used through database.get_db() inside an app context."""
+    monkeypatch.setattr(database, "DATABASE", str(tmp_path / "chat_sessions.db"))
+    monkeypatch.setattr(database, "pool", database.ConnectionPool())
+    app = Flask("tests", root_path=REPO_ROOT)
+    app.teardown_appcontext(database.close_db)
+    with app.app_context():
+        database.init_db()
+        yield database.get_db()
+    database.pool.close()
+
+
+@pytest.fixture
+def dialogue_flow(tmp_path, monkeypatch):
+    """A DialogueFlow on the base script and participants, answered by the fake LLM, with no Socket.IO clients."""
+    monkeypatch.setenv("LLM_BACKEND", "fake")
+    monkeypatch.setenv("FAKE_LLM_LATENCY", "fixed:0")
+    monkeypatch.setenv("FAKE_LLM_SPEAK_PROBABILITY", "1")
+    for name in ("send_message_via_socketio", "send_agent_status_via_socketio", "send_stage_update_via_socketio",
+                 "send_system_status"):
+        monkeypatch.setattr(dialogueFlow, name, lambda *args, **kwargs: None)
+    roles = load_yaml(f"{REPO_ROOT}/flow/crews/config/base_participants.yaml")
+    return DialogueFlow(
+        socketio=SocketIO(Flask(__name__), async_mode="threading"),
+        conversation=format_conversation_line(1712345678.0, 0, "System", "Chào mừng các bạn."),
+        filename=str(tmp_path / "session.log"),
+        problem="Xét tính đơn điệu của hàm số",
+        stage_state={"completed_task_ids": [], "signal": "1"},
+        current_stage_id="1",
+        participants=list(roles),
+        script=load_yaml(f"{REPO_ROOT}/flow/crews/config/base_script.yaml"),
+        turn_number=0,
+        inner_thought=[],
+    )
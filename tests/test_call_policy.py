@@ -0,0 +1,116 @@
+import asyncio
+import time
+
+import pytest
+
+from flow.utils.call_policy import CallPolicies, CallPolicy, CircuitBreaker, CircuitOpenError, is_transient
+
+
+def make_policies(threshold=1, cooldown=0.05, **policy):
+    policies = CallPolicies(CircuitBreaker(threshold=threshold, cooldown=cooldown))
+    policies._policies["task"] = CallPolicy(**{"timeout": 1.0, "max_attempts": 1, "backoff": 0.01, **policy})
+    return policies
+
+
+def fail(n):
+    raise ConnectionError("connection reset")
+
+
+def test_breaker_opens_and_recovers_after_cooldown():
+    policies = make_policies()
+    with pytest.raises(ConnectionError):
+        policies.call("task", fail)
+    with pytest.raises(CircuitOpenError):
+        policies.call("task", lambda n: "ok")
+    time.sleep(0.06)
+    assert policies.call("task", lambda n: "ok") == "ok"
+    assert policies.breaker.state == "closed"
+
+
+def test_cancelled_probe_frees_the_breaker():
+    policies = make_policies()
+    with pytest.raises(ConnectionError):
+        policies.call("task", fail)
+    time.sleep(0.06)
+
+    async def run():
+        probe = asyncio.ensure_future(policies.call_async("task", lambda n: asyncio.sleep(10)))
+        await asyncio.sleep(0.01)
+        assert policies.breaker.state == "half_open"
+        probe.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await probe
+        return await policies.call_async("task", lambda n: asyncio.sleep(0, result="ok"))
+
+    assert asyncio.run(run()) == "ok"
+    assert policies.breaker.state == "closed"
+
+
+def test_stuck_probe_is_given_up_after_cooldown():
+    breaker = CircuitBreaker(threshold=1, cooldown=0.05)
+    breaker.record_failure()
+    time.sleep(0.06)
+    assert breaker.before_call() is True
+    with pytest.raises(CircuitOpenError):
+        breaker.before_call()
+    time.sleep(0.06)
+    assert breaker.before_call() is True
+
+
+def test_retries_then_succeeds():
+    policies = make_policies(threshold=5, max_attempts=3)
+    calls = []
+
+    def flaky(n):
+        calls.append(n)
+        if len(calls) < 3:
+            raise TimeoutError("transient")
+        return "ok"
+
+    assert policies.call("task", flaky) == "ok"
+    assert calls == [0, 1, 2]
+
+
+class ProviderError(Exception):
+    def __init__(self, message, status_code):
+        super().__init__(message)
+        self.status_code = status_code
+
+
+class RateLimitError(Exception):
+    pass
+
+
+def test_is_transient():
+    assert is_transient(TimeoutError())
+    assert is_transient(ProviderError("overloaded", 503))
+    assert is_transient(RateLimitError("quota"))
+    wrapped = RuntimeError("crew failed")
+    wrapped.__cause__ = ProviderError("too many requests", 429)
+    assert is_transient(wrapped)
+    assert not is_transient(ProviderError("invalid api key", 401))
+    assert not is_transient(ValueError("Template variable 'a' not found"))
+    assert not is_transient(CircuitOpenError())
+
+
+def test_non_transient_error_is_not_retried_and_keeps_the_breaker_closed():
+    policies = make_policies(threshold=1, max_attempts=3)
+    calls = []
+
+    def bad_request(n):
+        calls.append(n)
+        raise ProviderError("invalid argument", 400)
+
+    with pytest.raises(ProviderError):
+        policies.call("task", bad_request)
+    assert calls == [0]
+    assert policies.breaker.state == "closed"
+
+
+def test_timeout_and_hedge():
+    policies = make_policies(threshold=5, timeout=0.05)
+    with pytest.raises(TimeoutError):
+        policies.call("task", lambda n: time.sleep(0.2))
+
+    policies = make_policies(threshold=5, timeout=1.0, hedge_after="0.02")
+    assert policies.call("task", lambda n: time.sleep(0.3 if n == 0 else 0) or f"request {n}") == "request 1"
@@ -0,0 +1,24 @@
+from flow.utils.checkpointer import Checkpointer
+
+
+def usage(session_id, task_name):
+    return {"session_id": session_id, "agent_name": "Bob", "task_name": task_name, "prompt_tokens": 10,
+            "completion_tokens": 5, "total_tokens": 15, "seconds": 0.1, "cached": False, "turn_number": 1}
+
+
+def test_llm_calls_are_written_in_the_checkpoint_batch():
+    batches = []
+    checkpointer = Checkpointer(write=lambda *batch: batches.append(batch), interval=0.05)
+    checkpointer.record_llm_call(usage("s1", "think"))
+    checkpointer.record_llm_call(usage("s1", "talk"))
+    checkpointer.record_event("s1", "new_message", "Bob", {"text": "Chào"}, turn_number=1)
+    checkpointer.checkpoint("s1", {"turn_number": 1})
+    assert checkpointer.flush()
+
+    events = [event for batch in batches for event in batch[0]]
+    llm_calls = [record for batch in batches for record in batch[2]]
+    assert [event["event_type"] for event in events] == ["new_message"]
+    assert [record["task_name"] for record in llm_calls] == ["think", "talk"]
+    assert checkpointer.stats()["queued_llm_calls"] == 0
+    checkpointer.close()
+
@@ -0,0 +1,47 @@
+from flow.utils.conversation_context import ConversationContext, estimate_tokens, split_messages
+from flow.utils.helpers import format_conversation_line
+
+
+def conversation(count):
+    return "".join(format_conversation_line(1712345678.0 + i, i, "An", f"tin nhắn {i}") for i in range(count))
+
+
+def test_split_messages_keeps_continuation_lines():
+    text = conversation(2) + "dòng tiếp theo\n"
+    messages = split_messages(text)
+    assert len(messages) == 2
+    assert messages[1].endswith("tin nhắn 1\ndòng tiếp theo\n")
+
+
+def test_pending_chunk_waits_for_a_full_chunk_outside_the_window():
+    context = ConversationContext(conversation(13), window_size=4, chunk_size=10)
+    assert context.pending_chunk() == ([], 0)
+
+    context.add_message(format_conversation_line(1.0, 13, "Bob", "tin nhắn 13"))
+    chunk, upto = context.pending_chunk()
+    assert upto == 10
+    assert chunk == context.messages[:10]
+
+
+def test_render_uses_summary_and_messages_after_it():
+    context = ConversationContext(conversation(14), window_size=4, chunk_size=10)
+    context.apply_summary("Nhóm đã thống nhất cách làm.", 10)
+    rendered = context.render()
+    assert rendered.startswith("[Tóm tắt các lượt trước]\nNhóm đã thống nhất cách làm.")
+    assert "tin nhắn 9\n" not in rendered
+    assert rendered.endswith("".join(context.messages[10:]))
+
+
+def test_window_size_zero_renders_full_conversation():
+    text = conversation(30)
+    context = ConversationContext(text, window_size=0, summary="bỏ qua", summarized_upto=20)
+    assert context.pending_chunk() == ([], 20)
+    assert context.render() == text
+
+
+def test_budget_drops_oldest_messages_but_keeps_the_latest():
+    context = ConversationContext(conversation(10), window_size=0)
+    per_message = estimate_tokens(context.messages[0])
+    rendered = context.render(max_tokens=per_message * 3)
+    assert rendered == "".join(context.messages[-3:])
+    assert context.render(max_tokens=1) == context.messages[-1]
@@ -0,0 +1,62 @@
+from database.database import append_event, get_message_page
+
+
+def add_messages(session_id, turns):
+    """Append `turns` as (turn_number, message count) message events, one millisecond apart."""
+    timestamp = 1712345678000
+    for turn_number, count in turns:
+        for i in range(count):
+            timestamp += 1
+            append_event(session_id, "new_message", "An", {"text": f"{turn_number}.{i}"},
+                         turn_number=turn_number, timestamp=timestamp, commit=False)
+
+
+def turn_numbers(rows):
+    return [row['turn_number'] for row in rows]
+
+
+def test_page_never_splits_a_turn(db):
+    add_messages("s1", [(1, 1), (2, 3), (3, 1), (4, 2)])
+    db.commit()
+
+    rows, has_more = get_message_page("s1", limit=2)
+    # The limit falls inside turn 2: all of its messages come with the page
+    assert turn_numbers(rows) == [1, 2, 2, 2]
+    assert has_more
+
+    rows, has_more = get_message_page("s1", after_turn=2, limit=2)
+    assert turn_numbers(rows) == [3, 4, 4]
+    assert not has_more
+
+
+def test_pages_cover_every_message_once(db):
+    add_messages("s1", [(1, 2), (2, 1), (3, 3), (4, 1), (5, 2)])
+    add_messages("s2", [(1, 5)])
+    db.commit()
+
+    seen, after_turn, has_more = [], None, True
+    while has_more:
+        rows, has_more = get_message_page("s1", after_turn=after_turn, limit=3)
+        seen += [row["content"]["text"] for row in rows]
+        after_turn = rows[-1]['turn_number']
+    all_rows, more = get_message_page("s1")
+    assert seen == [row["content"]["text"] for row in all_rows]
+    assert len(seen) == 9 and not more
+
+
+def test_executemany_waits_for_a_locked_database(db, monkeypatch):
+    import sqlite3
+    import threading
+    import time
+    from database import database
+
+    blocker = sqlite3.connect(database.DATABASE, check_same_thread=False)
+    blocker.execute("BEGIN IMMEDIATE")
+    threading.Timer(0.2, blocker.commit).start()
+    started = time.monotonic()
+    db.executemany("INSERT INTO llm_calls (session_id, timestamp, agent_name, task_name, seconds) VALUES (?, ?, ?, ?, ?)",
+                   ((f"s{i}", i, "Bob", "think", 0.1) for i in range(3)))
+    db.commit()
+    assert time.monotonic() - started >= 0.15
+    assert db.execute("SELECT COUNT(*) FROM llm_calls").fetchone()[0] == 3
+    blocker.close()
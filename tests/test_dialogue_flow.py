@@ -0,0 +1,16 @@
+from flow.utils.fake_llm import FakeLLM
+from flow.utils.log_sink import log_sink
+
+
+def test_unparseable_evaluation_is_a_turn_where_everyone_listens(dialogue_flow, monkeypatch):
+    respond = FakeLLM.respond
+    monkeypatch.setattr(FakeLLM, "respond", lambda self, prompt: (
+        "Xin lỗi, tôi không đánh giá được." if self.task_name == "evaluate" else respond(self, prompt)
+    ))
+    dialogue_flow.state.is_processing = True
+    assert dialogue_flow.run_turn() is None
+    assert dialogue_flow.state.evaluation == []
+    assert dialogue_flow.state.talker is None
+    assert log_sink.flush()
+    with open(dialogue_flow.filename, encoding="utf-8") as f:
+        assert "No agent chose to speak." in f.read()
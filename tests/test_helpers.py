@@ -0,0 +1,71 @@
+import json
+
+import pytest
+
+from flow.utils.helpers import extract_json, parse_output, repair_json, schema_error
+
+# LLM outputs the old chain (clean_response/literal_eval) had to cope with
+DEFECTIVE_OUTPUTS = [
+    # Python repr instead of JSON
+    ("{'speaker': 'An', 'ok': True}", {"speaker": "An", "ok": True}),
+    ("{'a': 'it\\'s', 'b': 'say \"hi\"', 'c': None}", {"a": "it's", "b": 'say "hi"', "c": None}),
+    # Markdown fence and prose around the object
+    ('Đây là kết quả:\n```json\n{"spoken_message": "Chào cả nhóm"}\n```\nHy vọng hữu ích!',
+     {"spoken_message": "Chào cả nhóm"}),
+    # Doubled braces copied from the prompt template
+    ('{{"signal": ["1"], "completed_task_ids": []}}', {"signal": ["1"], "completed_task_ids": []}),
+    # LaTeX backslashes and a raw newline inside a string
+    ('{"spoken_message": "Ta có \\frac{1}{2} \\times 4\nnên bằng 2"}',
+     {"spoken_message": "Ta có \\frac{1}{2} \\times 4\nnên bằng 2"}),
+    # Unescaped quotes inside a string
+    ('{"spoken_message": "Bạn ấy nói "đúng rồi" đấy", "n": 1}', {"spoken_message": 'Bạn ấy nói "đúng rồi" đấy', "n": 1}),
+    # Missing commas: adjacent strings on one line, and members on separate lines
+    ('{"a": "x" "b": 2}', {"a": "x", "b": 2}),
+    ('{"a": "x"\n"b": 2}', {"a": "x", "b": 2}),
+    # Trailing commas
+    ('{"signal": ["1", "2",], "completed_task_ids": [],}', {"signal": ["1", "2"], "completed_task_ids": []}),
+    # Truncated output
+    ('[{"name": "An", "action": "speak"}, {"name": "Bo', [{"name": "An", "action": "speak"}, {"name": "Bo"}]),
+]
+
+
+@pytest.mark.parametrize("text, expected", DEFECTIVE_OUTPUTS)
+def test_repair_json_fixes_defective_outputs(text, expected):
+    json_text, _ = repair_json(text)
+    assert json.loads(json_text) == expected
+
+
+def test_repair_json_leaves_valid_json_alone():
+    text = '{"stimuli": ["a"], "thought": "x \\"y\\" \\u00e9", "action": "speak"}'
+    assert repair_json(text) == (text, False)
+    assert repair_json("không có JSON") == (None, False)
+
+
+def test_schema_error():
+    schema = {"stimuli": list, "thought": str, "score": (int, float)}
+    assert schema_error({"stimuli": [], "thought": "x", "score": 1.5}, schema) is None
+    assert schema_error({"stimuli": [], "thought": "x"}, schema) == "missing 'score'"
+    assert schema_error({"stimuli": [], "thought": 1, "score": 1}, schema) == "'thought': expected str"
+    assert schema_error({"stimuli": [], "thought": "x", "score": True}, schema) == "'score': expected int or float"
+    assert schema_error([], schema) == "expected an object"
+
+
+def test_extract_json_validates_against_the_task_schema():
+    think = "{'stimuli': ['An hỏi'], 'thought': 'Nên trả lời', 'action': 'speak'}"
+    assert extract_json(think, "think") == {"stimuli": ["An hỏi"], "thought": "Nên trả lời", "action": "speak"}
+    assert extract_json('{"thought": "thiếu trường"}', "think") is None
+    assert extract_json("Xin lỗi, tôi không thể trả lời.", "think") is None
+
+
+def test_extract_json_drops_invalid_array_items():
+    evaluation = ('[{"name": "An", "action": "speak", "internal_score": 4, "external_score": 3.5},'
+                  ' {"name": "Bob", "action": "listen"}]')
+    assert extract_json(evaluation, "evaluate") == [
+        {"name": "An", "action": "speak", "internal_score": 4, "external_score": 3.5}
+    ]
+    assert extract_json('[{"name": "Bob"}]', "evaluate") is None
+
+
+def test_parse_output_renders_the_message_field():
+    assert parse_output("{'spoken_message': '**Đúng** rồi'}", "spoken_message", "talk") == "<strong>Đúng</strong> rồi"
+    assert parse_output("không phải JSON", "spoken_message", "talk") == "..."
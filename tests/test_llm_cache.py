@@ -0,0 +1,42 @@
+import pytest
+
+from flow.crews.dialogueCrew import crew_factory
+from flow.utils.llm_cache import LLMCacheMiss, LLMResponseCache, stable_inputs
+
+
+def talk_inputs(timestamps):
+    conversation = "".join(
+        f"TIME={timestamp} | CON#{i} | SENDER=An | TEXT=Câu {i}\n" for i, timestamp in enumerate(timestamps)
+    )
+    return {"problem": "Bài toán", "current_stage_description": "Bước 1", "conversation": conversation,
+            "participants": ["Bob", "Alice"], "thought": "Nên giải thích lại"}
+
+
+@pytest.fixture
+def fake_llm(monkeypatch):
+    monkeypatch.setenv("LLM_BACKEND", "fake")
+    monkeypatch.setenv("FAKE_LLM_LATENCY", "fixed:0")
+
+
+def test_stable_inputs_drops_timestamps_and_volatile_inputs():
+    inputs = {"conversation": "TIME=1712345678.91 | CON#1 | SENDER=An | TEXT=x\n", "session_id": "abc",
+              "thoughts": ["TIME=1.5 | CON#2 | SENDER=Bob | TEXT=y"]}
+    assert stable_inputs(inputs) == {"conversation": "CON#1 | SENDER=An | TEXT=x\n",
+                                     "thoughts": ["CON#2 | SENDER=Bob | TEXT=y"]}
+
+
+def test_record_then_replay(tmp_path, fake_llm):
+    path = str(tmp_path / "llm_cache.db")
+    recorded = LLMResponseCache(path, mode="record").kickoff(
+        crew_factory.get_crew("Bob", "talk"), talk_inputs([1712345678.1, 1712345679.2])
+    )
+
+    replay = LLMResponseCache(path, mode="replay")
+    # Same session re-run later: only the wall-clock timestamps differ
+    replayed = replay.kickoff(crew_factory.get_crew("Bob", "talk"), talk_inputs([1799999999.5, 1800000000.25]))
+    assert replayed.raw == recorded.raw
+    assert replay.hits == 1
+    assert replay.recorded_outputs() == [("talk", recorded.raw)]
+
+    with pytest.raises(LLMCacheMiss):
+        replay.kickoff(crew_factory.get_crew("Bob", "talk"), {**talk_inputs([1.0]), "thought": "Khác"})
@@ -0,0 +1,66 @@
+import json
+
+import pytest
+
+from database.database import migrate_session_state
+from flow.utils import session_codec
+from flow.utils.session_codec import SessionState, decode_session_state, encode_session_state
+
+SCRIPT = {"1": {"stage": "Tìm hiểu đề"}}
+ROLES = {"Bob": "Người giải thích"}
+
+
+def test_encode_then_decode_round_trip():
+    text = encode_session_state(script=SCRIPT, roles=ROLES, stage_state={"signal": ["1"]},
+                                inner_thought=[[{"agent": "Bob", "inner_thought": "x"}]])
+    state = decode_session_state(text)
+    assert state.stage_state == {"signal": ["1"]}
+    assert state.script == SCRIPT and state.roles == ROLES
+    assert state.inner_thought == [[{"agent": "Bob", "inner_thought": "x"}]]
+
+
+def test_lazy_fields_are_parsed_on_first_access():
+    state = decode_session_state(encode_session_state(script=SCRIPT))
+    assert "script" not in state.__dict__
+    assert isinstance(state._doc["script"], str)
+    assert state.script == SCRIPT
+    assert "script" in state.__dict__
+
+
+def test_empty_state_and_missing_fields():
+    state = decode_session_state(None)
+    assert state.script is None and state.roles is None and state.stage_state is None
+    assert state.inner_thought == []
+
+
+def test_older_documents_are_upgraded(monkeypatch):
+    monkeypatch.setattr(session_codec, "SCHEMA_VERSION", 2)
+    monkeypatch.setitem(session_codec.UPGRADES, 1, lambda doc: {**doc, "v": 2, "roles": json.dumps(ROLES)})
+    state = decode_session_state(json.dumps({"v": 1, "stage_state": None}))
+    assert isinstance(state, SessionState)
+    assert state.roles == ROLES
+
+
+def test_newer_documents_are_rejected():
+    with pytest.raises(ValueError):
+        decode_session_state(json.dumps({"v": session_codec.SCHEMA_VERSION + 1}))
+
+
+def test_migrate_session_state_moves_legacy_columns(db):
+    db.execute(
+        '''INSERT INTO sessions (session_id, user_name, script, roles, stage_state, inner_thought)
+           VALUES (?, ?, ?, ?, ?, ?)''',
+        ("old", "An", json.dumps(SCRIPT), json.dumps(ROLES), '{"signal": ["1"]}', "không phải JSON")
+    )
+    migrate_session_state(db)
+    row = db.execute('SELECT script, roles, stage_state, inner_thought, state FROM sessions').fetchone()
+    assert (row['script'], row['roles'], row['stage_state'], row['inner_thought']) == (None, None, None, None)
+    state = decode_session_state(row['state'])
+    assert state.script == SCRIPT and state.roles == ROLES
+    assert state.stage_state == {"signal": ["1"]}
+    # Unreadable legacy values are dropped
+    assert state.inner_thought == []
+
+    # Rows that already have a state document are left alone
+    migrate_session_state(db)
+    assert db.execute('SELECT state FROM sessions').fetchone()['state'] == row['state']
@@ -0,0 +1,70 @@
+import time
+
+from flow.utils.session_registry import SessionRegistry
+
+
+class Flow:
+    def __init__(self, name, busy=False):
+        self.name = name
+        self.busy = busy
+
+
+def make_registry(**kwargs):
+    snapshots = []
+    registry = SessionRegistry(on_evict=lambda session_id, flow: snapshots.append(session_id),
+                               is_busy=lambda flow: flow.busy, **kwargs)
+    return registry, snapshots
+
+
+def test_over_capacity_evicts_least_recently_used_idle_flow():
+    registry, snapshots = make_registry(max_sessions=2)
+    registry.put("a", Flow("a"))
+    registry.put("b", Flow("b"))
+    registry.get("a")
+    registry.put("c", Flow("c"))
+    assert snapshots == ["b"]
+    assert registry.session_ids() == ["a", "c"]
+
+
+def test_busy_flows_are_never_evicted():
+    registry, snapshots = make_registry(max_sessions=1, idle_ttl=0.05)
+    running = registry.put("a", Flow("a", busy=True))
+    registry.put("b", Flow("b"))
+    # Over capacity: the idle flow goes even though the busy one is older
+    assert snapshots == ["b"]
+    assert registry.session_ids() == ["a"]
+
+    time.sleep(0.1)
+    assert registry.evict_idle() == 0
+    running.busy = False
+    assert registry.evict_idle() == 1
+    assert snapshots == ["b", "a"]
+
+
+def test_get_or_create_keeps_the_flow_registered_first():
+    registry, _ = make_registry()
+    first = registry.get_or_create("a", lambda: Flow("first"))
+    assert registry.get_or_create("a", lambda: Flow("second")) is first
+    assert registry.get_or_create("b", lambda: None) is None
+
+
+def test_put_snapshots_the_replaced_flow_and_remove_can_skip_it():
+    registry, snapshots = make_registry()
+    registry.put("a", Flow("old"))
+    registry.put("a", Flow("new"))
+    assert snapshots == ["a"]
+    assert registry.remove("a", snapshot=False).name == "new"
+    assert snapshots == ["a"]
+
+
+def test_flow_with_a_scheduled_turn_is_not_evicted(dialogue_flow):
+    registry = SessionRegistry(max_sessions=0, idle_ttl=0, is_busy=type(dialogue_flow).is_busy,
+                               on_evict=lambda session_id, flow: flow.turn_scheduler.cancel())
+    # Not addressed to an agent: the turn waits for the quiet period
+    dialogue_flow.process_new_message("An", "mình nghĩ thêm chút nhé")
+    assert dialogue_flow.turn_scheduler.is_pending
+    registry.put("s1", dialogue_flow)
+    assert "s1" in registry
+
+    registry.remove("s1")
+    assert not dialogue_flow.turn_scheduler.is_pending
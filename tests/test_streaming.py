@@ -0,0 +1,35 @@
+import json
+
+import pytest
+
+from flow.utils.streaming import JsonStringFieldStream
+
+RESPONSE = '```json\n' + json.dumps({"spoken_message": 'Ta có "x" = \\frac{1}{2}\nvà é'}) + '\n```'
+
+
+def feed_in_chunks(text, size):
+    stream = JsonStringFieldStream("spoken_message")
+    deltas = [stream.feed(text[i:i + size]) for i in range(0, len(text), size)]
+    return stream, deltas
+
+
+@pytest.mark.parametrize("size", [1, 2, 3, 7, len(RESPONSE)])
+def test_any_chunking_decodes_the_same_value(size):
+    stream, deltas = feed_in_chunks(RESPONSE, size)
+    assert stream.done
+    assert "".join(deltas) == stream.text == 'Ta có "x" = \\frac{1}{2}\nvà é'
+
+
+def test_split_escape_is_held_until_complete():
+    stream = JsonStringFieldStream("spoken_message")
+    assert stream.feed('{"spoken_message": "a\\') == "a"
+    assert stream.feed('u00') == ""
+    assert stream.feed('e9b"}') == "éb"
+    assert stream.done
+    assert stream.feed(', "spoken_message": "lần hai"}') == ""
+
+
+def test_other_fields_and_unicode_escapes_are_skipped():
+    text = json.dumps({"thought": "không gửi", "spoken_message": "Xin chào"}, ensure_ascii=True)
+    stream, deltas = feed_in_chunks(text, 4)
+    assert "".join(deltas) == "Xin chào"
@@ -0,0 +1,34 @@
+from flask import Flask
+from flask_socketio import SocketIO
+
+from flow.utils.turn_benchmark import wait_for_turn
+from flow.utils.turn_executor import TurnExecutor
+
+
+def make_executor():
+    app = Flask(__name__)
+    return TurnExecutor(SocketIO(app, async_mode="threading"), app, num_workers=1)
+
+
+def test_turn_reporting_an_error_counts_as_failed():
+    executor = make_executor()
+    ok = executor.submit("s1", lambda: None)
+    handled = executor.submit("s1", lambda: "Error kicking off flow")
+
+    assert wait_for_turn(ok, timeout=5)
+    assert not wait_for_turn(handled, timeout=5)
+    assert handled.status == "failed"
+    assert handled.error == "Error kicking off flow"
+    assert executor.stats()["completed"] == 1
+    assert executor.stats()["failed"] == 1
+
+
+def test_raising_turn_counts_as_failed():
+    executor = make_executor()
+
+    def boom():
+        raise RuntimeError("boom")
+
+    job = executor.submit("s1", boom)
+    assert not wait_for_turn(job, timeout=5)
+    assert job.error == "boom"
@@ -0,0 +1,72 @@
+import time
+
+from flask import Flask
+from flask_socketio import SocketIO
+
+from flow.utils.turn_scheduler import TurnScheduler
+
+
+class Turns:
+    """start_turn stand-in that records when each turn started."""
+
+    def __init__(self):
+        self.started = []
+
+    def __call__(self):
+        self.started.append(time.monotonic())
+        return True
+
+
+def make_scheduler(quiet_period, max_wait):
+    turns = Turns()
+    return TurnScheduler(SocketIO(Flask(__name__), async_mode="threading"), turns,
+                         quiet_period=quiet_period, max_wait=max_wait), turns
+
+
+def test_burst_of_messages_starts_one_turn_after_the_quiet_period():
+    scheduler, turns = make_scheduler(quiet_period=0.1, max_wait=5.0)
+    first = time.monotonic()
+    for _ in range(3):
+        assert scheduler.notify() is None
+        time.sleep(0.02)
+    time.sleep(0.3)
+    assert len(turns.started) == 1
+    assert turns.started[0] - first >= 0.14
+    assert scheduler.is_running
+
+
+def test_max_wait_bounds_a_steady_stream_of_messages():
+    scheduler, turns = make_scheduler(quiet_period=0.2, max_wait=0.15)
+    first = time.monotonic()
+    while not turns.started and time.monotonic() - first < 1.0:
+        scheduler.notify()
+        time.sleep(0.03)
+    assert turns.started and turns.started[0] - first < 0.25
+
+
+def test_messages_during_a_turn_are_folded_into_one_followup():
+    scheduler, turns = make_scheduler(quiet_period=0.05, max_wait=5.0)
+    assert scheduler.notify(immediate=True) is True
+    assert len(turns.started) == 1
+    for _ in range(3):
+        assert scheduler.notify(immediate=True) is None
+    scheduler.turn_finished()
+    time.sleep(0.2)
+    assert len(turns.started) == 2
+
+
+def test_turn_not_started_frees_the_scheduler():
+    scheduler = TurnScheduler(SocketIO(Flask(__name__), async_mode="threading"), lambda: None)
+    assert scheduler.notify(immediate=True) is None
+    assert not scheduler.is_running
+
+
+def test_cancel_drops_the_scheduled_turn():
+    scheduler, turns = make_scheduler(quiet_period=0.05, max_wait=5.0)
+    scheduler.notify()
+    assert scheduler.is_pending
+    scheduler.cancel()
+    assert not scheduler.is_pending
+    scheduler.notify(immediate=True)
+    time.sleep(0.15)
+    assert turns.started == []